@@ -50,7 +50,7 @@ def get_argv(arg):
             error_msg("Expected an argument following %s" % arg)
             exit(1)
 
-import random, os, sys, socket, webbrowser, time, math, traceback, datetime, errno
+import random, os, sys, socket, webbrowser, time, math, traceback, datetime, errno, atexit, collections
 import urllib.request, configparser as ConfigParser
 from io import StringIO
 import pickle
@@ -60,6 +60,8 @@ from datetime import date
 import gettext
 from pyglet.shapes import Line
 from pyglet.shapes import Polygon
+import bwstats
+import bwengine
 
 # TODO check if this is right
 gettext.install('messages', localedir='res/i18n')
@@ -493,6 +495,13 @@ SFX_VOLUME = 1.0
 # Default: stats.txt
 STATSFILE = stats.txt
 
+# Where to keep the stats: text (the stats file above) or sqlite (a database
+# named like the stats file, with the extension .sqlite).  When switching to
+# sqlite, the stats file and the saved sessions are imported once; use
+# tools/statsdb.py to export the database back to a stats file.
+# Default: text
+STATS_BACKEND = text
+
 # Specify the hour the stats will roll over to a new day [0-23]
 ROLLOVER_HOUR = 4
 
@@ -642,6 +651,7 @@ def dump_pyglet_info():
 # parse config file & command line options
 if '--debug' in sys.argv:
     DEBUG = True
+    bwengine.DEBUG = True
 if '--vsync' in sys.argv or sys.platform == 'darwin':
     VSYNC = True
 if '--dump' in sys.argv:
@@ -797,6 +807,7 @@ def rewrite_configfile(configfile, overwrite=False):
     except OSError as e:
         debug_msg(e)
         f = open(os.path.join(get_data_dir(), statsfile), 'w')
+        f.write(bwstats.stats_header() + '\n') # names the columns, see bwstats.StatsSchema
         f.close()
     try:
         os.stat(os.path.join(get_data_dir(), STATS_BINARY))
@@ -1068,25 +1079,11 @@ def get_color(color):
     return cfg['COLOR_%i' % color]
 
 def default_nback_mode(mode):
-    if ('BACK_%i' % mode) in cfg:
-        return cfg['BACK_%i' % mode]
-    elif mode > 127:  # try to use the base mode for crab, multi
-        return default_nback_mode(mode % 128)
-    else:
-        return cfg.BACK_DEFAULT
+    return bwengine.default_back(cfg, mode)
 
 
 def default_ticks(mode):
-    if ('TICKS_%i' % mode) in cfg:
-        return cfg['TICKS_%i' % mode]
-    elif mode > 127:
-        bonus = ((mode & 128)/128) * cfg.BONUS_TICKS_CRAB
-        if mode & 768:
-            bonus += cfg['BONUS_TICKS_MULTI_%i' % ((mode & 768)/256+1)]
-        if DEBUG: print("Adding a bonus of %i ticks for mode %i" % (bonus, mode))
-        return bonus + default_ticks(mode % 128)
-    else:
-        return cfg.TICKS_DEFAULT
+    return bwengine.default_ticks(cfg, mode)
 
 #Create the game window
 caption = []
@@ -1146,35 +1143,7 @@ class Mode:
         self.num_trials_total = self.num_trials + self.num_trials_factor * \
             self.back ** self.num_trials_exponent
 
-        self.short_mode_names = {2:'D',
-                                 3:'PCA',
-                                 4:'DC',
-                                 5:'TC',
-                                 6:'QC',
-                                 7:'A',
-                                 8:'DA',
-                                 9:'TA',
-                                 10:'Po',
-                                 11:'Au',
-                                 12:'TCC',
-                                 20:'PC',
-                                 21:'PI',
-                                 22:'CA',
-                                 23:'IA',
-                                 24:'CI',
-                                 25:'PCI',
-                                 26:'PIA',
-                                 27:'CIA',
-                                 28:'Q',
-                                 100:'AA',
-                                 101:'PAA',
-                                 102:'CAA',
-                                 103:'IAA',
-                                 104:'PCAA',
-                                 105:'PIAA',
-                                 106:'CIAA',
-                                 107:'P'
-                                 }
+        self.short_mode_names, self.modalities, self.flags = bwengine.build_modes()
 
         self.long_mode_names =  {2:_('Dual'),
                                  3:_('Position, Color, Sound'),
@@ -1206,78 +1175,18 @@ class Mode:
                                  107:_('Pentuple')
                                  }
 
-        self.modalities = { 2:['position1', 'audio'],
-                            3:['position1', 'color', 'audio'],
-                            4:['visvis', 'visaudio', 'audiovis', 'audio'],
-                            5:['position1', 'visvis', 'visaudio', 'audiovis', 'audio'],
-                            6:['position1', 'visvis', 'visaudio', 'color', 'audiovis', 'audio'],
-                            7:['arithmetic'],
-                            8:['position1', 'arithmetic'],
-                            9:['position1', 'arithmetic', 'color'],
-                            10:['position1'],
-                            11:['audio'],
-                            12:['visvis', 'visaudio', 'color', 'audiovis', 'audio'],
-                            20:['position1', 'color'],
-                            21:['position1', 'image'],
-                            22:['color', 'audio'],
-                            23:['image', 'audio'],
-                            24:['color', 'image'],
-                            25:['position1', 'color', 'image'],
-                            26:['position1', 'image', 'audio'],
-                            27:['color', 'image', 'audio'],
-                            28:['position1', 'color', 'image', 'audio'],
-                            100:['audio', 'audio2'],
-                            101:['position1', 'audio', 'audio2'],
-                            102:['color', 'audio', 'audio2'],
-                            103:['image', 'audio', 'audio2'],
-                            104:['position1', 'color', 'audio', 'audio2'],
-                            105:['position1', 'image', 'audio', 'audio2'],
-                            106:['color', 'image', 'audio', 'audio2'],
-                            107:['position1', 'color', 'image', 'audio', 'audio2']
-                            }
-
-        self.flags = {}
-
-        # generate crab modes
-        for m in list(self.short_mode_names):
-            nm = m | 128                          # newmode; Crab DNB = 2 | 128 = 130
-            self.flags[m]  = {'crab':0, 'multi':1, 'selfpaced':0}# forwards
-            self.flags[nm] = {'crab':1, 'multi':1, 'selfpaced':0}# every (self.back) stimuli are reversed for matching
-            self.short_mode_names[nm] = 'C' + self.short_mode_names[m]
-            self.long_mode_names[nm] = _('Crab ') + self.long_mode_names[m]
-            self.modalities[nm] = self.modalities[m][:] # the [:] at the end is
-            # so we take a copy of the list, in case we want to change it later
-
-        # generate multi-stim modes
-        for m in list(self.short_mode_names):
-            for n, s in [(2, _('Double-stim')), (3, _('Triple-stim')), (4, _('Quadruple-stim'))]:
-                if set(['color', 'image']).issubset(self.modalities[m]) \
-                  or not 'position1' in self.modalities[m] \
-                  or set(['visvis', 'arithmetic']).intersection(self.modalities[m]):  # Combination? AAAH! Scary!
-                    continue
-                nm = m | 256 * (n-1)               # newmode; 3xDNB = 2 | 512 = 514
-                self.flags[nm] = dict(self.flags[m]) # take a copy
-                self.flags[nm]['multi'] = n
-                self.short_mode_names[nm] = repr(n) + 'x' + self.short_mode_names[m]
-                self.long_mode_names[nm] = s + ' ' + self.long_mode_names[m]
-                self.modalities[nm] = self.modalities[m][:] # take a copy ([:])
-                for i in range(2, n+1):
-                    self.modalities[nm].insert(i-1, 'position'+repr(i))
-                if 'color' in self.modalities[m] or 'image' in self.modalities[m]:
-                    for i in range(1, n+1):
-                        self.modalities[nm].insert(n+i-1, 'vis'+repr(i))
-                for ic in 'image', 'color':
-                    if ic in self.modalities[nm]:
-                        self.modalities[nm].remove(ic)
-
-        for m in list(self.short_mode_names):
-            nm = m | 1024
-            self.short_mode_names[nm] = 'SP-' + self.short_mode_names[m]
-            self.long_mode_names[nm] = 'Self-paced ' + self.long_mode_names[m]
-            self.modalities[nm] = self.modalities[m][:]
-            self.flags[nm] = dict(self.flags[m])
-            self.flags[nm]['selfpaced'] = 1
-
+        # name the crab, multi-stim and self-paced modes after their base mode
+        multi_names = {2: _('Double-stim'), 3: _('Triple-stim'), 4: _('Quadruple-stim')}
+        for nm in self.short_mode_names:
+            m = nm & 127
+            name = self.long_mode_names[m]
+            if nm & 128:
+                name = _('Crab ') + name
+            if nm & 768:
+                name = multi_names[self.flags[nm]['multi']] + ' ' + name
+            if nm & 1024:
+                name = 'Self-paced ' + name
+            self.long_mode_names[nm] = name
 
         self.variable_list = []
 
@@ -1285,55 +1194,14 @@ class Mode:
         if not self.manual:
             self.enforce_standard_mode()
 
-        self.inputs = {'position1': False,
-                       'position2': False,
-                       'position3': False,
-                       'position4': False,
-                       'color':     False,
-                       'image':     False,
-                       'vis1':      False,
-                       'vis2':      False,
-                       'vis3':      False,
-                       'vis4':      False,
-                       'visvis':    False,
-                       'visaudio':  False,
-                       'audiovis':  False,
-                       'audio':     False,
-                       'audio2':    False}
-
-        self.input_rts = {'position1': 0.,
-                          'position2': 0.,
-                          'position3': 0.,
-                          'position4': 0.,
-                          'color':     0.,
-                          'image':     0.,
-                          'vis1':      0.,
-                          'vis2':      0.,
-                          'vis3':      0.,
-                          'vis4':      0.,
-                          'visvis':    0.,
-                          'visaudio':  0.,
-                          'audiovis':  0.,
-                          'audio':     0.,
-                          'audio2':    0.}
+        self.inputs, self.input_rts = bwengine.new_inputs()
 
         self.hide_text = cfg.HIDE_TEXT
 
-        self.current_stim = {'position1': 0,
-                             'position2': 0,
-                             'position3': 0,
-                             'position4': 0,
-                             'color':     0,
-                             'vis':       0, # image or letter for non-multi mode
-                             'vis1':      0, # image or color for multi mode
-                             'vis2':      0,
-                             'vis3':      0,
-                             'vis4':      0,
-                             'audio':     0,
-                             'audio2':    0,
-                             'number':    0}
+        self.current_stim = bwengine.new_stimulus()
 
         self.current_operation = 'none'
+        self.answer_key = None
 
         self.started = False
         self.paused = False
@@ -1358,6 +1226,8 @@ class Mode:
         self.soundlist2 = []
 
         self.bt_sequence = []
+        self.sequence = []
+        self.seed = None
 
     def enforce_standard_mode(self):
         self.back = default_nback_mode(self.mode)
@@ -1405,8 +1275,9 @@ class Graph:
     def reset_dictionaries(self):
         self.dictionaries = dict([(i, {}) for i in mode.modalities])
 
+    # only the last 50 scores of each modality are averaged
     def reset_percents(self):
-        self.percents = dict([(k, dict([(i, []) for i in v])) for k,v in mode.modalities.items()])
+        self.percents = dict([(k, dict([(i, collections.deque(maxlen=50)) for i in v])) for k,v in mode.modalities.items()])
 
     def next_nonempty_mode(self):
         self.next_mode()
@@ -1427,84 +1298,82 @@ class Graph:
         self.batch = None
         self.reset_dictionaries()
         self.reset_percents()
-        ind = {'date':0, 'modename':1, 'percent':2, 'mode':3, 'n':4, 'ticks':5,
-               'trials':6, 'manual':7, 'session':8, 'position1':9, 'audio':10,
-               'color':11, 'visvis':12, 'audiovis':13, 'arithmetic':14,
-               'image':15, 'visaudio':16, 'audio2':17, 'position2':18,
-               'position3':19, 'position4':20, 'vis1':21, 'vis2':22, 'vis3':23,
-               'vis4':24}
-
-        if os.path.isfile(os.path.join(get_data_dir(), cfg.STATSFILE)):
+
+        if os.path.isfile(stats.stats_path()):
+            if self.styles[self.style] == 'N':
+                score = lambda n, p: n
+            elif self.styles[self.style] == '%':
+                score = lambda n, p: .01*p
+            elif self.styles[self.style] == 'N.%':
+                score = lambda n, p: n + .01*p
+            elif self.styles[self.style] == 'N+2*%-1':
+                score = lambda n, p: n - 1 + 2*.01*p
+            elif self.styles[self.style] == 'N+10/3+4/3':
+                adv, flb = get_threshold_advance(), get_threshold_fallback()
+                m = 1./(adv - flb)
+                b = -m*flb
+                score = lambda n, p, m=m, b=b: n + b + m*p # m is reused below
+
+            # each day is accumulated as [sessions, total score, best score]
+            # rather than keeping every session's entry
             try:
-                statsfile_path = os.path.join(get_data_dir(), cfg.STATSFILE)
-                statsfile = open(statsfile_path, 'r')
-                for line in statsfile:
-                    if line == '': continue
-                    if line == '\n': continue
-                    if line[0] not in '0123456789': continue
-                    datestamp = date(int(line[:4]), int(line[5:7]), int(line[8:10]))
-                    hour = int(line[11:13])
-                    if hour < cfg.ROLLOVER_HOUR:
-                        datestamp = date.fromordinal(datestamp.toordinal() - 1)
-                    if line.find('\t') >= 0:
-                        separator = '\t'
-                    else: separator = ','
-                    newline = line.split(separator)
-                    try:
-                        if int(newline[7]) != 0: # only consider standard mode
-                            continue
-                    except:
+                # sessions moved out by tools/compactstats.py are only
+                # summarized, per day; every style is linear in N and %, so
+                # a day's total follows from its sums, and its best from
+                # its frontier
+                c = score(0, 0)
+                dn, dp = score(1, 0) - c, score(0, 1) - c
+                summary = bwstats.StatsSummary(os.path.join(get_data_dir(), cfg.STATSFILE) + bwstats.SUMMARY_SUFFIX)
+                for newmode, days in summary.days.items():
+                    if newmode not in self.dictionaries:
+                        continue
+                    for ordinal, day in days.items():
+                        self.dictionaries[newmode][date.fromordinal(ordinal)] = [
+                            day[0], c*day[0] + dn*day[1] + dp*day[2],
+                            max([score(n, p) for n, p in day[3]])]
+                    for m in mode.modalities[newmode]:
+                        self.percents[newmode][m].extend(summary.tails[newmode].get(m, []))
+
+                # shares the parsed stats with the Stats class
+                history = stats.load_history()
+                dates = {}
+                for i in stats.sessions(manual=False): # only consider standard mode
+                    newmode = history.mode[i]
+                    if newmode not in self.dictionaries:
                         continue
-                    newmode = int(newline[3])
-                    newback = int(newline[4])
+                    ordinal = history.day(i, cfg.ROLLOVER_HOUR)
+                    if ordinal not in dates:
+                        dates[ordinal] = date.fromordinal(ordinal)
+                    datestamp = dates[ordinal]
 
-                    while len(newline) < 24:
-                        newline.append('0') # make it work for image mode, missing visaudio and audio2
-                    if len(newline) >= 16:
-                        for m in mode.modalities[newmode]:
-                            self.percents[newmode][m].append(int(newline[ind[m]]))
+                    for m in mode.modalities[newmode]:
+                        self.percents[newmode][m].append(history.column(m)[i])
 
                     dictionary = self.dictionaries[newmode]
+                    value = score(history.back[i], history.percent[i])
                     if datestamp not in dictionary:
-                        dictionary[datestamp] = []
-                    dictionary[datestamp].append([newback] + [int(newline[2])] + \
-                        [self.percents[newmode][n][-1] for n in mode.modalities[newmode]])
+                        dictionary[datestamp] = [1, value, value]
+                    else:
+                        day = dictionary[datestamp]
+                        day[0] += 1
+                        day[1] += value
+                        if value > day[2]:
+                            day[2] = value
 
-                statsfile.close()
             except:
-                quit_with_error(_('Error parsing stats file\n %s') %
-                                os.path.join(get_data_dir(), cfg.STATSFILE),
+                quit_with_error(_('Error parsing stats file\n %s') % stats.stats_path(),
                                 _('Please fix, delete or rename the stats file.'))
 
-            def mean(x):
-                if len(x):
-                    return sum(x)/float(len(x))
-                else:
-                    return 0.
             def cent(x):
                 return map(lambda y: .01*y, x)
 
             for dictionary in self.dictionaries.values():
-                for datestamp in list(dictionary): # this would be so much easier with numpy
-                    entries = dictionary[datestamp]
-                    if self.styles[self.style] == 'N':
-                        scores = [entry[0] for entry in entries]
-                    elif self.styles[self.style] == '%':
-                        scores = [.01*entry[1] for entry in entries]
-                    elif self.styles[self.style] == 'N.%':
-                        scores = [entry[0] + .01*entry[1] for entry in entries]
-                    elif self.styles[self.style] == 'N+2*%-1':
-                        scores = [entry[0] - 1 + 2*.01*entry[1] for entry in entries]
-                    elif self.styles[self.style] == 'N+10/3+4/3':
-                        adv, flb = get_threshold_advance(), get_threshold_fallback()
-                        m = 1./(adv - flb)
-                        b = -m*flb
-                        scores = [entry[0] + b + m*(entry[1]) for entry in entries]
-                    dictionary[datestamp] = (mean(scores), max(scores))
+                for datestamp, day in dictionary.items():
+                    dictionary[datestamp] = (day[1]/float(day[0]), day[2])
 
             for game in self.percents:
                 for category in self.percents[game]:
-                    pcts = self.percents[game][category][-50:]
+                    pcts = list(self.percents[game][category])
                     if not pcts:
                         self.percents[game][category].append(0)
                     else:
@@ -3305,64 +3174,11 @@ class SpaceLabel:
             self.label.text = ''.join(str_list)
 
 def check_match(input_type, check_missed = False):
-    current = 0
-    back_data = ''
-    operation = 0
-    # FIXME:  I'm not going to think about whether crab_back will work with
-    # cfg.VARIABLE_NBACK yet, since I don't actually understand how the latter works
-
-    if mode.flags[mode.mode]['crab'] == 1:
-        back = 1 + 2*((mode.trial_number-1) % mode.back)
-    else:
-        back = mode.back
-
-    if cfg.VARIABLE_NBACK:
-        nback_trial = mode.trial_number - mode.variable_list[mode.trial_number - back - 1] - 1
-    else:
-        nback_trial = mode.trial_number - back - 1
-
-    if len(stats.session['position1']) < mode.back:
-        return 'unknown'
-
-    if   input_type in ('visvis', 'visaudio', 'image'):
-        current = mode.current_stim['vis']
-    elif input_type in ('audiovis', ):
-        current = mode.current_stim['audio']
-    if   input_type in ('visvis', 'audiovis', 'image'):
-        back_data = 'vis'
-    elif input_type in ('visaudio', ):
-        back_data = 'audio'
-    elif input_type == 'arithmetic':
-        current = mode.current_stim['number']
-        back_data = stats.session['numbers'][nback_trial]
-        operation = mode.current_operation
-    else:
-        current = mode.current_stim[input_type]
-        back_data = input_type
-
     if input_type == 'arithmetic':
-        if operation == 'add':
-            correct_answer = back_data + current
-        elif operation == 'subtract':
-            correct_answer = back_data - current
-        elif operation == 'multiply':
-            correct_answer = back_data * current
-        elif operation == 'divide':
-            correct_answer = Decimal(back_data) / Decimal(current)
-        if correct_answer == arithmeticAnswerLabel.parse_answer():
-            return 'correct'
+        answer = arithmeticAnswerLabel.parse_answer()
     else:
-        # Catch accesses past list end
-        try:
-            if current == stats.session[back_data][nback_trial]:
-                if check_missed:
-                    return 'missed'
-                else:
-                    return 'correct'
-        except Exception as e:
-            print(e)
-            return 'incorrect'
-    return 'incorrect'
+        answer = None
+    return bwengine.check_match(mode, input_type, check_missed, answer)
 
 
 # this controls the statistics which display upon completion of a session.
@@ -3381,49 +3197,10 @@ class AnalysisLabel:
             self.label.text = ''
             return
 
-        poss_mods = ['position1', 'position2', 'position3', 'position4',
-                     'vis1', 'vis2', 'vis3', 'vis4',  'color', 'visvis',
-                     'visaudio', 'audiovis', 'image', 'audio',
-                     'audio2', 'arithmetic'] # arithmetic must be last so it's easy to exclude
-
-        rights = dict([(mod, 0) for mod in poss_mods])
-        wrongs = dict([(mod, 0) for mod in poss_mods])
-        category_percents = dict([(mod, 0) for mod in poss_mods])
-
+        poss_mods = bwengine.SCORED_MODALITIES
         mods = mode.modalities[mode.mode]
-        data = stats.session
-
-        for mod in mods:
-            for x in range(mode.back, len(data['position1'])):
-
-                if mode.flags[mode.mode]['crab'] == 1:
-                    back = 1 + 2*(x % mode.back)
-                else:
-                    back = mode.back
-                if cfg.VARIABLE_NBACK:
-                    back = mode.variable_list[x - back]
-
-                # data is a dictionary of lists.
-                if mod in ['position1', 'position2', 'position3', 'position4',
-                           'vis1', 'vis2', 'vis3', 'vis4', 'audio', 'audio2', 'color', 'image']:
-                    rights[mod] += int((data[mod][x] == data[mod][x-back]) and data[mod+'_input'][x])
-                    wrongs[mod] += int((data[mod][x] == data[mod][x-back])  ^  data[mod+'_input'][x]) # ^ is XOR
-                    if cfg.JAEGGI_SCORING:
-                        rights[mod] += int(data[mod][x] != data[mod][x-back]  and not data[mod+'_input'][x])
-
-                if mod in ['visvis', 'visaudio', 'audiovis']:
-                    modnow = mod.startswith('vis') and 'vis' or 'audio' # these are the python<2.5 compatible versions
-                    modthn = mod.endswith('vis')   and 'vis' or 'audio' # of 'vis' if mod.startswith('vis') else 'audio'
-                    rights[mod] += int((data[modnow][x] == data[modthn][x-back]) and data[mod+'_input'][x])
-                    wrongs[mod] += int((data[modnow][x] == data[modthn][x-back])  ^  data[mod+'_input'][x])
-                    if cfg.JAEGGI_SCORING:
-                        rights[mod] += int(data[modnow][x] != data[modthn][x-back]  and not data[mod+'_input'][x])
-
-                if mod in ['arithmetic']:
-                    ops = {'add':'+', 'subtract':'-', 'multiply':'*', 'divide':'/'}
-                    answer = eval("Decimal(data['numbers'][x-back]) %s Decimal(data['numbers'][x])" % ops[data['operation'][x]])
-                    rights[mod] += int(answer == Decimal(data[mod+'_input'][x])) # data[...][x] is only Decimal if op == /
-                    wrongs[mod] += int(answer != Decimal(data[mod+'_input'][x]))
+        percent, category_percents, rights, wrongs = \
+            bwengine.score_session(mode, stats.session, cfg)
 
         str_list = []
         if not CLINICAL_MODE:
@@ -3440,23 +3217,11 @@ class AnalysisLabel:
             if 'arithmetic' in mods:
                 str_list += ["%s:%i-%i%s" % (_("Arithmetic"), rights['arithmetic'], wrongs['arithmetic'], sep)]
 
-        def calc_percent(r, w):
-            if r+w: return int(r*100 / float(r+w))
-            else:   return 0
-
-        right = sum([rights[mod] for mod in mods])
-        wrong = sum([wrongs[mod] for mod in mods])
-
-        for mod in mods:
-            category_percents[mod] = calc_percent(rights[mod], wrongs[mod])
-
         if cfg.JAEGGI_SCORING:
-            percent = min([category_percents[m] for m in mode.modalities[mode.mode]])
-            #percent = min(category_percents['position1'], category_percents['audio']) # cfg.JAEGGI_MODE forces mode.mode==2
+            # the lowest score of any modality
             if not CLINICAL_MODE:
                 str_list += [_('Lowest score: %i%%') % percent]
         else:
-            percent = calc_percent(right, wrong)
             str_list += [_('Score: %i%%') % percent]
 
         self.label.text = ''.join(str_list)
@@ -3521,23 +3286,23 @@ class ChartLabel:
             self.column3[x].text = ''
         if mode.started: return
         index = 0
-        for x in range(len(stats.history) - 20, len(stats.history)):
-            if x < 0: continue
-            manual = stats.history[x][4]
+        table = stats.table
+        for x in stats.sessions(today=True, limit=20):
+            manual = table.manual[x]
             color = self.color_normal
-            if not manual and stats.history[x][3] >= get_threshold_advance():
+            if not manual and table.percent[x] >= get_threshold_advance():
                 color = self.color_advance
-            elif not manual and stats.history[x][3] < get_threshold_fallback():
+            elif not manual and table.percent[x] < get_threshold_fallback():
                 color = self.color_fallback
             self.column1[index].color = color
             self.column2[index].color = color
             self.column3[index].color = color
             if manual:
                 self.column1[index].text = 'M'
-            elif stats.history[x][0] > -1:
-                self.column1[index].text = '#%i' % stats.history[x][0]
-            self.column2[index].text = mode.short_name(mode=stats.history[x][1], back=stats.history[x][2])
-            self.column3[index].text = '%i%%' % stats.history[x][3]
+            elif table.session[x] > -1:
+                self.column1[index].text = '#%i' % table.session[x]
+            self.column2[index].text = mode.short_name(mode=table.mode[x], back=table.back[x])
+            self.column3[index].text = '%i%%' % table.percent[x]
             index += 1
 
 # this controls the title of the session history chart.
@@ -3554,9 +3319,11 @@ class AverageLabel:
         if mode.started or CLINICAL_MODE:
             self.label.text = ''
         else:
-            sessions = [sess for sess in stats.history if sess[1] == mode.mode][-20:]
-            if sessions:
-                average = sum([sess[2] for sess in sessions]) / float(len(sessions))
+            # the last 20 sessions of each mode are kept by stats.modes
+            levels = [stats.table.back[i] for i in stats.modes.recent.get(mode.mode, ())
+                      if i >= stats.today_start]
+            if levels:
+                average = sum(levels) / float(len(levels))
             else:
                 average = 0.
             self.label.text = _("%sNB average: %1.2f") % (mode.short_mode_names[mode.mode], average)
@@ -3575,10 +3342,6 @@ class TodayLabel:
         if mode.started:
             self.labelTitle.text = ''
         else:
-            total_trials = sum([mode.num_trials + mode.num_trials_factor * \
-                his[2] ** mode.num_trials_exponent for his in stats.history])
-            total_time = mode.ticks_per_trial * TICK_DURATION * total_trials
-
             self.labelTitle.text = _(
                 ("%i min %i sec done today in %i sessions\n" \
                + "%i min %i sec done in last 24 hours in %i sessions") \
@@ -3752,102 +3515,167 @@ class Stats:
     def __init__(self):
         # set up data variables
         self.initialize_session()
-        self.history = []
-        self.full_history = [] # not just today
+        self.parsed = None # bwstats.ParsedStats for the current stats file
+        self.clinical_log = None # bwstats.ClinicalLog, in clinical mode
+        self.table = bwstats.History() # every session in the stats file
+        self.unsaved = [] # rows of the sessions played with ATTEMPT_TO_SAVE_STATS off
+        self.today_start = 0 # index of the first of today's sessions in self.table
+        self.windows = bwstats.TimeIndex() # self.table sorted by time
+        self.modes = bwstats.ModeIndex() # self.table by game mode
+        self.cleared = 0 # sessions before this timestamp don't count as today's
+        self.next_rollover = 0
+        self.sessions_total = 0 # including those moved out by tools/compactstats.py
         self.sessions_today = 0
         self.time_today = 0
         self.time_thours = 0
         self.sessions_thours = 0
 
+    # the stats file, or the database with STATS_BACKEND = sqlite
+    def stats_path(self):
+        statsfile_path = os.path.join(get_data_dir(), cfg.STATSFILE)
+        if cfg.STATS_BACKEND == 'sqlite':
+            return os.path.splitext(statsfile_path)[0] + '.sqlite'
+        return statsfile_path
+
+    def open_stats(self):
+        path = self.stats_path()
+        if self.parsed is None or self.parsed.path != path:
+            if isinstance(self.parsed, bwstats.StatsDatabase):
+                self.parsed.close()
+            if cfg.STATS_BACKEND == 'sqlite':
+                importing = not os.path.exists(path)
+                self.parsed = bwstats.StatsDatabase(path)
+                statsfile_path = os.path.join(get_data_dir(), cfg.STATSFILE)
+                if importing and os.path.isfile(statsfile_path):
+                    self.parsed.import_stats(statsfile_path,
+                        os.path.join(get_data_dir(), USER + '-sessions.dat'))
+            else:
+                bwstats.finish_compaction(path, os.path.join(get_data_dir(), USER + '-sessions.dat'))
+                self.parsed = bwstats.ParsedStats(path)
+        return self.parsed
+
+    # the stats are loaded once into a columnar table (bwstats.History)
+    # which Graph and the labels query as well; only sessions added since the
+    # last call are loaded.
+    def load_history(self):
+        self.open_stats().update()
+        self.table = self.parsed.history
+        if self.unsaved:
+            # not part of the parsed stats, whose rows must all be in the file
+            self.table = self.table.copy()
+            self.table.extend(self.unsaved)
+        self.modes.update(self.table)
+        if self.parsed.quarantined:
+            self.report_quarantine()
+        return self.table
+
+    # the clinical log is hash-chained; whatever was appended to it since it
+    # was last verified is checked when it is opened
+    def open_clinical_log(self):
+        path = os.path.join(get_data_dir(), STATS_BINARY)
+        if self.clinical_log is None or self.clinical_log.path != path:
+            self.clinical_log = bwstats.ClinicalLog(path)
+            problems = self.clinical_log.verify()
+            if problems:
+                details = '\n'.join([_('record %i: %s') % (number + 1, reason)
+                                     for number, offset, reason in problems[:5]])
+                if len(problems) > 5:
+                    details += '\n...'
+                Message(_('The session log\n%s\nfailed verification:\n%s\n\n'
+                          'Press any key to continue.') % (path, details))
+        return self.clinical_log
+
+    # malformed lines are skipped rather than fatal; tell the user once
+    def report_quarantine(self):
+        lines = self.parsed.quarantined
+        self.parsed.quarantined = []
+        details = '\n'.join([_('line %i: %s') % (number, reason) for number, reason, line in lines[:5]])
+        if len(lines) > 5:
+            details += '\n...'
+        Message(_('%i malformed lines in the stats file were skipped:\n%s\n\n'
+                  'They were copied to\n%s\nwhere you can fix them and add them back.\n\n'
+                  'Press any key to continue.') %
+                (len(lines), details,
+                 os.path.join(get_data_dir(), cfg.STATSFILE) + bwstats.QUARANTINE_SUFFIX))
+
+    # indices into self.table of the sessions of a mode (all modes if None),
+    # oldest first; the database backend answers this from its indices.
+    def sessions(self, mode=None, today=False, manual=None, limit=None):
+        start = today and self.today_start or 0
+        if isinstance(self.parsed, bwstats.StatsDatabase):
+            return self.parsed.indices(mode=mode, start=start, manual=manual, limit=limit)
+        if mode is not None and manual is None:
+            return self.modes.indices(mode, start=start, limit=limit)
+        sessions = self.table.indices(mode=mode, start=start)
+        if manual is not None:
+            sessions = [i for i in sessions if self.table.manual[i] == manual]
+        if limit is not None:
+            sessions = sessions[-limit:]
+        return sessions
+
     def parse_statsfile(self):
         self.clear()
-        if os.path.isfile(os.path.join(get_data_dir(), cfg.STATSFILE)):
+        self.cleared = 0
+        self.unsaved = []
+        # the database is created (and the stats file imported) on first use
+        if cfg.STATS_BACKEND == 'sqlite' or os.path.isfile(self.stats_path()):
             try:
-                #last_session = []
-                #last_session_number = 0
-                last_mode = 0
-                last_back = 0
-                statsfile_path = os.path.join(get_data_dir(), cfg.STATSFILE)
-                statsfile = open(statsfile_path, 'r')
-                is_today = False
-                is_thours = False
-                today = date.today()
-                yesterday = date.fromordinal(today.toordinal() - 1)
-                tomorrow = date.fromordinal(today.toordinal() + 1)
-                for line in statsfile:
-                    if line == '': continue
-                    if line == '\n': continue
-                    if line[0] not in '0123456789': continue
-                    datestamp = date(int(line[:4]), int(line[5:7]), int(line[8:10]))
-                    hour = int(line[11:13])
-                    mins = int(line[14:16])
-                    sec = int(line[17:19])
-                    thour = datetime.datetime.today().hour
-                    tmin = datetime.datetime.today().minute
-                    tsec = datetime.datetime.today().second
-                    if int(strftime('%H')) < cfg.ROLLOVER_HOUR:
-                        if datestamp == today or (datestamp == yesterday and hour >= cfg.ROLLOVER_HOUR):
-                            is_today = True
-                    elif datestamp == today and hour >= cfg.ROLLOVER_HOUR:
-                        is_today = True
-                    if datestamp == today or (datestamp == yesterday and (hour > thour or (hour == thour and (mins > tmin or (mins == tmin and sec > tsec))))):
-                        is_thours = True
-                    if '\t' in line:
-                        separator = '\t'
-                    else: separator = ','
-                    newline = line.split(separator)
-                    newmode = int(newline[3])
-                    newback = int(newline[4])
-                    newpercent = int(newline[2])
-                    newmanual = bool(int(newline[7]))
-                    newsession_number = int(newline[8])
-                    try:
-                        sesstime = int(round(float(newline[25])))
-                    except Exception as e:
-                        debug_msg(e)
-                        # this session wasn't performed with this version of BW, and is therefore
-                        # old, and therefore the session time doesn't matter
-                        sesstime = 0
-                    if newmanual:
-                        newsession_number = 0
-                    self.full_history.append([newsession_number, newmode, newback, newpercent, newmanual])
-                    if is_thours:
-                        stats.sessions_thours += 1
-                        stats.time_thours += sesstime
-                    if is_today:
-                        stats.sessions_today += 1
-                        self.time_today += sesstime
-                        self.history.append([newsession_number, newmode, newback, newpercent, newmanual])
-                    #if not newmanual and (is_today or cfg.RESET_LEVEL):
-                    #    last_session = self.full_history[-1]
-                statsfile.close()
+                self.load_history()
+                if CLINICAL_MODE:
+                    self.open_clinical_log()
+                summary = bwstats.StatsSummary(os.path.join(get_data_dir(), cfg.STATSFILE) + bwstats.SUMMARY_SUFFIX)
+                self.sessions_total = summary.archived + len(self.table)
+                self.update_windows()
                 self.retrieve_progress()
 
             except Exception as e:
                 debug_msg(e)
-                quit_with_error(_('Error parsing stats file\n%s') %
-                                os.path.join(get_data_dir(), cfg.STATSFILE),
+                quit_with_error(_('Error parsing stats file\n%s') % self.stats_path(),
                                 _('\nPlease fix, delete or rename the stats file.'),
                                 quit=False)
-
-    def retrieve_progress(self):
-        if cfg.RESET_LEVEL:
-            sessions = [s for s in self.history if s[1] == mode.mode]
         else:
-            sessions = [s for s in self.full_history if s[1] == mode.mode]
+            self.parsed = None
+            self.table = bwstats.History()
+            self.today_start = 0
+            self.sessions_total = 0
+
+    # recount today's sessions and those of the last 24 hours; this only
+    # takes a few binary searches, so it is also run on a timer to notice
+    # the day rolling over while the game is left open.
+    def update_windows(self):
+        now = datetime.datetime.today()
+        today = now.toordinal()
+        if now.hour < cfg.ROLLOVER_HOUR:
+            today -= 1
+        day_start = today * 86400 + cfg.ROLLOVER_HOUR * 3600
+        self.next_rollover = day_start + 86400
+        self.modes.update(self.table)
+        self.windows.update(self.table)
+        since = max(day_start, self.cleared)
+        self.today_start = self.windows.first_index(since)
+        self.sessions_today, self.time_today = self.windows.window(since)
+        self.sessions_thours, self.time_thours = self.windows.window(
+            max(bwstats.local_timestamp(now) - 86400 + 1, self.cleared))
+
+    # the per-mode index (self.modes) keeps each mode's last run of sessions
+    # at one level, so this doesn't depend on the length of the history
+    def retrieve_progress(self):
+        table = self.table
+        start = cfg.RESET_LEVEL and self.today_start or 0
+        ls = self.modes.last_session(mode.mode, start)
         mode.enforce_standard_mode()
-        if sessions:
-            ls = sessions[-1]
-            mode.back = ls[2]
-            if ls[3] >= get_threshold_advance():
+        if ls is not None:
+            mode.back = table.back[ls]
+            if table.percent[ls] >= get_threshold_advance():
                 mode.back += 1
-            mode.session_number = ls[0]
-            mode.progress = 0
-            for s in sessions:
-                if s[2] == mode.back and s[3] < get_threshold_fallback():
-                    mode.progress += 1
-                elif s[2] != mode.back:
-                    mode.progress = 0
+            if table.manual[ls]:
+                mode.session_number = 0
+            else:
+                mode.session_number = table.session[ls]
+            if mode.back == table.back[ls]:
+                mode.progress = self.modes.below(mode.mode, get_threshold_fallback(), start)
+            else:
+                mode.progress = 0
             if mode.progress >= cfg.THRESHOLD_FALLBACK_SESSIONS:
                 mode.progress = 0
                 mode.back -= 1
@@ -3858,81 +3686,66 @@ class Stats:
         mode.num_trials_total = mode.num_trials + mode.num_trials_factor * mode.back ** mode.num_trials_exponent
 
     def initialize_session(self):
-        self.session = {}
-        for name in ('position1', 'position2', 'position3', 'position4',
-             'vis1', 'vis2', 'vis3', 'vis4',
-            'color', 'image', 'audio', 'audio2'
-            ):
-            self.session[name] = []
-            self.session["%s_input" % name] = []
-            self.session["%s_rt"    % name] = [] # reaction times
-        for name in ('vis', 'numbers', 'operation', 'visvis_input',
-            'visaudio_input', 'audiovis_input', 'arithmetic_input', 'visvis_rt',
-            'visaudio_rt', 'audiovis_rt' # , 'arithmetic_rt'
-            ):
-            self.session[name] = []
+        self.session = bwengine.new_session_record()
 
     def save_input(self):
-        for k, v in mode.current_stim.items():
-            if k == 'number':
-                self.session['numbers'].append(v)
-            else:
-                self.session[k].append(v)
-            if k == 'vis': # goes to both self.session['vis'] and ['image']
-                self.session['image'].append(v)
-        for k, v in mode.inputs.items():
-            self.session[k + '_input'].append(v)
-        for k, v in mode.input_rts.items():
-            self.session[k + '_rt'].append(v)
-
-        self.session['operation'].append(mode.current_operation)
-        self.session['arithmetic_input'].append(arithmeticAnswerLabel.parse_answer())
-
+        bwengine.save_input(self.session, mode, arithmeticAnswerLabel.parse_answer())
 
     def submit_session(self, percent, category_percents):
         global musicplayer
         global applauseplayer
-        self.history.append([mode.session_number, mode.mode, mode.back, percent, mode.manual])
+        sep = STATS_SEPARATOR
+        outlist = [strftime("%Y-%m-%d %H:%M:%S"),
+                   mode.short_name(),
+                   str(percent),
+                   str(mode.mode),
+                   str(mode.back),
+                   str(mode.ticks_per_trial),
+                   str(mode.num_trials_total),
+                   str(int(mode.manual)),
+                   str(mode.session_number),
+                   str(category_percents['position1']),
+                   str(category_percents['audio']),
+                   str(category_percents['color']),
+                   str(category_percents['visvis']),
+                   str(category_percents['audiovis']),
+                   str(category_percents['arithmetic']),
+                   str(category_percents['image']),
+                   str(category_percents['visaudio']),
+                   str(category_percents['audio2']),
+                   str(category_percents['position2']),
+                   str(category_percents['position3']),
+                   str(category_percents['position4']),
+                   str(category_percents['vis1']),
+                   str(category_percents['vis2']),
+                   str(category_percents['vis3']),
+                   str(category_percents['vis4']),
+                   str(mode.ticks_per_trial * TICK_DURATION * mode.num_trials_total),
+                   str(0),
+                   ]
 
         if ATTEMPT_TO_SAVE_STATS:
+            # the files are written by stats_writer on its own thread; the
+            # session is part of self.table right away
+            writes = []
             try:
-                sep = STATS_SEPARATOR
-                statsfile_path = os.path.join(get_data_dir(), cfg.STATSFILE)
-                statsfile = open(statsfile_path, 'a')
-                outlist = [strftime("%Y-%m-%d %H:%M:%S"),
-                           mode.short_name(),
-                           str(percent),
-                           str(mode.mode),
-                           str(mode.back),
-                           str(mode.ticks_per_trial),
-                           str(mode.num_trials_total),
-                           str(int(mode.manual)),
-                           str(mode.session_number),
-                           str(category_percents['position1']),
-                           str(category_percents['audio']),
-                           str(category_percents['color']),
-                           str(category_percents['visvis']),
-                           str(category_percents['audiovis']),
-                           str(category_percents['arithmetic']),
-                           str(category_percents['image']),
-                           str(category_percents['visaudio']),
-                           str(category_percents['audio2']),
-                           str(category_percents['position2']),
-                           str(category_percents['position3']),
-                           str(category_percents['position4']),
-                           str(category_percents['vis1']),
-                           str(category_percents['vis2']),
-                           str(category_percents['vis3']),
-                           str(category_percents['vis4']),
-                           str(mode.ticks_per_trial * TICK_DURATION * mode.num_trials_total),
-                           str(0),
-                           ]
-                statsfile.write(sep.join(outlist)) # adds sep between each element
-                statsfile.write('\n')  # but we don't want a sep before '\n'
-                statsfile.close()
+                if stats_writer.error is not None:
+                    raise stats_writer.error
+                row = bwstats.parse_line(sep.join(outlist))
+                if cfg.STATS_BACKEND == 'sqlite':
+                    self.open_stats().append(row) # SQLite does its own journaling
+                    self.load_history()
+                else:
+                    statsfile_path = os.path.join(get_data_dir(), cfg.STATSFILE)
+                    # in the column order the file's header names
+                    line = bwstats.format_row(row, sep, bwstats.read_schema(statsfile_path))
+                    writes.append(('append', statsfile_path, (line + '\n').encode('utf-8')))
+                    self.open_stats().add(row)
+                    self.table = self.parsed.history
+                self.update_windows()
                 if CLINICAL_MODE:
-                    picklefile = open(os.path.join(get_data_dir(), STATS_BINARY), 'ab')
-                    pickle.dump([strftime("%Y-%m-%d %H:%M:%S"), mode.short_name(),
+                    writes.append(('append', os.path.join(get_data_dir(), STATS_BINARY),
+                        self.open_clinical_log().record([strftime("%Y-%m-%d %H:%M:%S"), mode.short_name(),
                                  percent, mode.mode, mode.back, mode.ticks_per_trial,
                                  mode.num_trials_total, int(mode.manual),
                                  mode.session_number, category_percents['position1'],
@@ -3943,30 +3756,36 @@ class Stats:
                                  category_percents['position2'], category_percents['position3'],
                                  category_percents['position4'],
                                  category_percents['vis1'], category_percents['vis2'],
-                                 category_percents['vis3'], category_percents['vis4']],
-                                picklefile, protocol=2)
-                    picklefile.close()
+                                 category_percents['vis3'], category_percents['vis4']])))
                 cfg.SAVE_SESSIONS = True # FIXME: put this where it belongs
                 cfg.SESSION_STATS = USER + '-sessions.dat' # FIXME: default user; configurability
                 if cfg.SAVE_SESSIONS:
-                    picklefile = open(os.path.join(get_data_dir(), cfg.SESSION_STATS), 'ab')
                     session = {} # it's not a dotdict because we want to pickle it
                     session['summary'] = outlist # that's what goes into stats.txt
-                    session['cfg'] = cfg.__dict__
+                    session['cfg'] = dict(cfg) # stored once per distinct config, see bwstats.ConfigStore
                     session['timestamp'] = strftime("%Y-%m-%d %H:%M:%S")
                     session['mode']   = mode.mode
                     session['n']      = mode.back
                     session['manual'] = mode.manual
                     session['trial_duration'] = mode.ticks_per_trial * TICK_DURATION
                     session['trials']  = mode.num_trials_total
+                    session['seed']    = mode.seed # see bwengine.regenerate()
                     session['session'] = self.session
-                    pickle.dump(session, picklefile)
-                    picklefile.close()
+                    writes.append(bwstats.session_write(
+                        os.path.join(get_data_dir(), cfg.SESSION_STATS), session))
+                stats_writer.submit(writes)
+                self.sessions_total += 1
             except Exception as e:
                 debug_msg(e)
-                quit_with_error(_('Error writing to stats file\n%s') %
-                                os.path.join(get_data_dir(), cfg.STATSFILE),
+                quit_with_error(_('Error writing to stats file\n%s') % self.stats_path(),
                                 _('\nPlease check file and directory permissions.'))
+        else:
+            self.unsaved.append(bwstats.parse_line(sep.join(outlist)))
+            if self.parsed is None:
+                self.table.append(self.unsaved[-1])
+            else:
+                self.load_history()
+            self.update_windows()
 
         perfect = awesome = great = good = advance = fallback = False
 
@@ -4008,7 +3827,8 @@ class Stats:
             play_music(percent)
 
     def clear(self):
-        self.history = []
+        self.cleared = bwstats.local_timestamp(datetime.datetime.today()) + 1
+        self.today_start = len(self.table)
         self.sessions_today = 0
         self.time_today = 0
         self.sessions_thours = 0
@@ -4048,13 +3868,11 @@ def update_input_labels():
 
 # this function handles initiation of a new session.
 def new_session():
-    mode.tick = -9  # give a 1-second delay before displaying first trial
-    mode.tick -= 5 * (mode.flags[mode.mode]['multi'] - 1 )
-    if cfg.MULTI_MODE == 'image':
-        mode.tick -= 5 * (mode.flags[mode.mode]['multi'] - 1 )
+    mode.tick = bwengine.first_tick(mode, cfg)  # give a 1-second delay before displaying first trial
 
     mode.session_number += 1
     mode.trial_number = 0
+    mode.answer_key = None  # nothing to match before the first trial
     mode.started = True
     mode.paused = False
     circles.update()
@@ -4081,16 +3899,13 @@ def new_session():
     mode.soundlist  = [sounds[mode.sound_mode][l]  for l in visuals[0].letters]
     mode.soundlist2 = [sounds[mode.sound2_mode][l] for l in visuals[0].letters2]
 
-    if cfg.JAEGGI_MODE:
-        compute_bt_sequence()
+    # choose the stimuli of the whole session; the seed goes into the
+    # sessions file, so that they can be chosen again
+    mode.seed = random.getrandbits(63)
+    bwengine.pregenerate(mode, cfg, mode.seed)
 
     if preventMusicSkipping: pyglet.clock.tick(poll=True) # Prevent music/applause skipping
 
-    if cfg.VARIABLE_NBACK:
-        # compute variable n-back sequence using beta distribution
-        mode.variable_list = []
-        for index in range(0, mode.num_trials_total - mode.back):
-            mode.variable_list.append(int(random.betavariate(mode.back / 2.0, 1) * mode.back + 1))
     field.crosshair_update()
     reset_input()
     stats.initialize_session()
@@ -4105,8 +3920,6 @@ def end_session(cancelled=False):
         input_labels.remove(input_labels[0])
     if cancelled:
         mode.session_number -= 1
-    if not cancelled:
-        stats.sessions_today += 1
     for visual in visuals: visual.hide()
     mode.started = False
     mode.paused = False
@@ -4118,10 +3931,7 @@ def end_session(cancelled=False):
     else:
         update_all_labels(do_analysis = True)
         if cfg.PANHANDLE_FREQUENCY:
-            statsfile_path = os.path.join(get_data_dir(), cfg.STATSFILE)
-            statsfile = open(statsfile_path, 'r')
-            sessions = len(statsfile.readlines()) # let's just hope people
-            statsfile.close()       # don't manually edit their statsfiles
+            sessions = stats.sessions_total
             if (sessions % cfg.PANHANDLE_FREQUENCY) == 0 and not CLINICAL_MODE:
                 Panhandle(n=sessions)
 
@@ -4137,7 +3947,7 @@ def reset_input():
     update_input_labels()
 
 # this handles the computation of a round with exactly 6 position and 6 audio matches
-# this function is not currently used -- compute_bt_sequence() is used instead
+# this function is not currently used -- bwengine.compute_bt_sequence() is used instead
 ##def new_compute_bt_sequence(matches=6, modalities=['audio', 'vis']):
 ##    # not ready for visaudio or audiovis, doesn't get
 ##    seq = {}
@@ -4157,198 +3967,13 @@ def reset_input():
 ##                    seq[m][i] += 1
 ##    mode.bt_sequence = seq.values()
 
-def compute_bt_sequence():
-    bt_sequence = [[], []]
-    for x in range(0, mode.num_trials_total):
-        bt_sequence[0].append(0)
-        bt_sequence[1].append(0)
-
-    for x in range(0, mode.back):
-        bt_sequence[0][x] = random.randint(1, 8)
-        bt_sequence[1][x] = random.randint(1, 8)
-
-    position = 0
-    audio = 0
-    both = 0
-
-    # brute force it
-    while True:
-        position = 0
-        for x in range(mode.back, mode.num_trials_total):
-            bt_sequence[0][x] = random.randint(1, 8)
-            if bt_sequence[0][x] == bt_sequence[0][x - mode.back]:
-                position += 1
-        if position != 6:
-            continue
-        while True:
-            audio = 0
-            for x in range(mode.back, mode.num_trials_total):
-                bt_sequence[1][x] = random.randint(1, 8)
-                if bt_sequence[1][x] == bt_sequence[1][x - mode.back]:
-                    audio += 1
-            if audio == 6:
-                break
-        both = 0
-        for x in range(mode.back, mode.num_trials_total):
-            if bt_sequence[0][x] == bt_sequence[0][x - mode.back] and bt_sequence[1][x] == bt_sequence[1][x - mode.back]:
-                both += 1
-        if both == 2:
-            break
-
-    mode.bt_sequence = bt_sequence
-
 player = get_pyglet_media_Player()
 player2 = get_pyglet_media_Player()
-# responsible for the random generation of each new stimulus (audio, color, position)
+# plays and shows the stimuli of a new trial, chosen by bwengine.pregenerate()
 def generate_stimulus():
-    # first, randomly generate all stimuli
-    positions = random.sample(range(1,9), 4)   # sample without replacement
-    for s, p in zip(range(1, 5), positions):
-        mode.current_stim['position' + repr(s)] = p
-        mode.current_stim['vis' + repr(s)] = random.randint(1, 8)
-
-    #mode.current_stim['position1'] = random.randint(1, 8)
-    mode.current_stim['color']  = random.randint(1, 8)
-    mode.current_stim['vis']    = random.randint(1, 8)
-    mode.current_stim['audio']  = random.randint(1, 8)
-    mode.current_stim['audio2'] = random.randint(1, 8)
-
-
-    # treat arithmetic specially
-    operations = []
-    if cfg.ARITHMETIC_USE_ADDITION: operations.append('add')
-    if cfg.ARITHMETIC_USE_SUBTRACTION: operations.append('subtract')
-    if cfg.ARITHMETIC_USE_MULTIPLICATION: operations.append('multiply')
-    if cfg.ARITHMETIC_USE_DIVISION: operations.append('divide')
-    mode.current_operation = random.choice(operations)
-
-    if cfg.ARITHMETIC_USE_NEGATIVES:
-        min_number = 0 - cfg.ARITHMETIC_MAX_NUMBER
-    else:
-        min_number = 0
-    max_number = cfg.ARITHMETIC_MAX_NUMBER
-
-    if mode.current_operation == 'divide' and 'arithmetic' in mode.modalities[mode.mode]:
-        if len(stats.session['position1']) >= mode.back:
-            number_nback = stats.session['numbers'][mode.trial_number - mode.back - 1]
-            possibilities = []
-            for x in range(min_number, max_number + 1):
-                if x == 0:
-                    continue
-                if number_nback % x == 0:
-                    possibilities.append(x)
-                    continue
-                frac = Decimal(abs(number_nback)) / Decimal(abs(x))
-                if (frac % 1) in map(Decimal, cfg.ARITHMETIC_ACCEPTABLE_DECIMALS):
-                    possibilities.append(x)
-            mode.current_stim['number'] = random.choice(possibilities)
-        else:
-            mode.current_stim['number'] = random.randint(min_number, max_number)
-            while mode.current_stim['number'] == 0:
-                mode.current_stim['number'] = random.randint(min_number, max_number)
-    else:
-        mode.current_stim['number'] = random.randint(min_number, max_number)
-
+    bwengine.next_stimulus(mode)
     multi = mode.flags[mode.mode]['multi']
 
-    real_back = mode.back
-    if mode.flags[mode.mode]['crab'] == 1:
-        real_back = 1 + 2*((mode.trial_number-1) % mode.back)
-    else:
-        real_back = mode.back
-    if cfg.VARIABLE_NBACK:
-        real_back = mode.variable_list[mode.trial_number - real_back - 1]
-
-    if mode.modalities[mode.mode] != ['arithmetic'] and mode.trial_number > mode.back:
-        for mod in mode.modalities[mode.mode]:
-            if   mod in ('visvis', 'visaudio', 'image'):
-                current = 'vis'
-            elif mod in ('audiovis', ):
-                current = 'audio'
-            elif mod == 'arithmetic':
-                continue
-            else:
-                current = mod
-            if   mod in ('visvis', 'audiovis', 'image'):
-                back_data = 'vis'
-            elif mod in ('visaudio', ):
-                back_data = 'audio'
-            else:
-                back_data = mod
-
-            back = None
-            r1, r2 = random.random(), random.random()
-            if multi > 1:
-                r2 = 3./2. * r2 # 33% chance of multi-stim reversal
-
-            if  (r1 < cfg.CHANCE_OF_GUARANTEED_MATCH):
-                back = real_back
-
-            elif r2 < cfg.CHANCE_OF_INTERFERENCE and mode.back > 1:
-                back = real_back
-                interference = [-1, 1, mode.back]
-                if back < 3: interference = interference[1:] # for crab mode and 2-back
-                random.shuffle(interference)
-                for i in interference: # we'll just take the last one that works.
-                    if mode.trial_number - (real_back+i) - 1 >= 0 and \
-                         stats.session[back_data][mode.trial_number - (real_back+i) - 1] != \
-                         stats.session[back_data][mode.trial_number -  real_back    - 1]:
-                        back = real_back + i
-                if back == real_back: back = None # if none of the above worked
-                elif DEBUG:
-                    print('Forcing interference for %s' % current)
-
-            if back:
-                nback_trial = mode.trial_number - back - 1
-                matching_stim = stats.session[back_data][nback_trial]
-                # check for collisions in multi-stim mode
-                if multi > 1 and mod.startswith('position'):
-                    potential_conflicts = set(range(1, multi+1)) - set([int(mod[-1])])
-                    conflict_positions = [positions[i-1] for i in potential_conflicts]
-                    if matching_stim in conflict_positions: # swap 'em
-                        i = positions.index(matching_stim)
-                        if DEBUG:
-                            print("moving position%i from %i to %i for %s" % (i+1, positions[i], mode.current_stim[current], current))
-                        mode.current_stim['position' + repr(i+1)] = mode.current_stim[current]
-                        positions[i] = mode.current_stim[current]
-                    positions[int(current[-1])-1] = matching_stim
-                if DEBUG:
-                    print("setting %s to %i" % (current, matching_stim))
-                mode.current_stim[current] = matching_stim
-
-        if multi > 1:
-            if random.random() < cfg.CHANCE_OF_INTERFERENCE / 3.:
-                mod = 'position'
-                if 'vis1' in mode.modalities[mode.mode] and random.random() < .5:
-                    mod = 'vis'
-                offset = random.choice(range(1, multi))
-                for i in range(multi):
-                    mode.current_stim[mod + repr(i+1)] = stats.session[mod + repr(((i+offset)%multi) + 1)][mode.trial_number - real_back - 1]
-                    if mod == 'position':
-                        positions[i] = mode.current_stim[mod + repr(i+1)]
-
-
-    # set static stimuli according to mode.
-    # default position is 0 (center)
-    # default color is 1 (red) or 2 (black)
-    # default vis is 0 (square)
-    # audio is never static so it doesn't have a default.
-    if not 'color'     in mode.modalities[mode.mode]: mode.current_stim['color'] = cfg.VISUAL_COLORS[0]
-    if not 'position1' in mode.modalities[mode.mode]: mode.current_stim['position1'] = 0
-    if not set(['visvis', 'arithmetic', 'image']).intersection( mode.modalities[mode.mode] ):
-        mode.current_stim['vis'] = 0
-    if multi > 1 and not 'vis1' in mode.modalities[mode.mode]:
-        for i in range(1, 5):
-            if cfg.MULTI_MODE == 'color':
-                mode.current_stim['vis'+repr(i)] = 0 # use squares
-            elif cfg.MULTI_MODE == 'image':
-                mode.current_stim['vis'+repr(i)] = cfg.VISUAL_COLORS[0]
-
-    # in jaeggi mode, set using the predetermined sequence.
-    if cfg.JAEGGI_MODE:
-        mode.current_stim['position1'] = mode.bt_sequence[0][mode.trial_number - 1]
-        mode.current_stim['audio'] = mode.bt_sequence[1][mode.trial_number - 1]
-
     # initiate the chosen stimuli.
     # mode.current_stim['audio'] is a number from 1 to 8.
     if 'arithmetic' in mode.modalities[mode.mode] and mode.trial_number > mode.back:
@@ -4439,8 +4064,8 @@ def set_user(newuser):
     cfg = parse_config(CONFIGFILE)
     stats.initialize_session()
     stats.parse_statsfile()
-    if len(stats.full_history) > 0 and not cfg.JAEGGI_MODE:
-        mode.mode = stats.full_history[-1][1]
+    if len(stats.table) > 0 and not cfg.JAEGGI_MODE:
+        mode.mode = stats.table.mode[-1]
     stats.retrieve_progress()
     # text labels also need to be remade; until that's done, this remains commented out
     #if cfg.BLACK_BACKGROUND:
@@ -4741,44 +4366,48 @@ def on_draw():
     for label in input_labels:
         label.draw()
 
+# what happens during a session, as the window and the sound show it; see
+# bwengine.step()
+class SessionEvents:
+    def save_input(self):
+        stats.save_input()
+    def start_trial(self):
+        mode.trial_starttime = time.time()
+        trialsRemainingLabel.update()
+    def generate_stimulus(self):
+        generate_stimulus()
+    def end_session(self):
+        end_session()
+    def reset_input(self):
+        reset_input()
+    def hide_stimulus(self):
+        for visual in visuals: visual.hide()
+    def show_feedback(self):
+        update_input_labels()
+session_events = SessionEvents()
+
 # the event timer loop. Runs every 1/10 second. This loop controls the session
 # game logic.
-# During each trial the tick goes from 1 to ticks_per_trial-1 then back to 0.
-# tick = 1: Input from the last trial is saved. Input is reset.
-#             A new square appears and the sound cue plays.
-# tick = 6: the square disappears.
-# tick = ticks_per_trial - 1: tick is reset to 0.
-# tick = 1: etc.
 def update(dt):
     if mode.started and not mode.paused: # only run the timer during a game
-        if (not mode.flags[mode.mode]['selfpaced'] or
-                mode.tick > mode.ticks_per_trial-6 or
-                mode.tick < 5):
-            mode.tick += 1
-        if mode.tick == 1:
-            mode.show_missed = False
-            if mode.trial_number > 0:
-                stats.save_input()
-            mode.trial_number += 1
-            mode.trial_starttime = time.time()
-            trialsRemainingLabel.update()
-            if mode.trial_number > mode.num_trials_total:
-                end_session()
-            else: generate_stimulus()
-            reset_input()
-        # Hide square at either the 0.5 second mark or sooner
-        positions = len([mod for mod in mode.modalities[mode.mode] if mod.startswith('position')])
-        positions = max(0, positions-1)
-        if mode.tick == (6+positions) or mode.tick == mode.ticks_per_trial - 1:
-            for visual in visuals: visual.hide()
-        if mode.tick == mode.ticks_per_trial - 2:  # display feedback for 200 ms
-            mode.tick = 0
-            mode.show_missed = True
-            update_input_labels()
-        if mode.tick == mode.ticks_per_trial:
-            mode.tick = 0
+        bwengine.step(mode, session_events)
 pyglet.clock.schedule_interval(update, TICK_DURATION)
 
+# keeps the "today" and "last 24 hours" stats current while the game is
+# left open; at the rollover hour the chart starts over as well.
+def refresh_stats_windows(dt):
+    if mode.started: return
+    rollover = bwstats.local_timestamp(datetime.datetime.today()) >= stats.next_rollover
+    stats.update_windows()
+    if rollover:
+        if cfg.RESET_LEVEL:
+            stats.retrieve_progress()
+            circles.update()
+        chartLabel.update()
+        averageLabel.update()
+    todayLabel.update()
+pyglet.clock.schedule_interval(refresh_stats_windows, 60)
+
 angle = 0
 def pulsate(dt):
     global angle
@@ -4820,6 +4449,16 @@ mode = Mode()
 field = Field()
 visuals = [Visual() for i in range(4)]
 stats = Stats()
+
+# finish the writes an earlier run was interrupted in, before reading anything
+stats_writer = bwstats.StatsWriter(os.path.join(get_data_dir(), 'stats-journal.dat'))
+try:
+    stats_writer.replay()
+except Exception as e:
+    debug_msg(e)
+    quit_with_error(_('Error writing to stats file\n%s') % stats_writer.journal_path,
+                    _('\nPlease check file and directory permissions.'), quit=False)
+atexit.register(stats_writer.close)
 graph = Graph()
 circles = Circles()
 saccadic = Saccadic()
@@ -4851,8 +4490,8 @@ input_labels = []
 # load last game mode
 stats.initialize_session()
 stats.parse_statsfile()
-if len(stats.full_history) > 0 and not cfg.JAEGGI_MODE:
-    mode.mode = stats.full_history[-1][1]
+if len(stats.table) > 0 and not cfg.JAEGGI_MODE:
+    mode.mode = stats.table.mode[-1]
 stats.retrieve_progress()
 
 update_all_labels()
@@ -0,0 +1,976 @@
+# bwengine.py: the rules of a Brain Workshop session, without pyglet.
+#
+# Copyright (C) 2009-2011: Paul Hoskinson (plhosk@gmail.com)
+# Copyright (C) 2017-2018: Samantha McVey (samantham@posteo.net)
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Nothing in this module may import pyglet.  The game runs its sessions on
+# the functions here, passing its Mode object as the state and drawing and
+# playing sounds from the callbacks of step().  SessionEngine runs the same
+# sessions on a virtual clock, with no window or audio device, for the tools
+# in tools/ and for simulating players.
+
+import random, operator, copy, time
+from decimal import Decimal
+
+TICK_DURATION = 0.1
+
+# The default values of the configuration settings used here; the game
+# passes its own cfg, read from config.ini.
+DEFAULTS = {'BACK_DEFAULT': 2,
+            'TICKS_DEFAULT': 30,
+            'TICKS_4': 35, 'TICKS_5': 35, 'TICKS_6': 35,
+            'TICKS_7': 40, 'TICKS_8': 40, 'TICKS_9': 40,
+            'BONUS_TICKS_CRAB': 0,
+            'BONUS_TICKS_MULTI_2': 5,
+            'BONUS_TICKS_MULTI_3': 10,
+            'BONUS_TICKS_MULTI_4': 15,
+            'NUM_TRIALS': 20,
+            'NUM_TRIALS_FACTOR': 1,
+            'NUM_TRIALS_EXPONENT': 2,
+            'VARIABLE_NBACK': 0,
+            'JAEGGI_MODE': False,
+            'JAEGGI_SCORING': False,
+            'CHANCE_OF_GUARANTEED_MATCH': 0.125,
+            'CHANCE_OF_INTERFERENCE': 0.125,
+            'MULTI_MODE': 'color',
+            'VISUAL_COLORS': [1, 3, 8, 6],
+            'ARITHMETIC_MAX_NUMBER': 12,
+            'ARITHMETIC_USE_NEGATIVES': False,
+            'ARITHMETIC_USE_ADDITION': True,
+            'ARITHMETIC_USE_SUBTRACTION': True,
+            'ARITHMETIC_USE_MULTIPLICATION': True,
+            'ARITHMETIC_USE_DIVISION': True,
+            'ARITHMETIC_ACCEPTABLE_DECIMALS': ['0.1', '0.2', '0.3', '0.4', '0.5', '0.6',
+                '0.7', '0.8', '0.9', '0.125', '0.25', '0.375', '0.625', '0.75', '0.875',
+                '0.15', '0.35', '0.45', '0.55', '0.65', '0.85', '0.95']}
+
+class Config(dict):
+    '''Settings that can be read as cfg.NAME or cfg['NAME'], like the
+    game's cfg; missing settings are None.'''
+    def __getattr__(self, attr):
+        return self.get(attr, None)
+    __setattr__ = dict.__setitem__
+    __delattr__ = dict.__delitem__
+
+def config(**settings):
+    '''The default configuration, with the given settings changed.'''
+    cfg = Config(DEFAULTS)
+    cfg.update(settings)
+    return cfg
+
+# the base modes, as number: (short name, modalities)
+BASE_MODES = {2:   ('D',    ['position1', 'audio']),
+              3:   ('PCA',  ['position1', 'color', 'audio']),
+              4:   ('DC',   ['visvis', 'visaudio', 'audiovis', 'audio']),
+              5:   ('TC',   ['position1', 'visvis', 'visaudio', 'audiovis', 'audio']),
+              6:   ('QC',   ['position1', 'visvis', 'visaudio', 'color', 'audiovis', 'audio']),
+              7:   ('A',    ['arithmetic']),
+              8:   ('DA',   ['position1', 'arithmetic']),
+              9:   ('TA',   ['position1', 'arithmetic', 'color']),
+              10:  ('Po',   ['position1']),
+              11:  ('Au',   ['audio']),
+              12:  ('TCC',  ['visvis', 'visaudio', 'color', 'audiovis', 'audio']),
+              20:  ('PC',   ['position1', 'color']),
+              21:  ('PI',   ['position1', 'image']),
+              22:  ('CA',   ['color', 'audio']),
+              23:  ('IA',   ['image', 'audio']),
+              24:  ('CI',   ['color', 'image']),
+              25:  ('PCI',  ['position1', 'color', 'image']),
+              26:  ('PIA',  ['position1', 'image', 'audio']),
+              27:  ('CIA',  ['color', 'image', 'audio']),
+              28:  ('Q',    ['position1', 'color', 'image', 'audio']),
+              100: ('AA',   ['audio', 'audio2']),
+              101: ('PAA',  ['position1', 'audio', 'audio2']),
+              102: ('CAA',  ['color', 'audio', 'audio2']),
+              103: ('IAA',  ['image', 'audio', 'audio2']),
+              104: ('PCAA', ['position1', 'color', 'audio', 'audio2']),
+              105: ('PIAA', ['position1', 'image', 'audio', 'audio2']),
+              106: ('CIAA', ['color', 'image', 'audio', 'audio2']),
+              107: ('P',    ['position1', 'color', 'image', 'audio', 'audio2'])}
+
+# every modality that can be scored; arithmetic must be last so it's easy to exclude
+SCORED_MODALITIES = ['position1', 'position2', 'position3', 'position4',
+                     'vis1', 'vis2', 'vis3', 'vis4', 'color', 'visvis',
+                     'visaudio', 'audiovis', 'image', 'audio',
+                     'audio2', 'arithmetic']
+
+# the modalities matched against a stimulus of the same name
+PLAIN_MODALITIES = ['position1', 'position2', 'position3', 'position4',
+                    'vis1', 'vis2', 'vis3', 'vis4', 'audio', 'audio2', 'color', 'image']
+
+# modality: (stimulus of the current trial, stimulus of the trial n back)
+MATCHED_STIMULI = dict([(mod, (mod, mod)) for mod in PLAIN_MODALITIES])
+MATCHED_STIMULI.update({'image':    ('vis',   'vis'),
+                        'visvis':   ('vis',   'vis'),
+                        'visaudio': ('vis',   'audio'),
+                        'audiovis': ('audio', 'vis')})
+
+OPERATIONS = {'add': operator.add, 'subtract': operator.sub,
+              'multiply': operator.mul, 'divide': operator.truediv}
+
+DEBUG = False  # set by the game
+
+def build_modes():
+    '''Return (short names, modalities, flags) of every mode, by mode
+    number: the base modes, then the crab (| 128), multi-stimulus
+    (| 256, 512, 768) and self-paced (| 1024) variants.'''
+    short_names = {}
+    modalities = {}
+    flags = {}
+    for m, (name, mods) in BASE_MODES.items():
+        short_names[m] = name
+        modalities[m] = mods[:]
+
+    # generate crab modes
+    for m in list(short_names):
+        nm = m | 128                          # newmode; Crab DNB = 2 | 128 = 130
+        flags[m]  = {'crab':0, 'multi':1, 'selfpaced':0}# forwards
+        flags[nm] = {'crab':1, 'multi':1, 'selfpaced':0}# every (self.back) stimuli are reversed for matching
+        short_names[nm] = 'C' + short_names[m]
+        modalities[nm] = modalities[m][:] # the [:] at the end is
+        # so we take a copy of the list, in case we want to change it later
+
+    # generate multi-stim modes
+    for m in list(short_names):
+        for n in 2, 3, 4:
+            if set(['color', 'image']).issubset(modalities[m]) \
+              or not 'position1' in modalities[m] \
+              or set(['visvis', 'arithmetic']).intersection(modalities[m]):  # Combination? AAAH! Scary!
+                continue
+            nm = m | 256 * (n-1)               # newmode; 3xDNB = 2 | 512 = 514
+            flags[nm] = dict(flags[m]) # take a copy
+            flags[nm]['multi'] = n
+            short_names[nm] = repr(n) + 'x' + short_names[m]
+            modalities[nm] = modalities[m][:] # take a copy ([:])
+            for i in range(2, n+1):
+                modalities[nm].insert(i-1, 'position'+repr(i))
+            if 'color' in modalities[m] or 'image' in modalities[m]:
+                for i in range(1, n+1):
+                    modalities[nm].insert(n+i-1, 'vis'+repr(i))
+            for ic in 'image', 'color':
+                if ic in modalities[nm]:
+                    modalities[nm].remove(ic)
+
+    for m in list(short_names):
+        nm = m | 1024
+        short_names[nm] = 'SP-' + short_names[m]
+        modalities[nm] = modalities[m][:]
+        flags[nm] = dict(flags[m])
+        flags[nm]['selfpaced'] = 1
+    return short_names, modalities, flags
+
+SHORT_MODE_NAMES, MODALITIES, FLAGS = build_modes()
+
+def default_back(cfg, mode):
+    if ('BACK_%i' % mode) in cfg:
+        return cfg['BACK_%i' % mode]
+    elif mode > 127:  # try to use the base mode for crab, multi
+        return default_back(cfg, mode % 128)
+    else:
+        return cfg.BACK_DEFAULT
+
+def default_ticks(cfg, mode):
+    if ('TICKS_%i' % mode) in cfg:
+        return cfg['TICKS_%i' % mode]
+    elif mode > 127:
+        bonus = ((mode & 128) // 128) * cfg.BONUS_TICKS_CRAB
+        if mode & 768:
+            bonus += cfg['BONUS_TICKS_MULTI_%i' % ((mode & 768) // 256 + 1)]
+        if DEBUG: print("Adding a bonus of %i ticks for mode %i" % (bonus, mode))
+        return bonus + default_ticks(cfg, mode % 128)
+    else:
+        return cfg.TICKS_DEFAULT
+
+def trials_total(cfg, back):
+    return cfg.NUM_TRIALS + cfg.NUM_TRIALS_FACTOR * back ** cfg.NUM_TRIALS_EXPONENT
+
+def new_inputs():
+    '''The inputs of a trial before any key is pressed: ({modality: False},
+    {modality: reaction time 0.}).'''
+    inputs = dict([(k, False) for k in SCORED_MODALITIES[:-1]])
+    return inputs, dict([(k, 0.) for k in inputs])
+
+def new_stimulus():
+    return {'position1': 0,
+            'position2': 0,
+            'position3': 0,
+            'position4': 0,
+            'color':     0,
+            'vis':       0, # image or letter for non-multi mode
+            'vis1':      0, # image or color for multi mode
+            'vis2':      0,
+            'vis3':      0,
+            'vis4':      0,
+            'audio':     0,
+            'audio2':    0,
+            'number':    0}
+
+def new_session_record():
+    '''The per-trial lists of a session, empty; see save_input().'''
+    session = {}
+    for name in ('position1', 'position2', 'position3', 'position4',
+         'vis1', 'vis2', 'vis3', 'vis4',
+        'color', 'image', 'audio', 'audio2'
+        ):
+        session[name] = []
+        session["%s_input" % name] = []
+        session["%s_rt"    % name] = [] # reaction times
+    for name in ('vis', 'numbers', 'operation', 'visvis_input',
+        'visaudio_input', 'audiovis_input', 'arithmetic_input', 'visvis_rt',
+        'visaudio_rt', 'audiovis_rt' # , 'arithmetic_rt'
+        ):
+        session[name] = []
+    # the answer keys, for the modalities of the mode only
+    for name in SCORED_MODALITIES[:-1]:
+        session["%s_match" % name] = []
+    session['arithmetic_answer'] = []
+    return session
+
+def save_stimulus(session, state):
+    for k, v in state.current_stim.items():
+        if k == 'number':
+            session['numbers'].append(v)
+        else:
+            session[k].append(v)
+        if k == 'vis': # goes to both session['vis'] and ['image']
+            session['image'].append(v)
+    session['operation'].append(state.current_operation)
+
+def save_input(session, state, answer):
+    '''Add the stimuli, inputs and answer key of the trial that just ended
+    to the session; answer is the arithmetic answer given (a Decimal).'''
+    save_stimulus(session, state)
+    for k, v in state.inputs.items():
+        session[k + '_input'].append(v)
+    for k, v in state.input_rts.items():
+        session[k + '_rt'].append(v)
+    session['arithmetic_input'].append(answer)
+
+    key = state.answer_key or {}
+    for mod in state.modalities[state.mode]:
+        if mod == 'arithmetic':
+            session['arithmetic_answer'].append(key.get(mod))
+        else:
+            session[mod + '_match'].append(bool(key.get(mod)))
+
+def arithmetic_answer(operation, nback_number, number):
+    '''The answer to nback_number <operation> number, as a Decimal.'''
+    return OPERATIONS[operation](Decimal(nback_number), Decimal(number))
+
+def variable_nback_list(back, num_trials_total, rng=random):
+    '''The n-back of every trial after the first back ones, for
+    VARIABLE_NBACK, from a beta distribution.'''
+    return [int(rng.betavariate(back / 2.0, 1) * back + 1)
+            for index in range(0, num_trials_total - back)]
+
+def compute_bt_sequence(back, num_trials_total, rng=random):
+    '''The position and audio sequences of a Jaeggi mode session: exactly 6
+    position and 6 audio matches, 2 of them at once.'''
+    bt_sequence = [[], []]
+    for x in range(0, num_trials_total):
+        bt_sequence[0].append(0)
+        bt_sequence[1].append(0)
+
+    for x in range(0, back):
+        bt_sequence[0][x] = rng.randint(1, 8)
+        bt_sequence[1][x] = rng.randint(1, 8)
+
+    position = 0
+    audio = 0
+    both = 0
+
+    # brute force it
+    while True:
+        position = 0
+        for x in range(back, num_trials_total):
+            bt_sequence[0][x] = rng.randint(1, 8)
+            if bt_sequence[0][x] == bt_sequence[0][x - back]:
+                position += 1
+        if position != 6:
+            continue
+        while True:
+            audio = 0
+            for x in range(back, num_trials_total):
+                bt_sequence[1][x] = rng.randint(1, 8)
+                if bt_sequence[1][x] == bt_sequence[1][x - back]:
+                    audio += 1
+            if audio == 6:
+                break
+        both = 0
+        for x in range(back, num_trials_total):
+            if bt_sequence[0][x] == bt_sequence[0][x - back] and bt_sequence[1][x] == bt_sequence[1][x - back]:
+                both += 1
+        if both == 2:
+            break
+
+    return bt_sequence
+
+def trial_back(state, cfg):
+    '''How many trials back the current trial is matched against.'''
+    if state.flags[state.mode]['crab'] == 1:
+        back = 1 + 2*((state.trial_number-1) % state.back)
+    else:
+        back = state.back
+    if cfg.VARIABLE_NBACK:
+        back = state.variable_list[state.trial_number - back - 1]
+    return back
+
+# responsible for the random generation of each new stimulus (audio, color, position)
+def generate_stimulus(state, session, cfg, rng=random):
+    '''Choose the stimuli of the current trial, in state.current_stim and
+    state.current_operation, and work out state.answer_key.'''
+    # first, randomly generate all stimuli
+    positions = rng.sample(range(1,9), 4)   # sample without replacement
+    for s, p in zip(range(1, 5), positions):
+        state.current_stim['position' + repr(s)] = p
+        state.current_stim['vis' + repr(s)] = rng.randint(1, 8)
+
+    state.current_stim['color']  = rng.randint(1, 8)
+    state.current_stim['vis']    = rng.randint(1, 8)
+    state.current_stim['audio']  = rng.randint(1, 8)
+    state.current_stim['audio2'] = rng.randint(1, 8)
+
+    # treat arithmetic specially
+    operations = []
+    if cfg.ARITHMETIC_USE_ADDITION: operations.append('add')
+    if cfg.ARITHMETIC_USE_SUBTRACTION: operations.append('subtract')
+    if cfg.ARITHMETIC_USE_MULTIPLICATION: operations.append('multiply')
+    if cfg.ARITHMETIC_USE_DIVISION: operations.append('divide')
+    state.current_operation = rng.choice(operations)
+
+    if cfg.ARITHMETIC_USE_NEGATIVES:
+        min_number = 0 - cfg.ARITHMETIC_MAX_NUMBER
+    else:
+        min_number = 0
+    max_number = cfg.ARITHMETIC_MAX_NUMBER
+
+    modalities = state.modalities[state.mode]
+    if state.current_operation == 'divide' and 'arithmetic' in modalities:
+        if len(session['position1']) >= state.back:
+            number_nback = session['numbers'][state.trial_number - state.back - 1]
+            possibilities = []
+            for x in range(min_number, max_number + 1):
+                if x == 0:
+                    continue
+                if number_nback % x == 0:
+                    possibilities.append(x)
+                    continue
+                frac = Decimal(abs(number_nback)) / Decimal(abs(x))
+                if (frac % 1) in map(Decimal, cfg.ARITHMETIC_ACCEPTABLE_DECIMALS):
+                    possibilities.append(x)
+            state.current_stim['number'] = rng.choice(possibilities)
+        else:
+            state.current_stim['number'] = rng.randint(min_number, max_number)
+            while state.current_stim['number'] == 0:
+                state.current_stim['number'] = rng.randint(min_number, max_number)
+    else:
+        state.current_stim['number'] = rng.randint(min_number, max_number)
+
+    multi = state.flags[state.mode]['multi']
+
+    real_back = trial_back(state, cfg)
+
+    if modalities != ['arithmetic'] and state.trial_number > state.back:
+        for mod in modalities:
+            if   mod in ('visvis', 'visaudio', 'image'):
+                current = 'vis'
+            elif mod in ('audiovis', ):
+                current = 'audio'
+            elif mod == 'arithmetic':
+                continue
+            else:
+                current = mod
+            if   mod in ('visvis', 'audiovis', 'image'):
+                back_data = 'vis'
+            elif mod in ('visaudio', ):
+                back_data = 'audio'
+            else:
+                back_data = mod
+
+            back = None
+            r1, r2 = rng.random(), rng.random()
+            if multi > 1:
+                r2 = 3./2. * r2 # 33% chance of multi-stim reversal
+
+            if  (r1 < cfg.CHANCE_OF_GUARANTEED_MATCH):
+                back = real_back
+
+            elif r2 < cfg.CHANCE_OF_INTERFERENCE and state.back > 1:
+                back = real_back
+                interference = [-1, 1, state.back]
+                if back < 3: interference = interference[1:] # for crab mode and 2-back
+                rng.shuffle(interference)
+                for i in interference: # we'll just take the last one that works.
+                    if state.trial_number - (real_back+i) - 1 >= 0 and \
+                         session[back_data][state.trial_number - (real_back+i) - 1] != \
+                         session[back_data][state.trial_number -  real_back    - 1]:
+                        back = real_back + i
+                if back == real_back: back = None # if none of the above worked
+                elif DEBUG:
+                    print('Forcing interference for %s' % current)
+
+            if back:
+                nback_trial = state.trial_number - back - 1
+                matching_stim = session[back_data][nback_trial]
+                # check for collisions in multi-stim mode
+                if multi > 1 and mod.startswith('position'):
+                    potential_conflicts = set(range(1, multi+1)) - set([int(mod[-1])])
+                    conflict_positions = [positions[i-1] for i in potential_conflicts]
+                    if matching_stim in conflict_positions: # swap 'em
+                        i = positions.index(matching_stim)
+                        if DEBUG:
+                            print("moving position%i from %i to %i for %s" % (i+1, positions[i], state.current_stim[current], current))
+                        state.current_stim['position' + repr(i+1)] = state.current_stim[current]
+                        positions[i] = state.current_stim[current]
+                    positions[int(current[-1])-1] = matching_stim
+                if DEBUG:
+                    print("setting %s to %i" % (current, matching_stim))
+                state.current_stim[current] = matching_stim
+
+        if multi > 1:
+            if rng.random() < cfg.CHANCE_OF_INTERFERENCE / 3.:
+                mod = 'position'
+                if 'vis1' in modalities and rng.random() < .5:
+                    mod = 'vis'
+                offset = rng.choice(range(1, multi))
+                for i in range(multi):
+                    state.current_stim[mod + repr(i+1)] = session[mod + repr(((i+offset)%multi) + 1)][state.trial_number - real_back - 1]
+                    if mod == 'position':
+                        positions[i] = state.current_stim[mod + repr(i+1)]
+
+    # set static stimuli according to mode.
+    # default position is 0 (center)
+    # default color is 1 (red) or 2 (black)
+    # default vis is 0 (square)
+    # audio is never static so it doesn't have a default.
+    if not 'color'     in modalities: state.current_stim['color'] = cfg.VISUAL_COLORS[0]
+    if not 'position1' in modalities: state.current_stim['position1'] = 0
+    if not set(['visvis', 'arithmetic', 'image']).intersection(modalities):
+        state.current_stim['vis'] = 0
+    if multi > 1 and not 'vis1' in modalities:
+        for i in range(1, 5):
+            if cfg.MULTI_MODE == 'color':
+                state.current_stim['vis'+repr(i)] = 0 # use squares
+            elif cfg.MULTI_MODE == 'image':
+                state.current_stim['vis'+repr(i)] = cfg.VISUAL_COLORS[0]
+
+    # in jaeggi mode, set using the predetermined sequence.
+    if cfg.JAEGGI_MODE:
+        state.current_stim['position1'] = state.bt_sequence[0][state.trial_number - 1]
+        state.current_stim['audio'] = state.bt_sequence[1][state.trial_number - 1]
+
+    state.answer_key = answer_key(state, session, cfg)
+
+def answer_key(state, session, cfg):
+    '''The answer key of the current trial: for each modality of the mode,
+    whether its stimulus matches the one n trials back, and for arithmetic
+    the right answer (a Decimal).  None during the first n trials.'''
+    if len(session['position1']) < state.back:
+        return None
+    # FIXME:  I'm not going to think about whether crab_back will work with
+    # cfg.VARIABLE_NBACK yet, since I don't actually understand how the latter works
+    nback_trial = state.trial_number - trial_back(state, cfg) - 1
+    key = {}
+    for mod in state.modalities[state.mode]:
+        if mod == 'arithmetic':
+            key[mod] = arithmetic_answer(state.current_operation, session['numbers'][nback_trial],
+                                         state.current_stim['number'])
+        else:
+            now, then = MATCHED_STIMULI[mod]
+            # Catch accesses past list end
+            try:
+                key[mod] = state.current_stim[now] == session[then][nback_trial]
+            except IndexError as e:
+                print(e)
+                key[mod] = False
+    return key
+
+def pregenerate(state, cfg, seed):
+    '''Choose the stimuli of every trial of a session at once, from seed:
+    sets state.sequence (and state.bt_sequence, state.variable_list where
+    the configuration uses them).  The same mode, n-back level, number of
+    trials, configuration and seed always give the same stimuli.'''
+    rng = random.Random(seed)
+    state.seed = seed
+    if cfg.JAEGGI_MODE:
+        state.bt_sequence = compute_bt_sequence(state.back, state.num_trials_total, rng)
+    if cfg.VARIABLE_NBACK:
+        state.variable_list = variable_nback_list(state.back, state.num_trials_total, rng)
+    # the stimuli only depend on those of the earlier trials, never on the
+    # input, so the trials can be played through without a player
+    trial = copy.copy(state)
+    trial.current_stim = new_stimulus()
+    session = new_session_record()
+    sequence = []
+    for number in range(1, state.num_trials_total + 1):
+        trial.trial_number = number
+        generate_stimulus(trial, session, cfg, rng)
+        sequence.append((dict(trial.current_stim), trial.current_operation, trial.answer_key))
+        save_stimulus(session, trial)
+    state.sequence = sequence
+
+def next_stimulus(state):
+    '''Set the stimuli and answer key of the current trial from
+    state.sequence.'''
+    stim, state.current_operation, state.answer_key = state.sequence[state.trial_number - 1]
+    state.current_stim.update(stim)
+
+def regenerate(record):
+    '''The SessionState of a session from USER-sessions.dat (with its
+    'cfg'), its stimuli chosen again from the recorded seed; None for a
+    session recorded without one.'''
+    if record.get('seed') is None:
+        return None
+    cfg = config(**(record.get('cfg') or {}))
+    state = SessionState(record['mode'], cfg, record['n'],
+                         int(round(record['trial_duration'] / TICK_DURATION)))
+    state.num_trials_total = record['trials']
+    pregenerate(state, cfg, record['seed'])
+    return state
+
+def recorded_sequence(state, session, cfg):
+    '''The stimuli of a recorded session, as pregenerate() would have
+    chosen them.'''
+    trials = len(session['position1'])
+    keys = recorded_key(state, session, cfg)
+    sequence = []
+    for x in range(trials):
+        stim = {}
+        for name in new_stimulus():
+            values = session.get(name == 'number' and 'numbers' or name)
+            stim[name] = values and values[x] or 0
+        if x < state.back:
+            key = None
+        else:
+            key = dict([(mod, keys[mod][x]) for mod in keys])
+        sequence.append((stim, session['operation'][x], key))
+    return sequence
+
+def check_match(state, input_type, check_missed=False, answer=None):
+    ''''correct' if the current trial of input_type matches (for
+    arithmetic: if answer is right), 'missed' instead of 'correct' if
+    check_missed, 'incorrect' if not and 'unknown' before the first n
+    trials are over.'''
+    if state.answer_key is None:
+        return 'unknown'
+    expected = state.answer_key[input_type]
+    if input_type == 'arithmetic':
+        if expected == answer:
+            return 'correct'
+    elif expected:
+        if check_missed:
+            return 'missed'
+        else:
+            return 'correct'
+    return 'incorrect'
+
+def recorded_key(state, session, cfg):
+    '''The answer keys of the trials of a session, as saved by save_input():
+    {modality: [match or answer of each trial]}, worked out from the
+    stimuli for sessions recorded without them.'''
+    trials = len(session['position1'])
+    keys = {}
+    for mod in state.modalities[state.mode]:
+        name = mod == 'arithmetic' and 'arithmetic_answer' or mod + '_match'
+        if len(session.get(name, ())) == trials:
+            keys[mod] = session[name]
+            continue
+        if cfg.VARIABLE_NBACK and not state.variable_list:
+            raise ValueError('the n-back of each trial was not recorded')
+        key = keys[mod] = [None] * trials
+        now, then = MATCHED_STIMULI.get(mod, (None, None))
+        for x in range(state.back, trials):
+
+            if state.flags[state.mode]['crab'] == 1:
+                back = 1 + 2*(x % state.back)
+            else:
+                back = state.back
+            if cfg.VARIABLE_NBACK:
+                back = state.variable_list[x - back]
+
+            if mod == 'arithmetic':
+                key[x] = arithmetic_answer(session['operation'][x], session['numbers'][x-back],
+                                           session['numbers'][x])
+            else:
+                key[x] = session[now][x] == session[then][x-back]
+    return keys
+
+def calc_percent(r, w):
+    if r+w: return int(r*100 / float(r+w))
+    else:   return 0
+
+def score_session(state, session, cfg):
+    '''Score a finished session: returns (percent, category percents,
+    rights, wrongs), the last three by modality.  With JAEGGI_SCORING the
+    percent is that of the worst modality and a correctly withheld
+    response counts as right.'''
+    rights = dict([(mod, 0) for mod in SCORED_MODALITIES])
+    wrongs = dict([(mod, 0) for mod in SCORED_MODALITIES])
+    category_percents = dict([(mod, 0) for mod in SCORED_MODALITIES])
+
+    mods = state.modalities[state.mode]
+    keys = recorded_key(state, session, cfg)
+
+    for mod in mods:
+        key = keys[mod]
+        inputs = session[mod + '_input']
+        for x in range(state.back, len(key)):
+            if mod == 'arithmetic':
+                right = key[x] == Decimal(inputs[x])
+                rights[mod] += int(right)
+                wrongs[mod] += int(not right)
+            else:
+                rights[mod] += int(key[x] and inputs[x])
+                wrongs[mod] += int(key[x] ^ inputs[x]) # ^ is XOR
+                if cfg.JAEGGI_SCORING:
+                    rights[mod] += int(not key[x] and not inputs[x])
+
+    right = sum([rights[mod] for mod in mods])
+    wrong = sum([wrongs[mod] for mod in mods])
+
+    for mod in mods:
+        category_percents[mod] = calc_percent(rights[mod], wrongs[mod])
+
+    if cfg.JAEGGI_SCORING:
+        percent = min([category_percents[m] for m in mods])
+    else:
+        percent = calc_percent(right, wrong)
+    return percent, category_percents, rights, wrongs
+
+def hide_tick(state):
+    '''The tick the stimulus is hidden at, later with more positions.'''
+    positions = len([mod for mod in state.modalities[state.mode] if mod.startswith('position')])
+    return 6 + max(0, positions-1)
+
+def quiet_ticks(state):
+    '''How many of the next calls of step() would do nothing but count the
+    tick, so that a virtual clock can skip them.'''
+    if state.flags[state.mode]['selfpaced']:
+        return 0  # waits for the player
+    events = [t for t in (1, hide_tick(state), state.ticks_per_trial - 2,
+                          state.ticks_per_trial - 1, state.ticks_per_trial)
+              if t > state.tick]
+    if not events:
+        return 0
+    return min(events) - state.tick - 1
+
+# The session timer; runs every TICK_DURATION seconds during a session.
+# During each trial the tick goes from 1 to ticks_per_trial-1 then back to 0.
+# tick = 1: Input from the last trial is saved. Input is reset.
+#             A new square appears and the sound cue plays.
+# tick = 6: the square disappears.
+# tick = ticks_per_trial - 1: tick is reset to 0.
+# tick = 1: etc.
+def step(state, events):
+    '''Advance a running session by one tick.  events is told what
+    happens, through its methods save_input(), start_trial(),
+    generate_stimulus(), end_session(), reset_input(), hide_stimulus()
+    and show_feedback().'''
+    if (not state.flags[state.mode]['selfpaced'] or
+            state.tick > state.ticks_per_trial-6 or
+            state.tick < 5):
+        state.tick += 1
+    if state.tick == 1:
+        state.show_missed = False
+        if state.trial_number > 0:
+            events.save_input()
+        state.trial_number += 1
+        events.start_trial()
+        if state.trial_number > state.num_trials_total:
+            events.end_session()
+        else: events.generate_stimulus()
+        events.reset_input()
+    # Hide square at either the 0.5 second mark or sooner
+    if state.tick == hide_tick(state) or state.tick == state.ticks_per_trial - 1:
+        events.hide_stimulus()
+    if state.tick == state.ticks_per_trial - 2:  # display feedback for 200 ms
+        state.tick = 0
+        state.show_missed = True
+        events.show_feedback()
+    if state.tick == state.ticks_per_trial:
+        state.tick = 0
+
+def first_tick(state, cfg):
+    '''The tick a session starts from: a 1-second delay before the first
+    trial, longer in multi-stimulus modes.'''
+    tick = -9
+    tick -= 5 * (state.flags[state.mode]['multi'] - 1 )
+    if cfg.MULTI_MODE == 'image':
+        tick -= 5 * (state.flags[state.mode]['multi'] - 1 )
+    return tick
+
+class SessionState:
+    '''The state of one session, with the attributes of the game's Mode
+    object that the functions above use.'''
+    def __init__(self, mode, cfg, back=None, ticks_per_trial=None):
+        self.mode = mode
+        self.modalities = MODALITIES
+        self.flags = FLAGS
+        if back is None:
+            back = default_back(cfg, mode)
+        self.back = back
+        self.ticks_per_trial = ticks_per_trial or default_ticks(cfg, mode)
+        self.num_trials_total = trials_total(cfg, back)
+        self.inputs, self.input_rts = new_inputs()
+        self.current_stim = new_stimulus()
+        self.current_operation = 'none'
+        self.answer_key = None
+        self.variable_list = []
+        self.bt_sequence = []
+        self.sequence = []
+        self.seed = None
+        self.started = False
+        self.show_missed = False
+        self.session_number = 0
+        self.trial_number = 0
+        self.trial_starttime = 0.
+        self.tick = 0
+
+class Observer:
+    '''Receives the events of a SessionEngine; renderers, audio players and
+    recorders override the ones they need.'''
+    def session_started(self, engine):
+        pass
+    def stimulus_shown(self, engine):
+        '''engine.state.current_stim is the stimulus of the new trial.'''
+        pass
+    def stimulus_hidden(self, engine):
+        pass
+    def feedback_shown(self, engine):
+        pass
+    def key_pressed(self, engine, modality):
+        pass
+    def session_ended(self, engine):
+        '''engine.percent and engine.category_percents hold the score.'''
+        pass
+
+class SessionEngine:
+    '''Runs sessions of one mode on a virtual clock.  Inputs come from
+    press() and answer(), usually called by a player when a stimulus is
+    shown; see SimulatedPlayer and RecordedPlayer.'''
+    def __init__(self, mode=2, back=None, cfg=None, rng=None, player=None,
+                 observers=(), ticks_per_trial=None):
+        self.cfg = cfg or config()
+        self.rng = rng or random.Random()
+        self.state = SessionState(mode, self.cfg, back, ticks_per_trial)
+        self.player = player
+        self.observers = list(observers)
+        self.clock = 0.
+        self.session = new_session_record()
+        self.arithmetic_answer = Decimal(0)
+        self.percent = None
+        self.category_percents = None
+        self.shown = False
+        self.pending = []  # (reaction time, modality) of presses still to come
+
+    def notify(self, event, *args):
+        for observer in self.observers:
+            getattr(observer, event)(self, *args)
+
+    def choose_stimuli(self):
+        pregenerate(self.state, self.cfg, self.rng.getrandbits(63))
+
+    def start(self):
+        state = self.state
+        state.tick = first_tick(state, self.cfg)
+        state.session_number += 1
+        state.trial_number = 0
+        state.answer_key = None
+        state.started = True
+        self.choose_stimuli()
+        self.pending = []
+        self.reset_input()
+        self.session = new_session_record()
+        self.percent = self.category_percents = None
+        self.notify('session_started')
+
+    def tick(self):
+        self.shown = False
+        step(self.state, self)
+        if self.shown:
+            # after step() has reset the input of the new trial
+            self.notify('stimulus_shown')
+            if self.player is not None:
+                self.player.respond(self)
+        if self.pending:
+            self.press_due(self.clock - self.state.trial_starttime)
+        self.clock += TICK_DURATION
+
+    def run(self, speed=None):
+        '''Play a whole session; returns the percent score.  By default the
+        clock jumps over the ticks where nothing happens; with a speed,
+        ticks take TICK_DURATION / speed seconds of real time, for
+        observers that draw or play sound.'''
+        self.start()
+        state = self.state
+        start = time.time()
+        ticks = 0
+        while state.started:
+            if speed:
+                ticks += 1
+                delay = start + ticks * TICK_DURATION / speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                skip = quiet_ticks(state)
+                state.tick += skip
+                self.clock += skip * TICK_DURATION
+            self.tick()
+        return self.percent
+
+    # input
+    def press(self, modality, rt=None):
+        '''Press the key of a modality, rt seconds into the trial (by
+        default, now).  Presses later in the trial are held back until
+        the clock gets there, or until the trial ends.'''
+        elapsed = self.clock - self.state.trial_starttime
+        if rt is None:
+            rt = elapsed
+        elif rt > elapsed:
+            self.pending.append((rt, modality))
+            return
+        self.state.inputs[modality] = True
+        self.state.input_rts[modality] = rt
+        self.notify('key_pressed', modality)
+
+    def press_due(self, elapsed=None):
+        '''Make the held back presses due by elapsed seconds into the
+        trial (by default, all of them).'''
+        pending = self.pending
+        self.pending = []
+        for rt, modality in sorted(pending):
+            if elapsed is None or rt <= elapsed:
+                self.state.inputs[modality] = True
+                self.state.input_rts[modality] = rt
+                self.notify('key_pressed', modality)
+            else:
+                self.pending.append((rt, modality))
+
+    def answer(self, number):
+        self.arithmetic_answer = Decimal(number)
+
+    def advance(self):
+        '''Go on to the next trial, in a self-paced mode.'''
+        if self.state.flags[self.state.mode]['selfpaced']:
+            self.state.tick = self.state.ticks_per_trial - 2
+
+    def check_match(self, input_type, check_missed=False):
+        return check_match(self.state, input_type, check_missed, self.arithmetic_answer)
+
+    # the events of step()
+    def save_input(self):
+        self.press_due()
+        save_input(self.session, self.state, self.arithmetic_answer)
+
+    def start_trial(self):
+        self.state.trial_starttime = self.clock
+
+    def generate_stimulus(self):
+        next_stimulus(self.state)
+        self.shown = True
+
+    def end_session(self):
+        self.state.started = False
+        self.percent, self.category_percents, rights, wrongs = \
+            score_session(self.state, self.session, self.cfg)
+        self.reset_input()
+        self.notify('session_ended')
+
+    def reset_input(self):
+        self.state.inputs, self.state.input_rts = new_inputs()
+        self.arithmetic_answer = Decimal(0)
+
+    def hide_stimulus(self):
+        self.notify('stimulus_hidden')
+
+    def show_feedback(self):
+        self.notify('feedback_shown')
+
+class SimulatedPlayer:
+    '''Responds to each stimulus like a player who notices a match with
+    probability hit_rate, presses without a match with probability
+    false_alarm_rate and gets the arithmetic right with probability
+    hit_rate.  Reaction times are uniform between min_rt and max_rt.'''
+    def __init__(self, rng=None, hit_rate=0.8, false_alarm_rate=0.1,
+                 min_rt=0.3, max_rt=1.5):
+        self.rng = rng or random.Random()
+        self.hit_rate = hit_rate
+        self.false_alarm_rate = false_alarm_rate
+        self.min_rt = min_rt
+        self.max_rt = max_rt
+
+    def respond(self, engine):
+        state = engine.state
+        engine.advance()
+        key = state.answer_key
+        if key is None:
+            return
+        rng = self.rng
+        for mod in state.modalities[state.mode]:
+            if mod == 'arithmetic':
+                answer = key[mod]
+                if rng.random() >= self.hit_rate:
+                    answer += rng.choice((-1, 1))
+                engine.answer(answer)
+                continue
+            if key[mod]:
+                pressed = rng.random() < self.hit_rate
+            else:
+                pressed = rng.random() < self.false_alarm_rate
+            if pressed:
+                engine.press(mod, round(rng.uniform(self.min_rt, self.max_rt), 3))
+
+class RecordedPlayer:
+    '''Gives the inputs of a recorded session (the per-trial lists of a
+    session in USER-sessions.dat), at their reaction times.'''
+    def __init__(self, session):
+        self.session = session
+
+    def respond(self, engine):
+        state = engine.state
+        x = state.trial_number - 1
+        session = self.session
+        for mod in state.modalities[state.mode]:
+            if mod == 'arithmetic':
+                engine.answer(session['arithmetic_input'][x])
+            elif session[mod + '_input'][x]:
+                engine.press(mod, session[mod + '_rt'][x])
+        # when a self-paced trial was advanced is not recorded
+        engine.advance()
+
+class ReplayEngine(SessionEngine):
+    '''Plays a session from USER-sessions.dat (with its 'cfg' and
+    'session', see SessionArchive.resolve()) again: the recorded stimuli,
+    and the recorded inputs at their reaction times.  scoring, 'bw' or
+    'jaeggi', overrides the JAEGGI_SCORING the session was played with.'''
+    def __init__(self, record, scoring=None, observers=()):
+        if record.get('cfg') is None:
+            # its config reference points to a config missing from the store
+            raise ValueError('the configuration of the session is missing')
+        cfg = config(**record['cfg'])
+        if scoring is not None:
+            cfg.JAEGGI_SCORING = scoring == 'jaeggi'
+        ticks_per_trial = None
+        if record.get('trial_duration'):
+            ticks_per_trial = int(round(record['trial_duration'] / TICK_DURATION))
+        SessionEngine.__init__(self, record['mode'], record['n'], cfg,
+                               player=RecordedPlayer(record['session']),
+                               observers=observers, ticks_per_trial=ticks_per_trial)
+        self.record = record
+        self.state.num_trials_total = len(record['session']['position1'])
+
+    def choose_stimuli(self):
+        state = self.state
+        if self.cfg.VARIABLE_NBACK and self.record.get('seed') is not None:
+            state.variable_list = regenerate(self.record).variable_list
+        state.seed = self.record.get('seed')
+        state.sequence = recorded_sequence(state, self.record['session'], self.cfg)
+
+def recorded_percent(record):
+    '''The score a recorded session got when it was played, from its
+    stats.txt line; None if it has none.'''
+    try:
+        return int(record['summary'][2])
+    except (KeyError, IndexError, TypeError, ValueError):
+        return None
@@ -0,0 +1,2022 @@
+# bwstats.py: stats file handling for Brain Workshop.
+#
+# Copyright (C) 2009-2011: Paul Hoskinson (plhosk@gmail.com)
+# Copyright (C) 2017-2018: Samantha McVey (samantham@posteo.net)
+# SPDX-License-Identifier: GPL-2.0-or-later
+#
+# Nothing in this module may import pyglet.  It is shared between
+# brainworkshop.py and the scripts in tools/, which must be able to run
+# without opening a window or an audio device.
+
+import os, sys, mmap, struct, json, gzip, zlib, pickle, hashlib, bisect, collections, threading, queue
+from array import array
+from datetime import date
+
+CHECKPOINT_SUFFIX  = '.columns'
+CHECKPOINT_HASH_BYTES = 4096  # how much of the head and tail of the file we fingerprint
+CHECKPOINT_INTERVAL = 50      # rewrite the checkpoint after this many new rows
+
+# stats.txt columns 9-24 hold the percentage score of each modality
+MODALITY_COLUMNS = ('position1', 'audio', 'color', 'visvis', 'audiovis',
+                    'arithmetic', 'image', 'visaudio', 'audio2', 'position2',
+                    'position3', 'position4', 'vis1', 'vis2', 'vis3', 'vis4')
+
+# The columns of a History, as (name, array typecode).  'time' is the number
+# of seconds since midnight, 'sesstime' the length of the session in seconds
+# and 'modename' an index into History.strings.
+HISTORY_COLUMNS = (('ordinal', 'i'), ('time', 'i'), ('mode', 'i'),
+                   ('back', 'i'), ('percent', 'h'), ('manual', 'b'),
+                   ('session', 'i'), ('sesstime', 'd')) + \
+                  tuple([(m, 'h') for m in MODALITY_COLUMNS]) + \
+                  (('modename', 'i'), ('ticks', 'i'), ('trials', 'i'))
+MODENAME_COLUMN = [name for name, typecode in HISTORY_COLUMNS].index('modename')
+
+# The columns of a line of a stats file, as documented in
+# data/Readme-stats.txt.  Stats files written by this version start with a
+# header line naming them:
+#
+#   #brainworkshop-stats 1 date,modename,percent,...
+#
+# Files without one (written by older versions) have these columns, or the
+# leading part of them.  A reader goes by the names in the header, so a
+# later version may add or move columns without breaking it.
+STATS_HEADER = '#brainworkshop-stats'
+STATS_VERSION = 1
+STATS_FILE_COLUMNS = ('date', 'modename', 'percent', 'mode', 'n', 'ticks', 'trials',
+                      'manual', 'session') + MODALITY_COLUMNS + ('sesstime', 'reserved')
+
+_STANDARD_POSITION = dict([(name, i) for i, name in enumerate(STATS_FILE_COLUMNS)])
+
+class StatsSchema:
+    '''The column layout of a stats file.'''
+    def __init__(self, columns=STATS_FILE_COLUMNS, version=0):
+        self.version = version
+        self.columns = tuple(columns)
+        self.position = dict([(name, i) for i, name in reversed(list(enumerate(self.columns)))])
+        # files laid out like STATS_FILE_COLUMNS (possibly with more columns
+        # after them) are parsed without reordering
+        self.standard = self.columns[:len(STATS_FILE_COLUMNS)] == STATS_FILE_COLUMNS
+        self._order = [self.position.get(name) for name in STATS_FILE_COLUMNS]
+
+    def header(self):
+        return '%s %i %s' % (STATS_HEADER, STATS_VERSION, ','.join(self.columns))
+
+    def normalize(self, fields):
+        '''Put the fields of a line in the order of STATS_FILE_COLUMNS;
+        columns the file does not have count as 0.'''
+        if self.standard:
+            return fields
+        count = len(fields)
+        return [i is not None and i < count and fields[i] or '0' for i in self._order]
+
+    def layout(self, fields):
+        '''The inverse of normalize(): put fields in the order of
+        STATS_FILE_COLUMNS in the order of the file's columns; columns
+        the game does not write are 0.'''
+        if self.columns == STATS_FILE_COLUMNS:
+            return fields
+        return [name in _STANDARD_POSITION and fields[_STANDARD_POSITION[name]] or '0'
+                for name in self.columns]
+
+DEFAULT_SCHEMA = StatsSchema()
+
+def stats_header():
+    '''The header line (without newline) to start a new stats file with.'''
+    return DEFAULT_SCHEMA.header()
+
+def parse_header(line):
+    '''The StatsSchema a header line describes, or None if it is not one.'''
+    if not line.startswith(STATS_HEADER):
+        return None
+    parts = line.split(None, 2)
+    try:
+        version = int(parts[1])
+        columns = [name.strip() for name in parts[2].split(',')]
+    except (IndexError, ValueError):
+        return None
+    if 'date' not in columns:
+        return None
+    return StatsSchema(columns, version)
+
+def read_schema(path):
+    '''The StatsSchema of a stats file, from its first line.'''
+    try:
+        f = open(path, 'rb')
+    except (IOError, OSError):
+        return DEFAULT_SCHEMA
+    try:
+        line = f.readline(65536)
+    finally:
+        f.close()
+    return parse_header(line.decode('utf-8', 'replace')) or DEFAULT_SCHEMA
+
+def parse_line(line, schema=None):
+    '''Parse one line of a stats file into a row with the fields of
+    HISTORY_COLUMNS.  Returns None for lines which do not hold a session
+    (blank lines, comments, the header); raises ValueError or IndexError
+    for lines which look like a session but are malformed.'''
+    if not line or line[0] not in '0123456789':
+        return None
+    if '\t' in line:
+        separator = '\t'
+    else:
+        separator = ','
+    newline = line.rstrip('\r\n').split(separator)
+    if schema is not None and not schema.standard:
+        newline = schema.normalize(newline)
+    stamp = newline[0]
+    ordinal = _date_ordinal(int(stamp[:4]), int(stamp[5:7]), int(stamp[8:10]))
+    try:
+        sesstime = float(newline[25])
+    except (IndexError, ValueError):
+        # this session wasn't performed with this version of BW, and is
+        # therefore old, and therefore the session time doesn't matter
+        sesstime = 0.
+    # older versions wrote fewer modality columns; missing ones count as 0
+    percents = [int(x) for x in newline[9:25]]
+    percents.extend([0] * (16 - len(percents)))
+    return (ordinal,
+            int(stamp[11:13]) * 3600 + int(stamp[14:16]) * 60 + int(stamp[17:19]),
+            int(newline[3]), int(newline[4]), int(newline[2]),
+            int(newline[7]) != 0, int(newline[8]), sesstime) + \
+           tuple(percents) + (newline[1], int(newline[5]), int(newline[6]))
+
+def check_row(row):
+    '''Why a row returned by parse_line() does not fit the stats file
+    columns, or None if it does.'''
+    if row[1] >= 86400:
+        return 'bad time of day'
+    if row[2] <= 0:
+        return 'bad game mode %i' % row[2]
+    if row[3] < 1:
+        return 'bad n-back level %i' % row[3]
+    if not 0 <= row[4] <= 100:
+        return 'bad score %i' % row[4]
+    for name, percent in zip(MODALITY_COLUMNS, row[8:8 + len(MODALITY_COLUMNS)]):
+        if not 0 <= percent <= 100:
+            return 'bad %s score %i' % (name, percent)
+    if row[7] < 0:
+        return 'bad session length'
+    if not row[MODENAME_COLUMN]:
+        return 'no mode name'
+    if row[MODENAME_COLUMN + 1] <= 0 or row[MODENAME_COLUMN + 2] <= 0:
+        return 'bad trial length or count'
+    return None
+
+def parse_checked(line, schema=None):
+    '''Like parse_line(), but returns (row, reason) instead of raising:
+    reason says why the line is malformed, and is None if it is not.'''
+    try:
+        row = parse_line(line, schema)
+    except IndexError:
+        return None, 'too few columns'
+    except ValueError as e:
+        return None, str(e)
+    if row is None:
+        return None, None
+    return row, check_row(row)
+
+def format_row(row, separator=',', schema=None):
+    '''The inverse of parse_line(), for a row as returned by History.row();
+    laid out like the columns of schema if one is given.'''
+    d = date.fromordinal(row[0])
+    fields = ['%04i-%02i-%02i %02i:%02i:%02i' % (d.year, d.month, d.day,
+                  row[1] // 3600, row[1] // 60 % 60, row[1] % 60),
+              row[MODENAME_COLUMN], row[4], row[2], row[3],
+              row[MODENAME_COLUMN + 1], row[MODENAME_COLUMN + 2],
+              int(row[5]), row[6]]
+    fields.extend(row[8:8 + len(MODALITY_COLUMNS)])
+    fields.extend([row[7], 0])
+    fields = [str(field) for field in fields]
+    if schema is not None:
+        fields = schema.layout(fields)
+    return separator.join(fields)
+
+# For reading only some of the columns of a stats file: the stats file column
+# each History column comes from, how to convert it, and the value when a
+# short line lacks it (None if the line is then malformed).
+def _date_column(stamp):
+    return _date_ordinal(int(stamp[:4]), int(stamp[5:7]), int(stamp[8:10]))
+
+def _time_column(stamp):
+    return int(stamp[11:13]) * 3600 + int(stamp[14:16]) * 60 + int(stamp[17:19])
+
+def _sesstime_column(field):
+    try:
+        return float(field)
+    except ValueError:
+        return 0.
+
+_PROJECTIONS = {'ordinal':  ('date', _date_column, None),
+                'time':     ('date', _time_column, None),
+                'mode':     ('mode', int, None),
+                'back':     ('n', int, None),
+                'percent':  ('percent', int, None),
+                'manual':   ('manual', lambda field: int(field) != 0, None),
+                'session':  ('session', int, None),
+                'sesstime': ('sesstime', _sesstime_column, 0.),
+                'modename': ('modename', str, None),
+                'ticks':    ('ticks', int, None),
+                'trials':   ('trials', int, None)}
+for _name in MODALITY_COLUMNS:
+    _PROJECTIONS[_name] = (_name, int, 0)
+
+def read_columns(path, names):
+    '''Read the named columns (see HISTORY_COLUMNS) of the sessions in a
+    stats file, converting only the fields they come from.  Returns
+    ({name: array}, number of malformed lines); 'modename' gives a list of
+    strings.  Lines are not checked beyond the requested fields.'''
+    schema = read_schema(path)
+    fields = []
+    for name in names:
+        column, convert, default = _PROJECTIONS[name]
+        fields.append((schema.position.get(column), convert, default))
+    # lines are only split as far as the last field needed
+    last = max([position for position, convert, default in fields if position is not None] + [0])
+    typecodes = dict(HISTORY_COLUMNS)
+    result = []
+    for name in names:
+        if name == 'modename':
+            result.append([])
+        else:
+            result.append(array(typecodes[name]))
+    bad = 0
+    f = open(path, 'rb')
+    try:
+        for line in f:
+            line = line.decode('utf-8', 'replace')
+            if not line or line[0] not in '0123456789':
+                continue
+            split = line.rstrip('\r\n').split('\t' in line and '\t' or ',', last + 1)
+            try:
+                values = []
+                for position, convert, default in fields:
+                    if position is not None and position < len(split):
+                        values.append(convert(split[position]))
+                    elif default is None:
+                        raise IndexError(position)
+                    else:
+                        values.append(default)
+            except (ValueError, IndexError):
+                bad += 1
+                continue
+            for column, value in zip(result, values):
+                column.append(value)
+    finally:
+        f.close()
+    return dict(zip(names, result)), bad
+
+def tail_rows(path, count, blocksize=8192):
+    '''The last count well-formed session rows of a stats file, oldest
+    first.  The file is read backwards a block at a time, so the cost
+    depends on count rather than on the size of the file.  Malformed lines
+    and a last line still being written are skipped.'''
+    schema = read_schema(path)
+    rows = []
+    f = open(path, 'rb')
+    try:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        rest = b''
+        first = True
+        while position > 0 and len(rows) < count:
+            size = min(blocksize, position)
+            position -= size
+            f.seek(position)
+            data = f.read(size) + rest
+            if first:
+                end = data.rfind(b'\n')
+                if end == -1:
+                    rest = b''  # all part of a line without its newline yet
+                    continue
+                data = data[:end]
+                first = False
+            lines = data.split(b'\n')
+            # the first piece may be the end of a line that starts further back
+            rest = lines.pop(0)
+            for line in reversed(lines):
+                row, reason = parse_checked(line.decode('utf-8', 'replace'), schema)
+                if row is not None and reason is None:
+                    rows.append(row)
+                    if len(rows) == count:
+                        break
+        if position == 0 and len(rows) < count and not first:
+            row, reason = parse_checked(rest.decode('utf-8', 'replace'), schema)
+            if row is not None and reason is None:
+                rows.append(row)
+    finally:
+        f.close()
+    rows.reverse()
+    return rows
+
+_ordinal_cache = {}
+def _date_ordinal(year, month, day):
+    # constructing a date object per row is a noticeable part of the parse
+    key = (year, month, day)
+    try:
+        return _ordinal_cache[key]
+    except KeyError:
+        ordinal = _ordinal_cache[key] = date(year, month, day).toordinal()
+        return ordinal
+
+class History:
+    '''Columnar session history: one array per column of HISTORY_COLUMNS,
+    in the order the sessions appear in the stats file.  This is the one
+    in-memory copy of the stats shared by the game, the graph and the labels.'''
+    def __init__(self, columns=None, strings=()):
+        if columns is None:
+            columns = [array(typecode) for name, typecode in HISTORY_COLUMNS]
+        self._set_columns(columns)
+        self.strings = list(strings)
+        self.string_index = dict([(s, i) for i, s in enumerate(self.strings)])
+
+    def _set_columns(self, columns):
+        self.columns = columns
+        for (name, typecode), column in zip(HISTORY_COLUMNS, columns):
+            setattr(self, name, column)
+
+    def __len__(self):
+        return len(self.ordinal)
+
+    def column(self, name):
+        return getattr(self, name)
+
+    def _intern(self, string):
+        try:
+            return self.string_index[string]
+        except KeyError:
+            self.strings.append(string)
+            i = self.string_index[string] = len(self.strings) - 1
+            return i
+
+    def append(self, row):
+        self.extend([row])
+
+    def extend(self, rows):
+        if rows:
+            for i, (column, values) in enumerate(zip(self.columns, zip(*rows))):
+                if i == MODENAME_COLUMN:
+                    values = [self._intern(v) for v in values]
+                column.extend(values)
+
+    def truncate(self, length):
+        for column in self.columns:
+            del column[length:]
+
+    def copy(self, length=None):
+        return History([column[:length] for column in self.columns], self.strings)
+
+    def row(self, i):
+        row = [column[i] for column in self.columns]
+        row[MODENAME_COLUMN] = self.strings[row[MODENAME_COLUMN]]
+        return tuple(row)
+
+    def day(self, i, rollover_hour):
+        '''The date ordinal of the day session i counts towards.'''
+        if self.time[i] < rollover_hour * 3600:
+            return self.ordinal[i] - 1
+        return self.ordinal[i]
+
+    def timestamp(self, i):
+        '''Seconds since 0001-01-01 00:00, local time.'''
+        return self.ordinal[i] * 86400 + self.time[i]
+
+    def indices(self, mode=None, start=0):
+        if mode is None:
+            return list(range(start, len(self)))
+        modes = self.mode
+        return [i for i in range(start, len(modes)) if modes[i] == mode]
+
+class ModeIndex:
+    '''Per-mode view of a History: each mode's sessions, its last RECENT
+    sessions, and the trailing run of its sessions at one n-back level with
+    their scores sorted, which is what deciding the next level needs.
+    update() indexes the rows added to the history since the last call.'''
+    RECENT = 20
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.history = None
+        self.rows = 0
+        self.last = None
+        self.sessions = {}  # mode: array of history indices
+        self.recent = {}    # mode: deque of the last RECENT history indices
+        self.runs = {}      # mode: [position in sessions[mode] where the run starts, sorted scores]
+
+    def update(self, history):
+        rows = self.rows
+        if (history is not self.history or len(history) < rows or
+                (rows and self.last != history.row(rows - 1))):
+            self.reset()
+            self.history, rows = history, 0
+        for i in range(rows, len(history)):
+            m = history.mode[i]
+            if m not in self.sessions:
+                self.sessions[m] = array('i')
+                self.recent[m] = collections.deque(maxlen=self.RECENT)
+            sessions = self.sessions[m]
+            run = self.runs.get(m)
+            if run is None or history.back[sessions[run[0]]] != history.back[i]:
+                self.runs[m] = [len(sessions), [history.percent[i]]]
+            else:
+                bisect.insort(run[1], history.percent[i])
+            sessions.append(i)
+            self.recent[m].append(i)
+        self.rows = len(history)
+        if self.rows:
+            self.last = history.row(self.rows - 1)
+
+    def indices(self, mode, start=0, limit=None):
+        '''Like History.indices(mode, start), or only the last limit of them.'''
+        sessions = self.sessions.get(mode, ())
+        first = bisect.bisect_left(sessions, start)
+        if limit is not None:
+            first = max(first, len(sessions) - limit)
+        return list(sessions[first:])
+
+    def last_session(self, mode, start=0):
+        '''The history index of the mode's last session, if it was played no
+        earlier than session start; otherwise None.'''
+        sessions = self.sessions.get(mode)
+        if sessions and sessions[-1] >= start:
+            return sessions[-1]
+        return None
+
+    def below(self, mode, threshold, start=0):
+        '''How many sessions of the mode's trailing run at one level, played
+        no earlier than session start, scored below threshold.'''
+        run = self.runs.get(mode)
+        if run is None:
+            return 0
+        sessions = self.sessions[mode]
+        first = max(run[0], bisect.bisect_left(sessions, start))
+        if first == run[0]:
+            return bisect.bisect_left(run[1], threshold)
+        percent = self.history.percent
+        return len([i for i in sessions[first:] if percent[i] < threshold])
+
+def local_timestamp(dt):
+    '''Seconds since 0001-01-01 00:00 of a datetime, like History.timestamp().'''
+    return dt.toordinal() * 86400 + dt.hour * 3600 + dt.minute * 60 + dt.second
+
+class TimeIndex:
+    '''The sessions of a History sorted by time, with running totals of the
+    session lengths, so the number of sessions and the time played in any
+    window (today, the last 24 hours, the last n days) take two binary
+    searches to count.  update() indexes the rows added to the history since
+    the last call.'''
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.history = None
+        self.timestamps = array('q')
+        self.order = array('i')           # the history index of each timestamp
+        self.elapsed = array('d', [0.])   # elapsed[k]: total length of the first k sessions
+        self.last = None                  # (timestamp, sesstime) of the last row indexed
+
+    def update(self, history):
+        rows = len(self.order)
+        if (history is not self.history or len(history) < rows or
+                (rows and self.last != (history.timestamp(rows - 1), history.sesstime[rows - 1]))):
+            # a different or rewritten history
+            self.reset()
+            self.history, rows = history, 0
+        timestamps, order, elapsed = self.timestamps, self.order, self.elapsed
+        for i in range(rows, len(history)):
+            t = history.timestamp(i)
+            if not timestamps or t >= timestamps[-1]:
+                timestamps.append(t)
+                order.append(i)
+                elapsed.append(elapsed[-1] + history.sesstime[i])
+            else:
+                # played while the clock was set back; rare enough to pay for
+                k = bisect.bisect_right(timestamps, t)
+                timestamps.insert(k, t)
+                order.insert(k, i)
+                elapsed.insert(k + 1, 0.)
+                for j in range(k + 1, len(elapsed)):
+                    elapsed[j] = elapsed[j - 1] + history.sesstime[order[j - 1]]
+        if len(history):
+            self.last = (history.timestamp(len(history) - 1), history.sesstime[len(history) - 1])
+
+    def window(self, since, until=None):
+        '''The number of sessions and their total length in seconds, for the
+        sessions played from timestamp since up to (not including) until.'''
+        first = bisect.bisect_left(self.timestamps, since)
+        if until is None:
+            last = len(self.timestamps)
+        else:
+            last = max(first, bisect.bisect_left(self.timestamps, until))
+        return last - first, self.elapsed[last] - self.elapsed[first]
+
+    def first_index(self, since):
+        '''The history index of the first session played at or after since,
+        or the length of the history if there is none.'''
+        first = bisect.bisect_left(self.timestamps, since)
+        if first == len(self.order):
+            return len(self.order)
+        return min(self.order[first:])
+
+# The binary column store is a compact, fixed-width copy of a stats file:
+#
+#   header    COLUMNS_MAGIC, version, row count, column count, metadata length
+#   directory one (name, typecode, offset) entry per column
+#   metadata  JSON: the History.strings table plus whatever the writer adds
+#   columns   each column as a contiguous little-endian array, 8-byte aligned
+#
+# Reading a column maps it straight out of the file, so the cost of loading
+# depends on the columns asked for rather than on the size of the text.
+COLUMNS_MAGIC   = b'BWCOLS\x00\x00'
+COLUMNS_VERSION = 1
+_COLUMNS_HEADER = struct.Struct('<8sHxxIII')
+_COLUMNS_ENTRY  = struct.Struct('<16sc7xQ')
+
+def _align(n):
+    return (n + 7) & ~7
+
+def write_columns(path, history, meta=None):
+    '''Write a History to path in the binary column format.  The file is
+    replaced atomically.'''
+    meta = dict(meta or {})
+    meta['strings'] = history.strings
+    meta = json.dumps(meta).encode('utf-8')
+    rows = len(history)
+    offset = _align(_COLUMNS_HEADER.size + _COLUMNS_ENTRY.size * len(HISTORY_COLUMNS) + len(meta))
+    directory = []
+    for (name, typecode), column in zip(HISTORY_COLUMNS, history.columns):
+        directory.append(_COLUMNS_ENTRY.pack(name.encode('ascii'), typecode.encode('ascii'), offset))
+        offset = _align(offset + column.itemsize * rows)
+    tmp_path = path + '.tmp'
+    f = open(tmp_path, 'wb')
+    try:
+        f.write(_COLUMNS_HEADER.pack(COLUMNS_MAGIC, COLUMNS_VERSION, rows, len(directory), len(meta)))
+        f.write(b''.join(directory))
+        f.write(meta)
+        for column in history.columns:
+            f.write(b'\x00' * (_align(f.tell()) - f.tell()))
+            if sys.byteorder == 'big':
+                column = array(column.typecode, column)
+                column.byteswap()
+            f.write(column.tobytes())
+    finally:
+        f.close()
+    os.replace(tmp_path, path)
+
+class ColumnFile:
+    '''Read-only, memory-mapped view of a file written by write_columns().'''
+    def __init__(self, path):
+        self.path = path
+        f = open(path, 'rb')
+        try:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+        try:
+            magic, version, self.rows, ncols, metalen = _COLUMNS_HEADER.unpack_from(self.map, 0)
+            if magic != COLUMNS_MAGIC or version != COLUMNS_VERSION:
+                raise ValueError('%s is not a Brain Workshop column file' % path)
+            self.offsets = {}
+            pos = _COLUMNS_HEADER.size
+            for i in range(ncols):
+                name, typecode, offset = _COLUMNS_ENTRY.unpack_from(self.map, pos)
+                self.offsets[name.rstrip(b'\x00').decode('ascii')] = (typecode.decode('ascii'), offset)
+                pos += _COLUMNS_ENTRY.size
+            self.meta = json.loads(self.map[pos:pos + metalen].decode('utf-8'))
+            self.view = memoryview(self.map)
+        except Exception:
+            self.map.close()
+            raise
+
+    def __len__(self):
+        return self.rows
+
+    def column(self, name):
+        '''A zero-copy view of one column.  On big-endian machines the column
+        has to be copied and byte-swapped instead.'''
+        typecode, offset = self.offsets[name]
+        itemsize = array(typecode).itemsize
+        view = self.view[offset:offset + itemsize * self.rows].cast(typecode)
+        if sys.byteorder == 'big':
+            view = array(typecode, view)
+            view.byteswap()
+        return view
+
+    def history(self):
+        '''Copy the whole file into a History.'''
+        columns = []
+        for name, typecode in HISTORY_COLUMNS:
+            if name in self.offsets:
+                column = array(typecode, self.column(name))
+            else:
+                column = array(typecode, [0]) * self.rows
+            columns.append(column)
+        return History(columns, self.meta.get('strings', []))
+
+    def close(self):
+        self.view.release()
+        self.map.close()
+
+# Very large stats files (several users' stats concatenated for research)
+# can be parsed in parallel: the file is cut into chunks at line boundaries,
+# each chunk is parsed by parse_checked() in a worker process into columns of
+# its own, and the columns are joined in file order.  Malformed lines are
+# quarantined, as when ParsedStats reads the file.
+PARALLEL_CHUNK_SIZE = 16 * 1024 * 1024
+
+def _parse_chunk(path, start, end):
+    '''Returns the columns and strings of the chunk's history, its number
+    of lines and its malformed lines, numbered from 1 within the chunk.'''
+    f = open(path, 'rb')
+    try:
+        f.seek(start)
+        data = f.read(end - start)
+    finally:
+        f.close()
+    schema = read_schema(path)
+    history = History()
+    rows, bad = [], []
+    lines = data.decode('utf-8', 'replace').split('\n')
+    for number, line in enumerate(lines, 1):
+        row, reason = parse_checked(line, schema)
+        if reason is not None:
+            # like ParsedStats, an unfinished last line is not quarantined
+            if number < len(lines):
+                bad.append((number, reason, line.rstrip('\r')))
+        elif row is not None:
+            rows.append(row)
+    history.extend(rows)
+    return history.columns, history.strings, data.count(b'\n'), bad
+
+def _chunk_boundaries(path, chunk_size):
+    size = os.path.getsize(path)
+    boundaries = [0]
+    f = open(path, 'rb')
+    try:
+        while boundaries[-1] + chunk_size < size:
+            f.seek(boundaries[-1] + chunk_size)
+            f.readline()  # move on to the start of the next line
+            if f.tell() >= size:
+                break
+            boundaries.append(f.tell())
+    finally:
+        f.close()
+    boundaries.append(size)
+    return boundaries
+
+def parse_parallel(path, jobs=None, chunk_size=PARALLEL_CHUNK_SIZE, quarantined=None):
+    '''Parse a whole stats file into a History using a pool of jobs worker
+    processes (one per CPU by default).  Files of a single chunk are parsed
+    in this process.  Malformed lines are skipped and written to the
+    quarantine file, and added to the list quarantined if one is given.'''
+    from concurrent.futures import ProcessPoolExecutor
+    boundaries = _chunk_boundaries(path, chunk_size)
+    chunks = list(zip(boundaries[:-1], boundaries[1:]))
+    if jobs == 1 or len(chunks) < 2:
+        results = [_parse_chunk(path, start, end) for start, end in chunks]
+    else:
+        executor = ProcessPoolExecutor(jobs)
+        try:
+            results = list(executor.map(_parse_chunk, [path] * len(chunks),
+                                        [start for start, end in chunks],
+                                        [end for start, end in chunks]))
+        finally:
+            executor.shutdown()
+    history = History()
+    bad = []
+    lines = 0
+    for columns, strings, count, chunk_bad in results:
+        # each chunk numbered its mode names and its lines on its own
+        renumber = [history._intern(string) for string in strings]
+        for i, (column, values) in enumerate(zip(history.columns, columns)):
+            if i == MODENAME_COLUMN:
+                values = array('i', [renumber[k] for k in values])
+            column.extend(values)
+        bad.extend([(lines + number, reason, line) for number, reason, line in chunk_bad])
+        lines += count
+    try:
+        write_quarantine(path + QUARANTINE_SUFFIX, bad)
+    except (IOError, OSError):
+        pass  # they are still reported
+    if quarantined is not None:
+        quarantined.extend(bad)
+    return history
+
+def stats_to_columns(stats_path, columns_path, jobs=1, quarantined=None):
+    '''Convert a stats file to the binary column format, using jobs worker
+    processes (see parse_parallel()).'''
+    history = parse_parallel(stats_path, jobs, quarantined=quarantined)
+    write_columns(columns_path, history)
+    return len(history)
+
+def columns_to_stats(columns_path, stats_path, separator=','):
+    '''Convert a binary column file back to a stats file.'''
+    columns = ColumnFile(columns_path)
+    try:
+        history = columns.history()
+    finally:
+        columns.close()
+    f = open(stats_path, 'w')
+    try:
+        f.write(stats_header() + '\n')
+        for i in range(len(history)):
+            f.write(format_row(history.row(i), separator))
+            f.write('\n')
+    finally:
+        f.close()
+    return len(history)
+
+def _fingerprint(f, start, end):
+    f.seek(start)
+    return hashlib.sha1(f.read(end - start)).hexdigest()
+
+# Malformed lines of a stats file are skipped, and copied to the quarantine
+# file next to it (FILE.quarantine) as 'line number<TAB>reason<TAB>line'.
+QUARANTINE_SUFFIX = '.quarantine'
+
+def read_quarantine(path):
+    '''The (line number, reason, line) entries of a quarantine file.'''
+    entries = []
+    try:
+        f = open(path, 'rb')
+    except (IOError, OSError):
+        return entries
+    try:
+        for line in f.read().decode('utf-8', 'replace').split('\n'):
+            fields = line.split('\t', 2)
+            if len(fields) == 3 and fields[0].isdigit():
+                entries.append((int(fields[0]), fields[1], fields[2]))
+    finally:
+        f.close()
+    return entries
+
+def write_quarantine(path, entries, append=False):
+    '''Add entries to a quarantine file, or replace its contents by them
+    (removing it if there are none).'''
+    if not append and not entries:
+        if os.path.exists(path):
+            os.remove(path)
+        return
+    if not entries:
+        return
+    exists = append and os.path.exists(path)
+    f = open(path, append and 'ab' or 'wb')
+    try:
+        if not exists:
+            f.write(b'# malformed lines skipped when reading the stats file: '
+                    b'line number, reason, line\n')
+        f.write(''.join(['%i\t%s\t%s\n' % entry for entry in entries]).encode('utf-8'))
+    finally:
+        f.close()
+
+class ParsedStats:
+    '''The History of one stats file, kept up to date incrementally.
+
+    The history parsed so far is stored next to the stats file in the binary
+    column format, together with a checkpoint: the byte offset parsed up to,
+    the size and mtime of the file and fingerprints of the head and the tail
+    of the parsed region.  update() only parses the lines appended since
+    then; the whole file is rescanned only if it was truncated or edited.
+
+    Malformed lines are skipped and quarantined; the ones found since the
+    caller last cleared it are listed in self.quarantined.'''
+    def __init__(self, path):
+        self.path = path
+        self.checkpoint_path = path + CHECKPOINT_SUFFIX
+        self.quarantine_path = path + QUARANTINE_SUFFIX
+        self.unwritten = [] # rows added with add() not yet seen in the file
+        self.quarantined = []
+        self.reset()
+        self.load_checkpoint()
+
+    def reset(self):
+        self.history = History()
+        self.pending = 0    # rows at the end of history not backed by a complete line
+        self.offset = 0     # end of the last complete line parsed
+        self.lines = 0      # number of complete lines parsed
+        self.size = -1
+        self.mtime = -1
+        self.head = self.tail = ''
+        self.checkpoint_rows = 0
+
+    def load_checkpoint(self):
+        try:
+            columns = ColumnFile(self.checkpoint_path)
+            try:
+                state = columns.meta['checkpoint']
+                self.history = columns.history()
+            finally:
+                columns.close()
+            self.offset = state['offset']
+            self.lines  = state['lines']
+            self.size   = state['size']
+            self.mtime  = state['mtime']
+            self.head   = state['head']
+            self.tail   = state['tail']
+            self.checkpoint_rows = len(self.history)
+        except Exception:
+            # a missing or damaged checkpoint just means a full parse
+            self.reset()
+            return False
+        return True
+
+    def save_checkpoint(self):
+        complete = len(self.history) - self.pending  # never checkpoint a half-written line
+        state = {'offset': self.offset,
+                 'lines':  self.lines,
+                 'size':   self.size,
+                 'mtime':  self.mtime,
+                 'head':   self.head,
+                 'tail':   self.tail}
+        try:
+            write_columns(self.checkpoint_path, self.history.copy(complete), {'checkpoint': state})
+            self.checkpoint_rows = complete
+        except (IOError, OSError):
+            # the checkpoint is only an optimization
+            pass
+
+    def _still_valid(self, f, st):
+        if st.st_size < self.offset:
+            return False  # truncated
+        if st.st_size == self.size and st.st_mtime != self.mtime:
+            return False  # rewritten in place
+        head_end = min(self.offset, CHECKPOINT_HASH_BYTES)
+        tail_start = max(0, self.offset - CHECKPOINT_HASH_BYTES)
+        return (_fingerprint(f, 0, head_end) == self.head and
+                _fingerprint(f, tail_start, self.offset) == self.tail)
+
+    def update(self):
+        '''Bring the history up to date with the file.  Returns False if
+        nothing changed since the last call.'''
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            changed = len(self.history) > len(self.unwritten)
+            self.reset()
+            self.history.extend(self.unwritten)
+            self.pending = len(self.unwritten)
+            return changed
+        if st.st_size == self.size and st.st_mtime == self.mtime:
+            return False
+        rescanned = False
+        f = open(self.path, 'rb')
+        try:
+            if not self._still_valid(f, st):
+                self.reset()
+                rescanned = True
+            f.seek(0)
+            schema = parse_header(f.readline(65536).decode('utf-8', 'replace')) or DEFAULT_SCHEMA
+            f.seek(self.offset)
+            data = f.read(st.st_size - self.offset)
+            end = data.rfind(b'\n') + 1
+            new_rows = []
+            unwritten = list(self.unwritten)
+            lines = data[:end].decode('utf-8', 'replace').split('\n')[:-1]
+            bad = []
+            for number, line in enumerate(lines, self.lines + 1):
+                row, reason = parse_checked(line, schema)
+                if reason is not None:
+                    bad.append((number, reason, line.rstrip('\r')))
+                elif row is not None:
+                    new_rows.append(row)
+                    if unwritten and row == unwritten[0]:
+                        del unwritten[0]
+            tail = []
+            if end < len(data) and not unwritten:
+                row, reason = parse_checked(data[end:].decode('utf-8', 'replace'), schema)
+                if row is not None and reason is None:  # else still being written
+                    tail.append(row)
+            self._quarantine(bad)
+            tail.extend(unwritten)
+            self.history.truncate(len(self.history) - self.pending)
+            self.history.extend(new_rows + tail)
+            self.pending = len(tail)
+            self.unwritten = unwritten
+            self.offset += end
+            self.lines += len(lines)
+            self.size = st.st_size
+            self.mtime = st.st_mtime
+            self.head = _fingerprint(f, 0, min(self.offset, CHECKPOINT_HASH_BYTES))
+            self.tail = _fingerprint(f, max(0, self.offset - CHECKPOINT_HASH_BYTES), self.offset)
+        finally:
+            f.close()
+        if rescanned or len(self.history) - self.pending - self.checkpoint_rows >= CHECKPOINT_INTERVAL:
+            self.save_checkpoint()
+        return True
+
+    def _quarantine(self, bad):
+        if not bad and self.offset > 0:
+            return
+        # only lines that are not in the quarantine file yet are news; when
+        # parsing from the start, the quarantine file starts over too
+        known = set([(number, line) for number, reason, line in read_quarantine(self.quarantine_path)])
+        new = [entry for entry in bad if (entry[0], entry[2]) not in known]
+        self.quarantined.extend(new)
+        try:
+            if self.offset == 0:
+                write_quarantine(self.quarantine_path, bad)
+            else:
+                write_quarantine(self.quarantine_path, new, append=True)
+        except (IOError, OSError):
+            pass  # they are still reported
+
+    def add(self, row):
+        '''Add a row which is about to be appended to the file by someone
+        else (see StatsWriter).  It is part of the history right away, and
+        is not added a second time when update() finds it in the file.'''
+        self.unwritten.append(row)
+        self.history.append(row)
+        self.pending += 1
+
+# USER-sessions.dat is a stream of pickled session dictionaries, one per
+# session.  SessionArchive keeps a sidecar index (USER-sessions.dat.idx) of
+# fixed-width entries so any session can be found and loaded with one seek.
+# The index is only ever appended to; if it is missing or lags behind the
+# data file, the missing entries are recovered by scanning the data file.
+SESSIONS_INDEX_SUFFIX = '.idx'
+_INDEX_MAGIC = b'BWSIDX\x00\x01'
+_INDEX_ENTRY = struct.Struct('<QQqiib3x')
+
+# Sessions do not embed the configuration they were played with; they hold a
+# 'cfg_ref' naming an entry in USER-sessions.dat.cfg, a stream of pickled
+# (hash, config) pairs in which every distinct configuration appears once.
+CONFIGS_SUFFIX = '.cfg'
+
+def config_hash(config):
+    return hashlib.sha1(repr(sorted(config.items())).encode('utf-8')).hexdigest()
+
+class ConfigStore:
+    '''Content-addressed store for the configurations sessions refer to.'''
+    def __init__(self, path):
+        self.path = path
+        self._configs = None
+        self.end = 0  # end of the last complete entry
+
+    @property
+    def configs(self):
+        if self._configs is None:
+            self._configs = {}
+            try:
+                f = open(self.path, 'rb')
+            except (IOError, OSError):
+                return self._configs
+            try:
+                while True:
+                    try:
+                        ref, config = pickle.load(f)
+                    except Exception:
+                        break  # end of file, or a half-written last entry
+                    self._configs[ref] = config
+                    self.end = f.tell()
+            finally:
+                f.close()
+        return self._configs
+
+    def get(self, ref):
+        return self.configs.get(ref)
+
+    def put(self, config):
+        '''Store config unless it is already known; returns its reference.'''
+        config = dict(config)
+        ref = config_hash(config)
+        if ref not in self.configs:
+            f = open(self.path, 'ab')
+            try:
+                if f.tell() > self.end:
+                    f.truncate(self.end)  # a half-written entry would hide ours
+                pickle.dump((ref, config), f, protocol=pickle.HIGHEST_PROTOCOL)
+                self.end = f.tell()
+            finally:
+                f.close()
+            self.configs[ref] = config
+        return ref
+
+SessionEntry = collections.namedtuple('SessionEntry',
+    'offset length timestamp mode n manual')
+
+def session_timestamp(string):
+    '''Convert a 'YYYY-MM-DD HH:MM:SS' timestamp to seconds since
+    0001-01-01 00:00, like History.timestamp().'''
+    return (_date_ordinal(int(string[:4]), int(string[5:7]), int(string[8:10])) * 86400 +
+            int(string[11:13]) * 3600 + int(string[14:16]) * 60 + int(string[17:19]))
+
+def _session_entry(session, offset, length):
+    try:
+        timestamp = session_timestamp(session['timestamp'])
+    except (KeyError, TypeError, ValueError):
+        timestamp = 0
+    return SessionEntry(offset, length, timestamp, int(session.get('mode', 0)),
+                        int(session.get('n', 0)), bool(session.get('manual', False)))
+
+# The per-trial lists of a session (session['session']: stimuli, inputs and
+# reaction times for every modality) are stored packed and compressed, as
+# session['session_z']: booleans are packed into bits, integers into the
+# narrowest array type that holds them (delta-coded when that is narrower),
+# and reaction times into a double array; anything else is kept as it is.
+# Each session is compressed on its own, so sessions can still be loaded
+# one at a time through the index.
+_INT_TYPECODES = ('b', 'h', 'i', 'q')
+
+def _int_array(values):
+    for typecode in _INT_TYPECODES:
+        try:
+            return array(typecode, values)
+        except OverflowError:
+            pass
+    return None
+
+def _pack_list(values):
+    if not values or not isinstance(values, list):
+        return values
+    kinds = set([type(value) for value in values])
+    if kinds == set([bool]):
+        bits = bytearray((len(values) + 7) // 8)
+        for i, value in enumerate(values):
+            if value:
+                bits[i >> 3] |= 1 << (i & 7)
+        return ('bits', len(values), bytes(bits))
+    if kinds == set([int]):
+        plain = _int_array(values)
+        deltas = _int_array([values[0]] + [b - a for a, b in zip(values, values[1:])])
+        if plain is None or deltas is None:
+            return values
+        if deltas.itemsize < plain.itemsize:
+            return ('delta', deltas.typecode, deltas.tobytes())
+        return ('ints', plain.typecode, plain.tobytes())
+    if kinds == set([float]):
+        return ('floats', 'd', array('d', values).tobytes())
+    return values
+
+def _unpack_list(packed):
+    if not isinstance(packed, tuple):
+        return packed
+    if packed[0] == 'bits':
+        count, bits = packed[1], bytearray(packed[2])
+        return [bool(bits[i >> 3] & (1 << (i & 7))) for i in range(count)]
+    values = array(packed[1])
+    values.frombytes(packed[2])
+    if packed[0] == 'delta':
+        total, result = 0, []
+        for delta in values:
+            total += delta
+            result.append(total)
+        return result
+    return values.tolist()
+
+def pack_trials(trials):
+    '''Pack and compress the per-trial lists of a session.'''
+    packed = dict([(name, _pack_list(values)) for name, values in trials.items()])
+    return zlib.compress(pickle.dumps(packed, protocol=pickle.HIGHEST_PROTOCOL), 9)
+
+def unpack_trials(data):
+    packed = pickle.loads(zlib.decompress(data))
+    return dict([(name, _unpack_list(values)) for name, values in packed.items()])
+
+def pack_session(session):
+    '''Return (config, session) for storing a session: a copy of the session
+    with its config replaced by a reference and its trials packed, and the
+    config to put in the ConfigStore (None if there is none to add).'''
+    config = session.get('cfg')
+    if not isinstance(config, dict):
+        config = None
+    if config is None and not isinstance(session.get('session'), dict):
+        return None, session
+    session = dict(session)
+    if config is not None:
+        del session['cfg']
+        session['cfg_ref'] = config_hash(config)
+    if isinstance(session.get('session'), dict):
+        session['session_z'] = pack_trials(session.pop('session'))
+    return config, session
+
+class SessionArchive:
+    '''Random access to the sessions in a USER-sessions.dat file.'''
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + SESSIONS_INDEX_SUFFIX
+        self.configs = ConfigStore(path + CONFIGS_SUFFIX)
+        self._entries = None
+
+    def _read_index(self):
+        try:
+            f = open(self.index_path, 'rb')
+        except (IOError, OSError):
+            return []
+        try:
+            data = f.read()
+        finally:
+            f.close()
+        if data[:len(_INDEX_MAGIC)] != _INDEX_MAGIC:
+            return []
+        size = _INDEX_ENTRY.size
+        end = len(_INDEX_MAGIC) + (len(data) - len(_INDEX_MAGIC)) // size * size
+        return [SessionEntry(*_INDEX_ENTRY.unpack_from(data, pos))
+                for pos in range(len(_INDEX_MAGIC), end, size)]
+
+    def _write_index(self, entries, append=False):
+        if append and os.path.exists(self.index_path):
+            f = open(self.index_path, 'ab')
+        else:
+            f = open(self.index_path + '.tmp', 'wb')
+            f.write(_INDEX_MAGIC)
+            append = False
+        try:
+            f.write(b''.join([_INDEX_ENTRY.pack(*entry) for entry in entries]))
+        finally:
+            f.close()
+        if not append:
+            os.replace(self.index_path + '.tmp', self.index_path)
+
+    def _scan(self, start):
+        '''Index the sessions stored from byte offset start on.'''
+        entries = []
+        try:
+            f = open(self.path, 'rb')
+        except (IOError, OSError):
+            return entries
+        try:
+            f.seek(start)
+            while True:
+                offset = f.tell()
+                try:
+                    session = pickle.load(f)
+                except EOFError:
+                    break
+                except Exception:
+                    # a session that was only half written; it cannot be read
+                    # by anything else either, so stop here
+                    break
+                if isinstance(session, dict):
+                    entries.append(_session_entry(session, offset, f.tell() - offset))
+        finally:
+            f.close()
+        return entries
+
+    def _check(self, entry):
+        try:
+            f = open(self.path, 'rb')
+            try:
+                f.seek(entry.offset)
+                session = pickle.loads(f.read(entry.length))
+            finally:
+                f.close()
+            return _session_entry(session, entry.offset, entry.length) == entry
+        except Exception:
+            return False
+
+    def sync(self):
+        '''Make sure the index covers the whole data file, and return it.'''
+        entries = self._read_index()
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        end = entries and entries[-1].offset + entries[-1].length or 0
+        if end > size or (entries and not self._check(entries[-1])):
+            entries, end, rebuilt = [], 0, True  # data file was replaced or truncated
+        else:
+            rebuilt = not os.path.exists(self.index_path)
+        if end < size:
+            new_entries = self._scan(end)
+            entries.extend(new_entries)
+            if not rebuilt:
+                self._write_index(new_entries, append=True)
+        if rebuilt:
+            self._write_index(entries)
+        self._entries = entries
+        return entries
+
+    def refresh(self):
+        '''Index the sessions appended to the data file by someone else.'''
+        if self._entries is None:
+            return self.sync()
+        entries = self._entries
+        end = entries and entries[-1].offset + entries[-1].length or 0
+        try:
+            size = os.path.getsize(self.path)
+        except OSError:
+            size = 0
+        if size < end:
+            return self.sync()
+        if size > end:
+            new_entries = self._scan(end)
+            self._write_index(new_entries, append=True)
+            entries.extend(new_entries)
+        return entries
+
+    @property
+    def entries(self):
+        if self._entries is None:
+            self.sync()
+        return self._entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def append(self, session):
+        '''Append one session, updating the index in place.'''
+        entries = self.entries
+        data = pickle.dumps(self._pack(session), protocol=pickle.HIGHEST_PROTOCOL)
+        f = open(self.path, 'ab')
+        try:
+            f.seek(0, os.SEEK_END)
+            offset = f.tell()
+            f.write(data)
+        finally:
+            f.close()
+        entry = _session_entry(session, offset, len(data))
+        self._write_index([entry], append=True)
+        entries.append(entry)
+        return len(entries) - 1
+
+    def _pack(self, session):
+        config, session = pack_session(session)
+        if config is not None:
+            self.configs.put(config)
+        return session
+
+    def resolve(self, session):
+        '''Replace a session's config reference by the config itself, and
+        unpack its per-trial data.'''
+        if 'cfg_ref' in session:
+            session['cfg'] = self.configs.get(session.pop('cfg_ref'))
+        if 'session_z' in session:
+            session['session'] = unpack_trials(session.pop('session_z'))
+        return session
+
+    def load(self, k):
+        '''Load session number k (negative numbers count from the end).'''
+        entry = self.entries[k]
+        f = open(self.path, 'rb')
+        try:
+            f.seek(entry.offset)
+            return self.resolve(pickle.loads(f.read(entry.length)))
+        finally:
+            f.close()
+
+    def migrate(self):
+        '''Rewrite a data file written by an older version, whose sessions
+        embed their config and per-trial lists, so that they refer to the
+        config store and hold their trials packed.  Returns the sizes of the
+        file before and after.  If a session cannot be read, the file is
+        left as it was and the error is raised.'''
+        old_size = os.path.getsize(self.path)
+        tmp_path = self.path + '.tmp'
+        entries = []
+        f = open(self.path, 'rb')
+        out = open(tmp_path, 'wb')
+        try:
+            while True:
+                try:
+                    session = pickle.load(f)
+                except EOFError:
+                    break
+                if isinstance(session, dict):
+                    session = self._pack(session)
+                    entries.append(_session_entry(session, out.tell(), 0))
+                pickle.dump(session, out, protocol=pickle.HIGHEST_PROTOCOL)
+                if isinstance(session, dict):
+                    entries[-1] = entries[-1]._replace(length=out.tell() - entries[-1].offset)
+        except:
+            # a damaged session: leave the file as it is rather than drop
+            # every session after it
+            out.close()
+            f.close()
+            os.remove(tmp_path)
+            raise
+        out.close()
+        f.close()
+        os.replace(tmp_path, self.path)
+        # if we die before this, sync() notices the index no longer matches
+        self._write_index(entries)
+        self._entries = entries
+        return old_size, os.path.getsize(self.path)
+
+    def iter_sessions(self, since=None, until=None, mode=None, n=None, manual=None,
+                      resolve=True):
+        '''Yield (index, session) for the sessions matching every given filter,
+        one at a time.  since and until are dates (both inclusive); mode and n
+        may be a single value or a collection of values.  The filters are
+        checked against the index, so sessions that do not match are never
+        read from disk.'''
+        start = since is not None and since.toordinal() * 86400 or None
+        stop = until is not None and (until.toordinal() + 1) * 86400 or None
+        if mode is not None and not isinstance(mode, (set, frozenset, list, tuple)):
+            mode = (mode,)
+        if n is not None and not isinstance(n, (set, frozenset, list, tuple)):
+            n = (n,)
+        entries = self.entries
+        f = open(self.path, 'rb')
+        try:
+            for i, entry in enumerate(entries):
+                if ((start is not None and entry.timestamp < start) or
+                        (stop is not None and entry.timestamp >= stop) or
+                        (mode is not None and entry.mode not in mode) or
+                        (n is not None and entry.n not in n) or
+                        (manual is not None and entry.manual != bool(manual))):
+                    continue
+                if f.tell() != entry.offset:
+                    f.seek(entry.offset)
+                session = pickle.loads(f.read(entry.length))
+                if resolve:
+                    session = self.resolve(session)
+                yield i, session
+        finally:
+            f.close()
+
+    def stream(self, resolve=True):
+        '''Yield every session in the data file in order, reading it from
+        start to end without the index, in constant memory.'''
+        f = open(self.path, 'rb')
+        try:
+            while True:
+                try:
+                    session = pickle.load(f)
+                except EOFError:
+                    return
+                except Exception:
+                    return  # a half-written last session
+                if isinstance(session, dict):
+                    if resolve:
+                        session = self.resolve(session)
+                    yield session
+        finally:
+            f.close()
+
+    def find(self, timestamp=None, mode=None, n=None):
+        '''Indices of the sessions matching all of the given keys.'''
+        return [i for i, entry in enumerate(self.entries)
+                if (timestamp is None or entry.timestamp == timestamp) and
+                   (mode is None or entry.mode == mode) and
+                   (n is None or entry.n == n)]
+
+# The SQLite stats backend keeps the same columns as a History in a table
+# 'sessions', with the mode name as text.  Rows are never updated or deleted
+# by the game, so the rowid order is the order the sessions were played in.
+# The two indices cover the queries the game makes: a mode's sessions since
+# some point in time, and a mode's sessions at one n-back level.
+STATS_DATABASE_SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    id INTEGER PRIMARY KEY,
+    %s
+);
+CREATE INDEX IF NOT EXISTS sessions_mode_date ON sessions (mode, ordinal, time);
+CREATE INDEX IF NOT EXISTS sessions_mode_back ON sessions (mode, back);
+''' % ',\n    '.join(['%s %s' % (name, name == 'modename' and 'TEXT' or
+                                    typecode == 'd' and 'REAL' or 'INTEGER')
+                     for name, typecode in HISTORY_COLUMNS])
+_COLUMN_NAMES = ', '.join([name for name, typecode in HISTORY_COLUMNS])
+
+class StatsDatabase:
+    '''Stats kept in an SQLite database rather than a text file.
+
+    Like ParsedStats, it keeps a History of every session (self.history),
+    which update() extends with the rows added since the last call.
+    indices() answers the game's per-mode queries from the database
+    indices instead of scanning that history.'''
+    def __init__(self, path):
+        import sqlite3
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(STATS_DATABASE_SCHEMA)
+        self.history = History()
+        self.ids = array('q') # database id of each row of self.history
+        self.quarantined = [] # malformed lines skipped by import_stats()
+
+    def close(self):
+        self.connection.close()
+
+    def __len__(self):
+        return self.connection.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+    def update(self):
+        '''Load the rows added since the last call.  Returns False if there
+        were none.'''
+        last = self.ids and self.ids[-1] or 0
+        rows = self.connection.execute(
+            'SELECT id, %s FROM sessions WHERE id > ? ORDER BY id' % _COLUMN_NAMES,
+            (last,)).fetchall()
+        if not rows:
+            return False
+        self.ids.extend([row[0] for row in rows])
+        self.history.extend([row[1:] for row in rows])
+        return True
+
+    def append(self, row):
+        '''Add one session (a row as returned by parse_line()) in a single
+        transaction.'''
+        self.extend([row])
+
+    def extend(self, rows):
+        with self.connection:
+            self._insert(rows)
+
+    def _insert(self, rows):
+        self.connection.executemany(
+            'INSERT INTO sessions (%s) VALUES (%s)' % (
+                _COLUMN_NAMES, ', '.join(['?'] * len(HISTORY_COLUMNS))),
+            rows)
+
+    def _index(self, id):
+        i = bisect.bisect_left(self.ids, id)
+        if i == len(self.ids) or self.ids[i] != id:
+            raise KeyError(id)
+        return i
+
+    def indices(self, mode=None, start=0, manual=None, limit=None):
+        '''Like History.indices(): the indices into self.history of the
+        sessions of one mode played no earlier than session start, oldest
+        first.  If limit is given only the last limit of them are returned.'''
+        if start >= len(self.history):
+            return []
+        where, args = [], []
+        if mode is not None:
+            where.append('mode = ?')
+            args.append(mode)
+        if start > 0:
+            # the date condition lets the (mode, ordinal, time) index do the work
+            where.append('(ordinal > ? OR (ordinal = ? AND time >= ?)) AND id >= ?')
+            ordinal, time = self.history.ordinal[start], self.history.time[start]
+            args.extend([ordinal, ordinal, time, self.ids[start]])
+        if manual is not None:
+            where.append('manual = ?')
+            args.append(int(bool(manual)))
+        query = 'SELECT id FROM sessions'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += ' ORDER BY ordinal DESC, time DESC, id DESC'
+        if limit is not None:
+            query += ' LIMIT %i' % limit
+        ids = [row[0] for row in self.connection.execute(query, args)]
+        ids.sort()
+        return [self._index(id) for id in ids if id <= self.ids[-1]]
+
+    def import_stats(self, stats_path, sessions_path=None):
+        '''Replace the contents of the database by the sessions in a stats
+        file, plus those in a USER-sessions.dat file that are missing from
+        it.  Returns the number of sessions imported.'''
+        rows, bad = [], []
+        schema = read_schema(stats_path)
+        f = open(stats_path, 'rb')
+        try:
+            for number, line in enumerate(f.read().decode('utf-8', 'replace').split('\n'), 1):
+                row, reason = parse_checked(line, schema)
+                if reason is not None:
+                    bad.append((number, reason, line.rstrip('\r')))
+                elif row is not None:
+                    rows.append(row)
+        finally:
+            f.close()
+        write_quarantine(stats_path + QUARANTINE_SUFFIX, bad)
+        self.quarantined.extend(bad)
+        if sessions_path is not None and os.path.exists(sessions_path):
+            known = set([row[:4] for row in rows])  # date, time, mode and n
+            for i, session in SessionArchive(sessions_path).iter_sessions(resolve=False):
+                try:
+                    row, reason = parse_checked(','.join([str(field) for field in session['summary']]))
+                except (KeyError, TypeError):
+                    continue
+                if row is not None and reason is None and row[:4] not in known:
+                    known.add(row[:4])
+                    rows.append(row)
+            rows.sort(key=lambda row: (row[0], row[1]))
+        with self.connection:
+            self.connection.execute('DELETE FROM sessions')
+            self._insert(rows)
+        self.history = History()
+        self.ids = array('q')
+        self.update()
+        return len(rows)
+
+    def export_stats(self, stats_path, separator=','):
+        '''Write the database out as a stats file.  Returns the number of
+        sessions written.'''
+        tmp_path = stats_path + '.tmp'
+        f = open(tmp_path, 'w')
+        count = 0
+        try:
+            f.write(stats_header() + '\n')
+            for row in self.connection.execute(
+                    'SELECT %s FROM sessions ORDER BY id' % _COLUMN_NAMES):
+                f.write(format_row(row, separator) + '\n')
+                count += 1
+        finally:
+            f.close()
+        os.replace(tmp_path, stats_path)
+        return count
+
+# StatsWriter moves the file writes at the end of a session off the UI thread.
+# Each session's writes form a batch, which is first saved to a journal
+# (written to a temporary file, synced and renamed over the journal), then
+# carried out, and then dropped from the journal.  A batch left in the journal
+# by a crash is carried out again the next time the game starts.
+#
+# The writes are appends, and carrying one out twice must not duplicate it:
+# complete_append() looks at the end of the file and only writes whatever
+# part of the data is not already there.
+def complete_append(path, data):
+    '''Append data to the file at path, unless the file already ends with it.
+    If the file ends with a leading part of data (an append that was cut
+    short), only the rest is written.'''
+    f = open(path, 'ab+')
+    try:
+        size = f.tell()
+        f.seek(max(0, size - len(data)))
+        tail = f.read()
+        written = 0
+        for k in range(min(len(tail), len(data)), 0, -1):
+            if tail.endswith(data[:k]):
+                written = k
+                break
+        if written < len(data):
+            f.seek(0, os.SEEK_END)
+            f.write(data[written:])
+            f.flush()
+            os.fsync(f.fileno())
+    finally:
+        f.close()
+
+def session_write(path, session):
+    '''The StatsWriter operation appending a session to a SessionArchive.'''
+    config, session = pack_session(session)
+    return ('session', path, config, pickle.dumps(session, protocol=pickle.HIGHEST_PROTOCOL))
+
+class StatsWriter:
+    '''Carries out batches of writes on a background thread, through a
+    journal.  A batch is a list of operations:
+
+      ('append', path, data)               append bytes to a file
+      ('session', path, config, data)      see session_write()
+    '''
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.queue = queue.Queue()
+        self.pending = []   # batches in the journal which were not carried out
+        self.error = None   # the last error, for the UI thread to report
+        self.thread = None
+        self.archives = {}
+
+    def replay(self):
+        '''Carry out the batches a previous run left in the journal.  Call
+        this before anything reads the files.  Returns the number of batches
+        replayed.'''
+        try:
+            f = open(self.journal_path, 'rb')
+        except (IOError, OSError):
+            return 0
+        try:
+            self.pending = pickle.load(f)
+        except Exception:
+            # the journal is replaced atomically, so this is not a batch we
+            # promised to write
+            self.pending = []
+        finally:
+            f.close()
+        replayed = len(self.pending)
+        self._flush()
+        if self.error is not None:
+            raise self.error
+        return replayed
+
+    def _write_journal(self):
+        if not self.pending:
+            try:
+                os.remove(self.journal_path)
+            except OSError:
+                pass
+            return
+        tmp_path = self.journal_path + '.tmp'
+        f = open(tmp_path, 'wb')
+        try:
+            pickle.dump(self.pending, f, protocol=pickle.HIGHEST_PROTOCOL)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.replace(tmp_path, self.journal_path)
+
+    def _archive(self, path):
+        if path not in self.archives:
+            self.archives[path] = SessionArchive(path)
+        return self.archives[path]
+
+    def _apply(self, operation):
+        if operation[0] == 'append':
+            complete_append(operation[1], operation[2])
+        elif operation[0] == 'session':
+            kind, path, config, data = operation
+            archive = self._archive(path)
+            if config is not None:
+                archive.configs.put(config)
+            complete_append(path, data)
+            archive.refresh()
+        else:
+            raise ValueError('unknown stats write %r' % (operation[0],))
+
+    def _flush(self):
+        try:
+            while self.pending:
+                for operation in self.pending[0]:
+                    self._apply(operation)
+                del self.pending[0]
+                # the journal never lists a batch that was carried out, or
+                # a crash before the next one would have it carried out twice
+                self._write_journal()
+            self._write_journal()  # a journal that could not be read
+            self.error = None
+        except Exception as e:
+            self.error = e  # the batch stays in the journal
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            try:
+                if batch is None:
+                    return
+                self.pending.append(batch)
+                try:
+                    self._write_journal()
+                except Exception as e:
+                    self.error = e
+                    continue  # keep it in memory; it goes out with the next batch
+                self._flush()
+            finally:
+                self.queue.task_done()
+
+    def submit(self, batch):
+        '''Queue a batch of writes and return at once.'''
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='StatsWriter')
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put(list(batch))
+
+    def flush(self):
+        '''Wait until every batch submitted so far has been carried out.'''
+        if self.thread is not None:
+            self.queue.join()
+
+    def close(self):
+        '''Finish the queued writes and stop the thread.'''
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+# Compaction moves old sessions out of the live stats file and sessions file
+# into per-year archive segments (FILE.archive/YYYY.gz).  New sessions are
+# added to a segment as one more gzip member, so segments are only appended
+# to.  The stats file also gets a summary (FILE.summary, JSON) of what was
+# archived, which is all the graph needs of the old sessions: per mode and
+# day the number of sessions, the sums of the n-back levels and the scores,
+# and the (n, score) pairs not beaten in both, from which the best score of
+# the day under any of the graph's styles follows; and per mode the last
+# GRAPH_TAIL scores of each modality.
+#
+# Each mode's latest sessions at its current n-back level stay in the live
+# file however old they are, so retrieve_progress() gives the same answer.
+ARCHIVE_SUFFIX   = '.archive'
+SUMMARY_SUFFIX   = '.summary'
+COMPACTED_SUFFIX = '.compacted'
+GRAPH_TAIL = 50
+
+def segment_path(path, year):
+    return os.path.join(path + ARCHIVE_SUFFIX, '%04i.gz' % year)
+
+def read_segment(path, year, size):
+    '''The contents of the archive segment of path for year, up to size bytes
+    of compressed data (anything beyond was never committed).'''
+    f = open(segment_path(path, year), 'rb')
+    try:
+        return gzip.decompress(f.read(size))
+    finally:
+        f.close()
+
+def _append_segment(path, year, size, data):
+    directory = path + ARCHIVE_SUFFIX
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    f = open(segment_path(path, year), 'ab')
+    try:
+        if f.tell() > size:
+            f.truncate(size)  # left over from an interrupted compaction
+        f.write(gzip.compress(data))
+        f.flush()
+        os.fsync(f.fileno())
+        return f.tell()
+    finally:
+        f.close()
+
+def _write_synced(path, data):
+    f = open(path, 'wb')
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+
+class StatsSummary:
+    '''The summary compaction keeps of the archived sessions of a stats file.'''
+    def __init__(self, path):
+        self.path = path
+        self.rollover_hour = 4
+        self.pending = False  # the live files were not replaced yet
+        self.archived = 0
+        self.segments = {}    # 'stats' and 'sessions': {year: committed size}
+        self.days = {}        # mode: {day ordinal: [count, sum_back, sum_percent, frontier]}
+        self.tails = {}       # mode: {modality: last GRAPH_TAIL scores}
+        try:
+            f = open(path, 'r')
+        except (IOError, OSError):
+            return
+        try:
+            state = json.load(f)
+        finally:
+            f.close()
+        self.rollover_hour = state['rollover_hour']
+        self.pending = state['pending']
+        self.archived = state['archived']
+        self.segments = dict([(kind, dict([(int(year), size) for year, size in sizes.items()]))
+                              for kind, sizes in state['segments'].items()])
+        self.days = dict([(int(m), dict([(int(day), summary) for day, summary in days.items()]))
+                          for m, days in state['days'].items()])
+        self.tails = dict([(int(m), tails) for m, tails in state['tails'].items()])
+
+    def save(self):
+        state = {'rollover_hour': self.rollover_hour,
+                 'pending':       self.pending,
+                 'archived':      self.archived,
+                 'segments':      self.segments,
+                 'days':          self.days,
+                 'tails':         self.tails}
+        _write_synced(self.path + '.tmp', json.dumps(state).encode('utf-8'))
+        os.replace(self.path + '.tmp', self.path)
+
+    def add(self, row):
+        '''Summarize one archived row (as returned by parse_line()).'''
+        self.archived += 1
+        if row[5]:
+            return  # the graph leaves out manual sessions
+        m, back, percent = row[2], row[3], row[4]
+        ordinal = row[0]
+        if row[1] < self.rollover_hour * 3600:
+            ordinal -= 1
+        day = self.days.setdefault(m, {}).setdefault(ordinal, [0, 0, 0, []])
+        day[0] += 1
+        day[1] += back
+        day[2] += percent
+        if not [1 for n, p in day[3] if n >= back and p >= percent]:
+            day[3] = [[n, p] for n, p in day[3] if n > back or p > percent] + [[back, percent]]
+        tails = self.tails.setdefault(m, {})
+        for k, column in enumerate(MODALITY_COLUMNS):
+            tail = tails.setdefault(column, [])
+            tail.append(row[8 + k])
+            del tail[:-GRAPH_TAIL]
+
+def finish_compaction(stats_path, sessions_path=None):
+    '''Complete a compaction that was interrupted after its summary was
+    committed; until then the live files would count twice.'''
+    summary = StatsSummary(stats_path + SUMMARY_SUFFIX)
+    if not summary.pending:
+        return summary
+    for path in (stats_path, sessions_path):
+        if path and os.path.exists(path + COMPACTED_SUFFIX):
+            os.replace(path + COMPACTED_SUFFIX, path)
+            if path == sessions_path and os.path.exists(path + SESSIONS_INDEX_SUFFIX):
+                os.remove(path + SESSIONS_INDEX_SUFFIX)  # rebuilt on the next sync()
+    summary.pending = False
+    summary.save()
+    return summary
+
+def compact_stats(stats_path, sessions_path, horizon, rollover_hour=4):
+    '''Move the sessions played before horizon (a timestamp, as returned by
+    local_timestamp()) from the stats file and the sessions file into their
+    archive segments.  Returns the number of stats rows and of sessions
+    archived.
+
+    The new live files are written next to the old ones first, then the
+    segments are appended to and the summary is saved with pending set, and
+    only then are the live files replaced; finish_compaction() redoes that
+    last step if it was interrupted.'''
+    summary = finish_compaction(stats_path, sessions_path)
+    summary.rollover_hour = rollover_hour
+    for path in (stats_path, sessions_path):
+        if path and os.path.exists(path + COMPACTED_SUFFIX):
+            os.remove(path + COMPACTED_SUFFIX)  # from a run that never committed
+
+    f = open(stats_path, 'rb')
+    try:
+        lines = f.read().split(b'\n')
+    finally:
+        f.close()
+    schema = lines and parse_header(lines[0].decode('utf-8', 'replace'))
+    rows = []
+    for k, line in enumerate(lines):
+        try:
+            row = parse_line(line.decode('utf-8', 'replace'), schema)
+        except (ValueError, IndexError):
+            row = None  # left in the live file for the user to look at
+        if row is not None:
+            rows.append((k, row))
+
+    # each mode's trailing run of sessions at one level stays live
+    kept, levels, done = set(), {}, set()
+    for k, row in reversed(rows):
+        if row[2] in done:
+            continue
+        if levels.setdefault(row[2], row[3]) == row[3]:
+            kept.add(k)
+        else:
+            done.add(row[2])
+    archived = [(k, row) for k, row in rows
+                if k not in kept and row[0] * 86400 + row[1] < horizon]
+    archived_lines = set([k for k, row in archived])
+    stats_segments = {}
+    for k, row in archived:
+        year = date.fromordinal(row[0]).year
+        if year not in stats_segments:
+            stats_segments[year] = []
+            if schema and not summary.segments.get('stats', {}).get(year):
+                # a new segment needs the header to be read on its own
+                stats_segments[year].append(lines[0] + b'\n')
+        stats_segments[year].append(lines[k] + b'\n')
+        summary.add(row)
+
+    session_segments = {}
+    live_sessions = []
+    if sessions_path and os.path.exists(sessions_path):
+        archive = SessionArchive(sessions_path)
+        f = open(sessions_path, 'rb')
+        try:
+            for entry in archive.sync():
+                f.seek(entry.offset)
+                data = f.read(entry.length)
+                if 0 < entry.timestamp < horizon:
+                    year = date.fromordinal(entry.timestamp // 86400).year
+                    session_segments.setdefault(year, []).append(data)
+                else:
+                    live_sessions.append(data)
+        finally:
+            f.close()
+    if not archived and not session_segments:
+        return 0, 0
+
+    _write_synced(stats_path + COMPACTED_SUFFIX,
+                  b'\n'.join([line for k, line in enumerate(lines) if k not in archived_lines]))
+    if session_segments:
+        _write_synced(sessions_path + COMPACTED_SUFFIX, b''.join(live_sessions))
+    for kind, path, segments in (('stats', stats_path, stats_segments),
+                                 ('sessions', sessions_path, session_segments)):
+        sizes = summary.segments.setdefault(kind, {})
+        for year in sorted(segments):
+            sizes[year] = _append_segment(path, year, sizes.get(year, 0), b''.join(segments[year]))
+    summary.pending = True
+    summary.save()
+    finish_compaction(stats_path, sessions_path)
+    return len(archived), sum([len(sessions) for sessions in session_segments.values()])
+
+# In clinical mode every session is also appended to a log (logfile.dat) as a
+# pickle.  Each record is a dictionary {'prev': hash, 'row': row}, where hash
+# is the SHA-256 of the previous record as stored (or of nothing, for the
+# first record of the file), so that changing, removing or inserting a record
+# breaks the chain after it.  Records written by older versions are plain
+# lists; they can only come before the first chained record, which covers the
+# last of them.
+#
+# What has been verified is remembered in FILE.verified: the offset up to
+# which the chain holds and where the last record starts.  Verifying again
+# checks that this last record is unchanged and then reads only the records
+# appended since.
+VERIFIED_SUFFIX = '.verified'
+
+def record_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+class ClinicalLog:
+    '''The hash-chained session log of clinical mode.'''
+    def __init__(self, path):
+        self.path = path
+        self.checkpoint_path = path + VERIFIED_SUFFIX
+        self.offset = 0       # end of the verified records
+        self.last_start = 0   # where the last verified record starts
+        self.last = None      # hash of the last record, None if unknown
+        self.records = 0
+        self.chained = False  # whether a chained record was seen
+        self.problems = []    # (record number, offset, reason)
+
+    def _load_checkpoint(self):
+        try:
+            f = open(self.checkpoint_path, 'r')
+        except (IOError, OSError):
+            return False
+        try:
+            state = json.load(f)
+        except ValueError:
+            return False
+        finally:
+            f.close()
+        self.offset = state['offset']
+        self.last_start = state['last_start']
+        self.last = state['last']
+        self.records = state['records']
+        self.chained = state['chained']
+        return True
+
+    def _save_checkpoint(self):
+        state = {'offset':     self.offset,
+                 'last_start': self.last_start,
+                 'last':       self.last,
+                 'records':    self.records,
+                 'chained':    self.chained}
+        _write_synced(self.checkpoint_path + '.tmp', json.dumps(state).encode('utf-8'))
+        os.replace(self.checkpoint_path + '.tmp', self.checkpoint_path)
+
+    def _reset(self):
+        self.offset = self.last_start = self.records = 0
+        self.last = record_hash(b'')
+        self.chained = False
+
+    def verify(self, full=False):
+        '''Check the chain, from the last checkpoint on unless full is set,
+        up to the end of the file.  Returns the problems found, as (record
+        number, offset, reason).  The checkpoint only moves up to the first
+        problem, so problems are reported again until the log is repaired.'''
+        self.problems = []
+        try:
+            f = open(self.path, 'rb')
+        except (IOError, OSError):
+            self._reset()
+            return self.problems
+        try:
+            size = os.fstat(f.fileno()).st_size
+            if full or not self._load_checkpoint():
+                self._reset()
+            elif self.offset > size:
+                self.problems.append((self.records, size, 'log is shorter than when it was last verified'))
+                self._reset()
+            elif self.offset > 0:
+                f.seek(self.last_start)
+                if record_hash(f.read(self.offset - self.last_start)) != self.last:
+                    self.problems.append((self.records - 1, self.last_start,
+                                          'record was changed after it was verified'))
+                    self._reset()
+            f.seek(self.offset)
+            checkpoint = not self.problems
+            while self.offset < size:
+                start = f.tell()
+                try:
+                    record = pickle.load(f)
+                except Exception:
+                    self.problems.append((self.records, start, 'unreadable record'))
+                    break
+                end = f.tell()
+                problem = None
+                if isinstance(record, dict) and 'prev' in record:
+                    if record['prev'] != self.last:
+                        problem = 'chain is broken'
+                    self.chained = True
+                elif self.chained:
+                    problem = 'unchained record after chained ones'
+                if problem is not None:
+                    # carry on from this record, so that every break is
+                    # reported and new records chain to the real last one
+                    if checkpoint:
+                        self._save_checkpoint()
+                        checkpoint = False
+                    self.problems.append((self.records, start, problem))
+                f.seek(start)
+                self.last = record_hash(f.read(end - start))
+                self.last_start, self.offset = start, end
+                self.records += 1
+        finally:
+            f.close()
+        if checkpoint:
+            self._save_checkpoint()
+        return self.problems
+
+    def record(self, row):
+        '''The bytes to append to the log for a session's row.  The log must
+        not be written to by anyone else in the meantime.'''
+        if self.last is None:
+            self.verify()
+        data = pickle.dumps({'prev': self.last, 'row': row}, protocol=2)
+        self.last = record_hash(data)
+        return data
+
+def iter_log(path):
+    '''Yield the rows of a clinical log, chained or not.'''
+    f = open(path, 'rb')
+    try:
+        while True:
+            try:
+                record = pickle.load(f)
+            except EOFError:
+                return
+            if isinstance(record, dict) and 'row' in record:
+                record = record['row']
+            yield record
+    finally:
+        f.close()
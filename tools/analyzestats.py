@@ -0,0 +1,294 @@
+#!/usr/bin/env python
+#
+# analyzestats.py: summarize the training of every Brain Workshop user in a
+# data directory: sessions, time trained, n-back level over time and the
+# score in each modality, per user and for all users together.
+#
+# Usage: analyzestats.py [--jobs N] [--cache FILE] [--json] DATA_DIR
+#
+# Users are found like the game finds them, from their stats files.  Each
+# user is summarized in a worker process, from the stats file, the summary
+# of sessions moved out by compactstats.py and USER-sessions.dat (for the
+# reaction times).  Summaries are cached (by default in
+# DATA_DIR/analytics-cache.json) and only redone for users whose files
+# changed since.
+#
+# Sessions moved out by compactstats.py count towards the sessions, days and
+# n-back levels; the time trained, scores and reaction times are those of
+# the sessions still in the live files.
+#
+# The score of a modality is averaged over the sessions where it is not 0,
+# since the stats file has 0 both for a modality that was not played and
+# for one where nothing was right.
+#
+
+import os, sys, json, optparse
+from datetime import date
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bwstats
+
+CACHE_VERSION = 1
+ROLLOVER_HOUR = 4
+
+def find_users(data_dir):
+    '''{user: (stats file, sessions file)}, like get_users() in the game.'''
+    users = {}
+    for fn in sorted(os.listdir(data_dir)):
+        if fn == 'stats.txt':
+            user = 'default'
+        elif fn.endswith('-stats.txt') and fn != 'Readme-stats.txt':
+            user = fn[:-len('-stats.txt')]
+        else:
+            continue
+        users[user] = (os.path.join(data_dir, fn),
+                       os.path.join(data_dir, user + '-sessions.dat'))
+    return users
+
+def user_files(stats_path, sessions_path):
+    return [stats_path, stats_path + bwstats.SUMMARY_SUFFIX, sessions_path]
+
+def files_key(paths):
+    '''What the cache entry of a user is valid for: the size and mtime of
+    each of the user's files (None for a missing file).'''
+    key = []
+    for path in paths:
+        try:
+            st = os.stat(path)
+            key.append([os.path.basename(path), st.st_size, st.st_mtime])
+        except OSError:
+            key.append([os.path.basename(path), None, None])
+    return key
+
+def load_history(path):
+    '''The sessions in a stats file, skipping malformed lines.'''
+    history = bwstats.History()
+    rows = []
+    bad = 0
+    f = open(path, 'rb')
+    try:
+        for line in f:
+            row, reason = bwstats.parse_checked(line.decode('utf-8', 'replace'))
+            if reason is not None:
+                bad += 1
+            elif row is not None:
+                rows.append(row)
+                if len(rows) >= 10000:
+                    history.extend(rows)
+                    rows = []
+    finally:
+        f.close()
+    history.extend(rows)
+    return history, bad
+
+def add_mean(means, name, value):
+    total = means.setdefault(name, [0, 0])
+    total[0] += 1
+    total[1] += value
+
+def summarize(user, stats_path, sessions_path):
+    '''Summary of one user, as a dictionary that can be stored as JSON.
+    Means are kept as [count, sum] so that summaries can be added up.'''
+    history, malformed = load_history(stats_path)
+    summary = {'user': user, 'sessions': len(history), 'archived': 0,
+               'malformed': malformed, 'manual': 0, 'seconds': 0, 'days': 0,
+               'first': None, 'last': None, 'modes': {}, 'scores': {},
+               'reaction_times': {}, 'recorded': 0}
+    days = set()
+    monthly = {}  # mode: {'YYYY-MM': [count, sum of n]}
+    modes = summary['modes']
+    for i in range(len(history)):
+        m = str(history.mode[i])
+        back = history.back[i]
+        day = history.day(i, ROLLOVER_HOUR)
+        days.add(day)
+        if history.sesstime[i]:
+            summary['seconds'] += history.sesstime[i]
+        else:
+            # older versions did not record it
+            summary['seconds'] += history.ticks[i] * 0.1 * history.trials[i]
+        if history.manual[i]:
+            summary['manual'] += 1
+            continue  # the level of a manual session is not a result
+        if m not in modes:
+            modes[m] = {'sessions': 0, 'first_n': back, 'last_n': back, 'max_n': back}
+        stats = modes[m]
+        stats['sessions'] += 1
+        stats['last_n'] = back
+        stats['max_n'] = max(stats['max_n'], back)
+        add_mean(monthly.setdefault(m, {}), date.fromordinal(day).strftime('%Y-%m'), back)
+        for modality in bwstats.MODALITY_COLUMNS:
+            percent = history.column(modality)[i]
+            if percent:
+                add_mean(summary['scores'], modality, percent)
+
+    # sessions moved out to the archive only survive as per-day summaries
+    archive_summary = bwstats.StatsSummary(stats_path + bwstats.SUMMARY_SUFFIX)
+    summary['archived'] = archive_summary.archived
+    for m, per_day in archive_summary.days.items():
+        m = str(m)
+        for day, (count, sum_back, sum_percent, frontier) in per_day.items():
+            days.add(day)
+            total = monthly.setdefault(m, {}).setdefault(date.fromordinal(day).strftime('%Y-%m'), [0, 0])
+            total[0] += count
+            total[1] += sum_back
+    for m, months in monthly.items():
+        stats = modes.setdefault(m, {'sessions': 0, 'first_n': None, 'last_n': None, 'max_n': None})
+        stats['monthly'] = [[month, round(float(total) / count, 2)]
+                            for month, (count, total) in sorted(months.items())]
+
+    if days:
+        summary['days'] = len(days)
+        summary['first'] = date.fromordinal(min(days)).isoformat()
+        summary['last'] = date.fromordinal(max(days)).isoformat()
+
+    if os.path.exists(sessions_path):
+        for session in bwstats.SessionArchive(sessions_path).stream(resolve=False):
+            if 'session_z' in session:
+                trials = bwstats.unpack_trials(session['session_z'])
+            else:
+                trials = session.get('session') or {}
+            summary['recorded'] += 1
+            for name, values in trials.items():
+                if name.endswith('_rt'):
+                    for rt in values:
+                        if rt > 0:
+                            add_mean(summary['reaction_times'], name[:-3], rt)
+    return summary
+
+def summarize_task(task):
+    user, stats_path, sessions_path = task
+    try:
+        return user, summarize(user, stats_path, sessions_path), None
+    except Exception as e:
+        return user, None, '%s: %s' % (e.__class__.__name__, e)
+
+def combine(summaries):
+    '''The summary of all users together.'''
+    total = {'users': len(summaries), 'sessions': 0, 'archived': 0, 'manual': 0,
+             'seconds': 0, 'days': 0, 'recorded': 0, 'scores': {}, 'reaction_times': {},
+             'max_n': {}}
+    for summary in summaries:
+        for name in ('sessions', 'archived', 'manual', 'seconds', 'days', 'recorded'):
+            total[name] += summary[name]
+        for name in ('scores', 'reaction_times'):
+            for modality, (count, value) in summary[name].items():
+                mean = total[name].setdefault(modality, [0, 0])
+                mean[0] += count
+                mean[1] += value
+        # how many users reached each level, per mode
+        for m, stats in summary['modes'].items():
+            if stats['max_n'] is not None:
+                reached = total['max_n'].setdefault(m, {})
+                reached[stats['max_n']] = reached.get(stats['max_n'], 0) + 1
+    return total
+
+def load_cache(path):
+    try:
+        f = open(path, 'r')
+    except (IOError, OSError):
+        return {}
+    try:
+        cache = json.load(f)
+    except ValueError:
+        return {}
+    finally:
+        f.close()
+    if cache.get('version') != CACHE_VERSION:
+        return {}
+    return cache.get('users', {})
+
+def save_cache(path, users):
+    f = open(path + '.tmp', 'w')
+    try:
+        json.dump({'version': CACHE_VERSION, 'users': users}, f)
+    finally:
+        f.close()
+    os.replace(path + '.tmp', path)
+
+def means(totals, digits=1):
+    return ', '.join(['%s %s' % (name, round(float(value) / count, digits))
+                      for name, (count, value) in sorted(totals.items())]) or '-'
+
+def hours(seconds):
+    return '%.1f h' % (seconds / 3600.0)
+
+def print_summary(summary):
+    print('%s: %i sessions (%i archived, %i manual) on %i days, %s to %s, %s' % (
+        summary['user'], summary['sessions'] + summary['archived'], summary['archived'],
+        summary['manual'], summary['days'], summary['first'], summary['last'],
+        hours(summary['seconds'])))
+    if summary['malformed']:
+        print('  %i malformed lines skipped' % summary['malformed'])
+    for m, stats in sorted(summary['modes'].items(), key=lambda item: int(item[0])):
+        monthly = stats.get('monthly', [])
+        print('  mode %s: %i sessions, n %s -> %s (max %s); by month: %s' % (
+            m, stats['sessions'], stats['first_n'], stats['last_n'], stats['max_n'],
+            ' '.join(['%s:%s' % (month, back) for month, back in monthly[-12:]])))
+    print('  scores: %s' % means(summary['scores']))
+    if summary['recorded']:
+        print('  reaction times (%i recorded sessions): %s' % (
+            summary['recorded'], means(summary['reaction_times'], 3)))
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [--jobs N] [--cache FILE] [--json] DATA_DIR')
+    parser.add_option('--jobs', type='int', default=0,
+                      help='worker processes, 0 for one per CPU [default: %default]')
+    parser.add_option('--cache', metavar='FILE',
+                      help='cache file [default: DATA_DIR/analytics-cache.json]')
+    parser.add_option('--no-cache', action='store_true',
+                      help='summarize every user again')
+    parser.add_option('--json', action='store_true',
+                      help='print the summaries as JSON')
+    options, args = parser.parse_args()
+    if len(args) != 1 or not os.path.isdir(args[0]):
+        parser.error('expected a data directory')
+    data_dir = args[0]
+    cache_path = options.cache or os.path.join(data_dir, 'analytics-cache.json')
+    cache = not options.no_cache and load_cache(cache_path) or {}
+
+    users = find_users(data_dir)
+    keys = dict([(user, files_key(user_files(*paths))) for user, paths in users.items()])
+    tasks = [(user, paths[0], paths[1]) for user, paths in sorted(users.items())
+             if user not in cache or cache[user]['key'] != keys[user]]
+    if options.jobs == 1 or len(tasks) < 2:
+        results = list(map(summarize_task, tasks))
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(options.jobs or None)
+        try:
+            results = list(executor.map(summarize_task, tasks))
+        finally:
+            executor.shutdown()
+    failed = False
+    for user, summary, error in results:
+        if error is not None:
+            sys.stderr.write('%s: %s\n' % (user, error))
+            cache.pop(user, None)
+            failed = True
+        else:
+            cache[user] = {'key': keys[user], 'summary': summary}
+    for user in list(cache):
+        if user not in users:
+            del cache[user]  # profile was deleted
+    try:
+        save_cache(cache_path, cache)
+    except (IOError, OSError) as e:
+        sys.stderr.write('cannot write %s: %s\n' % (cache_path, e))
+
+    summaries = [cache[user]['summary'] for user in sorted(cache)]
+    total = combine(summaries)
+    if options.json:
+        print(json.dumps({'users': summaries, 'total': total}, indent=1))
+    else:
+        for summary in summaries:
+            print_summary(summary)
+        print('all %i users: %i sessions (%i archived), %s; %i of %i users redone' % (
+            total['users'], total['sessions'] + total['archived'], total['archived'],
+            hours(total['seconds']), len(tasks), len(users)))
+        print('  scores: %s' % means(total['scores']))
+        if total['recorded']:
+            print('  reaction times: %s' % means(total['reaction_times'], 3))
+        for m, reached in sorted(total['max_n'].items(), key=lambda item: int(item[0])):
+            print('  mode %s, users by highest n: %s' % (
+                m, ' '.join(['%s:%i' % (n, count) for n, count in sorted(reached.items())])))
+    sys.exit(failed and 1 or 0)
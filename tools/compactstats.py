@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+#
+# compactstats.py: move old sessions out of a Brain Workshop stats file and
+# sessions file into compressed per-year archive segments, keeping a per-day
+# summary for the graph.  Run it while Brain Workshop is not running.
+#
+# Usage: compactstats.py [--days DAYS] [--rollover-hour HOUR] STATSFILE [USER-sessions.dat]
+#   compactstats.py --days 365 data/stats.txt data/default-sessions.dat
+#
+
+import os, sys, optparse, datetime
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bwstats
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] STATSFILE [USER-sessions.dat]')
+    parser.add_option('--days', type='int', default=365,
+                      help='archive sessions older than this many days [default: %default]')
+    parser.add_option('--rollover-hour', type='int', default=4,
+                      help='ROLLOVER_HOUR from the config file [default: %default]')
+    options, args = parser.parse_args()
+    if len(args) not in (1, 2):
+        parser.error('expected a stats file and optionally a sessions file')
+    stats_path = args[0]
+    sessions_path = len(args) == 2 and args[1] or None
+
+    # writes a session was ended with, if the game did not get to finish them
+    journal = os.path.join(os.path.dirname(os.path.abspath(stats_path)), 'stats-journal.dat')
+    bwstats.StatsWriter(journal).replay()
+
+    horizon = bwstats.local_timestamp(datetime.datetime.today()) - options.days * 86400
+    rows, sessions = bwstats.compact_stats(stats_path, sessions_path, horizon,
+                                           options.rollover_hour)
+    print('%s: archived %i sessions' % (stats_path, rows))
+    if sessions_path:
+        print('%s: archived %i sessions' % (sessions_path, sessions))
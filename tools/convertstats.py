@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+#
+# convertstats.py: convert a Brain Workshop stats file to the binary column
+# format and back.  The direction is picked from the input file.
+#
+# Usage: convertstats.py [--jobs N] INPUT OUTPUT
+#   convertstats.py stats.txt stats.columns
+#   convertstats.py stats.columns stats.txt
+#
+# --jobs parses a large stats file with N worker processes (0: one per CPU).
+#
+
+import os, sys, optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bwstats
+
+def is_column_file(path):
+    f = open(path, 'rb')
+    try:
+        return f.read(len(bwstats.COLUMNS_MAGIC)) == bwstats.COLUMNS_MAGIC
+    finally:
+        f.close()
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [--jobs N] INPUT OUTPUT')
+    parser.add_option('--jobs', type='int', default=1,
+                      help='worker processes for parsing a stats file, 0 for one per CPU [default: %default]')
+    options, args = parser.parse_args()
+    if len(args) != 2:
+        parser.error('expected an input and an output file')
+    source, target = args
+    quarantined = []
+    if is_column_file(source):
+        rows = bwstats.columns_to_stats(source, target)
+    else:
+        rows = bwstats.stats_to_columns(source, target, options.jobs or None, quarantined)
+    print('%s -> %s: %i sessions' % (source, target, rows))
+    if quarantined:
+        print('  %i malformed lines skipped, see %s' % (len(quarantined),
+                                                        source + bwstats.QUARANTINE_SUFFIX))
@@ -1,4 +1,181 @@
-#!/usr/bin/env python
-# 
-# dat2txt.py: convert Brain Workshop binary logfile into text format.
-#
+#!/usr/bin/env python
+#
+# dat2txt.py: convert Brain Workshop binary logfile into text format.
+#
+# Converts clinical mode logs (logfile.dat, USER-logfile.dat) and per-trial
+# session files (USER-sessions.dat) to CSV or JSON Lines.  Files are read as
+# a stream, one session at a time, and several files are converted at once
+# by a pool of worker processes.  Directories are searched for such files.
+#
+# Usage: dat2txt.py [--format csv|jsonl] [--jobs N] [--output-dir DIR] FILE_OR_DATA_DIR...
+#   dat2txt.py data/logfile.dat
+#   dat2txt.py --format jsonl --output-dir export/ data/
+#
+# Each FILE becomes FILE.csv or FILE.jsonl (in DIR, if given).  Logs give
+# one line per session, with the columns of a stats file.  Session files
+# give one line per trial in CSV and one line per session in JSON Lines;
+# the configuration a session was played with is left out unless
+# --config is given.
+#
+
+import os, sys, csv, json, pickle, optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bwstats
+
+# the columns of a log row; see data/Readme-stats.txt
+LOG_COLUMNS = ['timestamp', 'mode_name', 'percent', 'mode', 'n', 'ticks_per_trial',
+               'trials', 'manual', 'session_number', 'position1', 'audio', 'color',
+               'visvis', 'audiovis', 'arithmetic', 'image', 'visaudio', 'audio2',
+               'position2', 'position3', 'position4', 'vis1', 'vis2', 'vis3', 'vis4']
+
+# the per-trial lists of a session (see Stats.initialize_session)
+TRIAL_COLUMNS = []
+for name in ('position1', 'position2', 'position3', 'position4',
+             'vis1', 'vis2', 'vis3', 'vis4', 'color', 'image', 'audio', 'audio2'):
+    TRIAL_COLUMNS.extend([name, name + '_input', name + '_rt'])
+TRIAL_COLUMNS.extend(['vis', 'numbers', 'operation', 'visvis_input', 'visaudio_input',
+                      'audiovis_input', 'arithmetic_input', 'visvis_rt', 'visaudio_rt',
+                      'audiovis_rt'])
+# the answer key, in sessions recorded since it is saved (empty otherwise)
+TRIAL_COLUMNS.extend([name + '_match' for name in
+                      ('position1', 'position2', 'position3', 'position4', 'vis1', 'vis2',
+                       'vis3', 'vis4', 'color', 'visvis', 'visaudio', 'audiovis', 'image',
+                       'audio', 'audio2')] + ['arithmetic_answer'])
+SESSION_COLUMNS = ['timestamp', 'mode', 'n', 'manual', 'trial'] + TRIAL_COLUMNS
+
+def file_kind(path):
+    ''''log' or 'sessions', from the first record of the file.'''
+    f = open(path, 'rb')
+    try:
+        record = pickle.load(f)
+    except Exception:
+        record = None
+    finally:
+        f.close()
+    if isinstance(record, dict) and 'row' not in record:
+        return 'sessions'
+    return 'log'
+
+def text(value):
+    if isinstance(value, bool):
+        return int(value)
+    return value
+
+def cell(values, trial):
+    if trial < len(values):
+        return text(values[trial])
+    return ''
+
+def convert_log(path, out, format):
+    count = 0
+    writer = format == 'csv' and csv.writer(out) or None
+    if writer:
+        writer.writerow(LOG_COLUMNS)
+    for row in bwstats.iter_log(path):
+        if writer:
+            writer.writerow([text(value) for value in row])
+        else:
+            out.write(json.dumps(dict(zip(LOG_COLUMNS, row)), default=str) + '\n')
+        count += 1
+    return count
+
+def convert_sessions(path, out, format, config=False):
+    count = 0
+    writer = format == 'csv' and csv.writer(out) or None
+    if writer:
+        writer.writerow(SESSION_COLUMNS)
+    archive = bwstats.SessionArchive(path)
+    for session in archive.stream(resolve=False):
+        if config and 'cfg_ref' in session:
+            session['cfg'] = archive.configs.get(session.pop('cfg_ref'))
+        elif not config:
+            session.pop('cfg', None)
+            session.pop('cfg_ref', None)
+        if 'session_z' in session:
+            session['session'] = bwstats.unpack_trials(session.pop('session_z'))
+        if writer:
+            trials = session.get('session') or {}
+            key = [session.get('timestamp'), session.get('mode'), session.get('n'),
+                   int(bool(session.get('manual')))]
+            for trial in range(max([len(values) for values in trials.values()] + [0])):
+                writer.writerow(key + [trial + 1] +
+                                [cell(trials.get(name, ()), trial) for name in TRIAL_COLUMNS])
+        else:
+            out.write(json.dumps(session, default=str) + '\n')
+        count += 1
+    return count
+
+def convert(task):
+    '''Convert one file; returns (input, output, sessions, error).'''
+    path, output_path, format, config = task
+    try:
+        out = open(output_path + '.tmp', 'w', newline='')
+        try:
+            if file_kind(path) == 'sessions':
+                count = convert_sessions(path, out, format, config)
+            else:
+                count = convert_log(path, out, format)
+        finally:
+            out.close()
+        os.replace(output_path + '.tmp', output_path)
+    except Exception as e:
+        # one bad file should not stop the others
+        try:
+            os.remove(output_path + '.tmp')
+        except OSError:
+            pass
+        return path, output_path, 0, e
+    return path, output_path, count, None
+
+def input_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for fn in sorted(os.listdir(path)):
+                if fn.endswith('logfile.dat') or fn.endswith('-sessions.dat'):
+                    yield os.path.join(path, fn)
+        else:
+            yield path
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(
+        usage='%prog [--format csv|jsonl] [--jobs N] [--output-dir DIR] FILE_OR_DATA_DIR...')
+    parser.add_option('--format', choices=('csv', 'jsonl'), default='csv',
+                      help='csv or jsonl [default: %default]')
+    parser.add_option('--jobs', type='int', default=0,
+                      help='files to convert at once, 0 for one per CPU [default: %default]')
+    parser.add_option('--output-dir', metavar='DIR',
+                      help='where to write the converted files [default: next to each file]')
+    parser.add_option('--config', action='store_true',
+                      help='include the configuration of each session (jsonl only)')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('expected a file or data directory')
+    tasks = []
+    for path in input_files(args):
+        output_path = path + '.' + options.format
+        if options.output_dir:
+            output_path = os.path.join(options.output_dir, os.path.basename(output_path))
+        tasks.append((path, output_path, options.format,
+                      options.config and options.format == 'jsonl'))
+    if options.output_dir and not os.path.isdir(options.output_dir):
+        os.makedirs(options.output_dir)
+
+    if options.jobs == 1 or len(tasks) < 2:
+        results = map(convert, tasks)
+        executor = None
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        executor = ProcessPoolExecutor(options.jobs or None)
+        results = executor.map(convert, tasks)
+    failed = False
+    try:
+        for path, output_path, count, error in results:
+            if error is not None:
+                sys.stderr.write('%s: %s\n' % (path, error))
+                failed = True
+            else:
+                print('%s -> %s: %i sessions' % (path, output_path, count))
+    finally:
+        if executor is not None:
+            executor.shutdown()
+    sys.exit(failed and 1 or 0)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+#
+# genhistory.py: write a synthetic Brain Workshop history, for timing the
+# stats code on histories of any size.  The stats file (and the sessions
+# file, if one is given) are valid input for the game and the other tools,
+# and the same seed and options always give the same files.
+#
+# Usage: genhistory.py [options] STATSFILE [USER-sessions.dat]
+#   genhistory.py --sessions 1000000 --days 3650 big-stats.txt
+#   genhistory.py --modes 2:8,3:1,130:1 --seed 7 stats.txt default-sessions.dat
+#
+# The n-back level of each mode follows the game's rules: up a level at
+# THRESHOLD_ADVANCE percent, down after THRESHOLD_FALLBACK_SESSIONS sessions
+# in a row under THRESHOLD_FALLBACK, with scores drawn around a skill that
+# improves ever more slowly towards --max-n.
+#
+# With a sessions file, every session is played on the game's rules
+# (bwengine.py) by a simulated player whose hit rate is the drawn score, and
+# the stats file gets the scores of those sessions, so the two files agree
+# and the sessions can be replayed with replay.py.  Playing the sessions
+# makes writing a sessions file some hundred times slower per session than
+# writing a stats file alone.
+#
+
+import os, sys, optparse, random, pickle, datetime
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bwstats
+import bwengine
+
+THRESHOLD_ADVANCE = 80
+THRESHOLD_FALLBACK = 50
+THRESHOLD_FALLBACK_SESSIONS = 3
+
+def parse_modes(string):
+    '''"2:8,3:1" -> ([2, 3], [8.0, 1.0])'''
+    modes, weights = [], []
+    for item in string.split(','):
+        m, weight = (item.split(':') + ['1'])[:2]
+        m = int(m)
+        if m not in bwengine.MODALITIES:
+            raise ValueError('mode %i is not supported' % m)
+        modes.append(m)
+        weights.append(float(weight))
+    return modes, weights
+
+class Trajectory:
+    '''The n-back level and skill of one mode over time.'''
+    def __init__(self, rng, back, learning_rate, max_n):
+        self.rng = rng
+        self.back = back
+        self.skill = back + rng.random()
+        self.learning_rate = learning_rate
+        self.max_n = max(max_n, self.skill)
+        self.fallbacks = 0
+        self.session_number = 0
+
+    def draw(self):
+        '''A score for the next session.'''
+        return int(max(0, min(100, self.rng.gauss(75 + 20 * (self.skill - self.back), 10))))
+
+    def play(self, percent):
+        '''Move on after a session scored percent.'''
+        # gains get smaller towards max_n
+        self.skill += self.learning_rate * self.rng.random() * (self.max_n - self.skill) / self.max_n
+        if percent >= THRESHOLD_ADVANCE:
+            self.back += 1
+            self.fallbacks = 0
+        elif percent < THRESHOLD_FALLBACK and self.back > 1:
+            self.fallbacks += 1
+            if self.fallbacks >= THRESHOLD_FALLBACK_SESSIONS:
+                self.back -= 1
+                self.fallbacks = 0
+        else:
+            self.fallbacks = 0
+
+def generate(rng, options):
+    '''Yield (timestamp, mode, trajectory, session number) in time order;
+    the timestamp is a string as in the stats file.  The caller plays the
+    session and passes its score to trajectory.play().'''
+    modes, weights = parse_modes(options.modes)
+    cum_weights = [sum(weights[:i + 1]) for i in range(len(weights))]
+    trajectories = dict([(m, Trajectory(rng, options.start_n, options.learning_rate, options.max_n)) for m in modes])
+    start = datetime.datetime.strptime(options.start, '%Y-%m-%d').date()
+    per_day = float(options.sessions) / options.days
+    generated = 0
+    for day in range(options.days):
+        count = int(per_day * (day + 1)) - int(per_day * day)
+        if day == options.days - 1:
+            count = options.sessions - generated
+        if not count:
+            continue
+        for trajectory in trajectories.values():
+            trajectory.session_number = 0
+        spacing = min(90.0, 16 * 3600.0 / count)
+        today = (start + datetime.timedelta(days=day)).strftime('%Y-%m-%d')
+        for k in range(count):
+            m = len(modes) == 1 and modes[0] or rng.choices(modes, cum_weights=cum_weights)[0]
+            trajectory = trajectories[m]
+            trajectory.session_number += 1
+            seconds = 8 * 3600 + int(k * spacing)
+            timestamp = '%s %02i:%02i:%02i' % (today, seconds // 3600, seconds // 60 % 60, seconds % 60)
+            yield timestamp, m, trajectory, trajectory.session_number
+        generated += count
+
+def drawn_categories(rng, m, percent):
+    '''Per-modality scores around percent, for a session that is not played.'''
+    categories = dict([(modality, 0) for modality in bwstats.MODALITY_COLUMNS])
+    for modality in bwengine.MODALITIES[m]:
+        categories[modality] = max(0, min(100, percent + int(rng.gauss(0, 8))))
+    return categories
+
+def stats_line(cfg, timestamp, m, back, percent, categories, session_number, manual):
+    '''A stats line like Stats.submit_session() writes.'''
+    ticks = bwengine.default_ticks(cfg, m)
+    trials = bwengine.trials_total(cfg, back)
+    return ','.join([timestamp, '%s%iB' % (bwengine.SHORT_MODE_NAMES[m], back),
+                     str(percent), str(m), str(back), str(ticks), str(trials),
+                     str(int(manual)), str(session_number)] +
+                    [str(categories[modality]) for modality in bwstats.MODALITY_COLUMNS] +
+                    [str(ticks * bwengine.TICK_DURATION * trials), '0'])
+
+def play_session(rng, cfg, m, back, percent):
+    '''Play a session of mode m on the game's rules, with a simulated player
+    whose hit rate is percent; returns the engine.'''
+    hit_rate = percent / 100.0
+    engine = bwengine.SessionEngine(
+        m, back, cfg, rng=random.Random(rng.getrandbits(63)),
+        player=bwengine.SimulatedPlayer(random.Random(rng.getrandbits(63)),
+                                        hit_rate, (1 - hit_rate) / 10))
+    engine.run()
+    return engine
+
+def session_record(engine, line, timestamp, manual, config):
+    '''A USER-sessions.dat session like Stats.submit_session() writes.'''
+    state = engine.state
+    return {'summary':        line.split(','),
+            'cfg':            config,
+            'timestamp':      timestamp,
+            'mode':           state.mode,
+            'n':              state.back,
+            'manual':         manual,
+            'trial_duration': state.ticks_per_trial * bwengine.TICK_DURATION,
+            'trials':         state.num_trials_total,
+            'seed':           state.seed,
+            'session':        engine.session}
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] STATSFILE [USER-sessions.dat]')
+    parser.add_option('--sessions', type='int', default=10000,
+                      help='number of sessions [default: %default]')
+    parser.add_option('--days', type='int', default=365,
+                      help='days the sessions are spread over [default: %default]')
+    parser.add_option('--start', default='2010-01-01',
+                      help='date of the first day, YYYY-MM-DD [default: %default]')
+    parser.add_option('--modes', default='2',
+                      help='modes played, as MODE:WEIGHT,... [default: %default]')
+    parser.add_option('--start-n', type='int', default=2,
+                      help='n-back level every mode starts at [default: %default]')
+    parser.add_option('--learning-rate', type='float', default=0.01,
+                      help='average skill gained per session at first, in n-back levels [default: %default]')
+    parser.add_option('--max-n', type='int', default=8,
+                      help='n-back level the skill levels off at [default: %default]')
+    parser.add_option('--manual', type='float', default=0.0,
+                      help='fraction of sessions played in manual mode [default: %default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed [default: %default]')
+    options, args = parser.parse_args()
+    if len(args) not in (1, 2):
+        parser.error('expected a stats file and optionally a sessions file')
+    if options.sessions < 0 or options.days < 1:
+        parser.error('--sessions must be at least 0 and --days at least 1')
+    try:
+        parse_modes(options.modes)
+    except ValueError as e:
+        parser.error(str(e))
+
+    rng = random.Random(options.seed)
+    # the sessions have their own generator, so that the n-back levels and
+    # the drawn scores do not depend on how many numbers playing them takes
+    trial_rng = random.Random('%i-trials' % options.seed)
+    cfg = bwengine.config()
+    stats_path = args[0]
+    archive = None
+    if len(args) == 2:
+        for path in (args[1], args[1] + bwstats.SESSIONS_INDEX_SUFFIX,
+                     args[1] + bwstats.CONFIGS_SUFFIX):
+            if os.path.exists(path):
+                os.remove(path)
+        archive = bwstats.SessionArchive(args[1])
+        config = dict(cfg)
+        config.update({'GENERATED_BY': 'genhistory.py', 'SEED': options.seed})
+        sessions_file = open(args[1], 'wb')
+    stats_file = open(stats_path, 'w')
+    stats_file.write(bwstats.stats_header() + '\n')
+    lines = []
+    count = 0
+    try:
+        for timestamp, m, trajectory, session_number in generate(rng, options):
+            back, percent = trajectory.back, trajectory.draw()
+            manual = options.manual > 0 and rng.random() < options.manual
+            if archive is None:
+                categories = drawn_categories(rng, m, percent)
+            else:
+                engine = play_session(trial_rng, cfg, m, back, percent)
+                percent, categories = engine.percent, engine.category_percents
+            trajectory.play(percent)
+            line = stats_line(cfg, timestamp, m, back, percent, categories, session_number, manual)
+            lines.append(line + '\n')
+            if archive is not None:
+                session = session_record(engine, line, timestamp, manual, config)
+                session_config, session = bwstats.pack_session(session)
+                archive.configs.put(session_config)
+                pickle.dump(session, sessions_file, protocol=pickle.HIGHEST_PROTOCOL)
+            if len(lines) >= 10000:
+                stats_file.write(''.join(lines))
+                lines = []
+            count += 1
+        stats_file.write(''.join(lines))
+    finally:
+        stats_file.close()
+        if archive is not None:
+            sessions_file.close()
+    if archive is not None:
+        archive.sync()  # builds the index
+    print('%s: %i sessions' % (stats_path, count))
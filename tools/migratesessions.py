@@ -0,0 +1,39 @@
+#!/usr/bin/env python
+#
+# migratesessions.py: shrink Brain Workshop USER-sessions.dat files written
+# by older versions, which stored a full copy of the configuration with
+# every session and kept its per-trial data unpacked.  Each distinct
+# configuration is moved to the config store (USER-sessions.dat.cfg) once, and
+# the sessions are rewritten to refer to it and to hold their trials packed.
+#
+# Usage: migratesessions.py FILE_OR_DATA_DIR...
+#
+
+import os, sys, optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bwstats
+
+def session_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for fn in sorted(os.listdir(path)):
+                if fn.endswith('-sessions.dat'):
+                    yield os.path.join(path, fn)
+        else:
+            yield path
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog FILE_OR_DATA_DIR...')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('expected a sessions file or a data directory')
+    failed = 0
+    for path in session_files(args):
+        try:
+            before, after = bwstats.SessionArchive(path).migrate()
+        except Exception as e:
+            sys.stderr.write('%s: not migrated, a session could not be read: %s\n' % (path, e))
+            failed += 1
+            continue
+        print('%s: %i -> %i bytes' % (path, before, after))
+    sys.exit(failed and 1 or 0)
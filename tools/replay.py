@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+#
+# replay.py: play sessions recorded in a Brain Workshop USER-sessions.dat file
+# again, without the game: the recorded stimuli and key presses go through
+# the game's rules (bwengine.py) and are scored again, with the scoring the
+# session was played with, Brain Workshop scoring or Jaeggi scoring.
+#
+# Usage: replay.py [options] USER-sessions.dat [SESSION...]
+#   replay.py data/default-sessions.dat -1
+#   replay.py --scoring both --mode 2 data/default-sessions.dat
+#   replay.py --trace --speed 1 data/default-sessions.dat 41
+#
+# SESSION is a number as listed by sessions.py (negative numbers count from
+# the end); by default every session is replayed.  A session whose replayed
+# score differs from the one it was given when played is marked with '!'.
+#
+# --speed plays the sessions in real time (1) or faster (10 is ten times as
+# fast) instead of as fast as possible; --trace prints each trial as it is
+# shown, which is where a renderer or a sound player would be attached.
+#
+
+import os, sys, optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bwstats
+import bwengine
+
+class TraceObserver(bwengine.Observer):
+    '''Prints the stimuli, the answer key and the key presses of each trial.'''
+    def stimulus_shown(self, engine):
+        state = engine.state
+        modalities = state.modalities[state.mode]
+        names = []
+        for mod in modalities:
+            name = mod == 'arithmetic' and 'number' or bwengine.MATCHED_STIMULI[mod][0]
+            if name not in names:
+                names.append(name)
+        stimuli = ' '.join(['%s=%s' % (name, state.current_stim[name]) for name in names])
+        if 'arithmetic' in modalities:
+            stimuli += ' ' + state.current_operation
+        key = state.answer_key
+        if key is None:
+            expected = '-'
+        else:
+            expected = ' '.join([mod == 'arithmetic' and 'answer %s' % key[mod] or mod
+                                 for mod in modalities
+                                 if mod == 'arithmetic' or key[mod]]) or 'no match'
+        print('  %3i  %.1fs  %s  [%s]' % (state.trial_number, engine.clock, stimuli, expected))
+
+    def key_pressed(self, engine, modality):
+        print('                %s pressed at %.3fs' % (modality, engine.state.input_rts[modality]))
+
+def replay(record, scoring, speed=None, trace=False):
+    engine = bwengine.ReplayEngine(record, scoring, trace and [TraceObserver()] or [])
+    return engine.run(speed)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] USER-sessions.dat [SESSION...]')
+    parser.add_option('--scoring', choices=('recorded', 'bw', 'jaeggi', 'both'), default='recorded',
+                      help='recorded (what the session was played with), bw, jaeggi or both '
+                           '[default: %default]')
+    parser.add_option('--mode', help='only these mode numbers, comma separated')
+    parser.add_option('--speed', type='float',
+                      help='play in real time, SPEED times as fast')
+    parser.add_option('--trace', action='store_true',
+                      help='print every trial')
+    parser.disable_interspersed_args()  # so that negative SESSION numbers are not options
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('expected a sessions file')
+    if options.speed is not None and options.speed <= 0:
+        parser.error('--speed must be more than 0')
+    archive = bwstats.SessionArchive(args[0])
+    try:
+        numbers = [int(arg) for arg in args[1:]]
+    except ValueError:
+        parser.error('SESSION must be a number')
+    if numbers:
+        for k in numbers:
+            if not -len(archive) <= k < len(archive):
+                parser.error('there is no session %i' % k)
+        sessions = [(k % len(archive), archive.load(k)) for k in numbers]
+    else:
+        modes = options.mode and set([int(m) for m in options.mode.split(',')]) or None
+        sessions = archive.iter_sessions(mode=modes)
+
+    scorings = {'recorded': [None], 'bw': ['bw'], 'jaeggi': ['jaeggi'],
+                'both': ['bw', 'jaeggi']}[options.scoring]
+    count = differ = failed = 0
+    for i, record in sessions:
+        recorded = bwengine.recorded_percent(record)
+        jaeggi_scoring = bool((record.get('cfg') or {}).get('JAEGGI_SCORING'))
+        scores = []
+        try:
+            for k, scoring in enumerate(scorings):
+                percent = replay(record, scoring, options.speed,
+                                 options.trace and k == 0)
+                scores.append('%s %i%%' % (scoring or 'replayed', percent))
+                if scoring is None or (scoring == 'jaeggi') == jaeggi_scoring:
+                    # scored like when it was played
+                    if recorded is not None and percent != recorded:
+                        scores[-1] += ' !'
+                        differ += 1
+        except (KeyError, IndexError, ValueError) as e:
+            scores.append('cannot replay: %s' % e)
+            failed += 1
+        name = bwengine.SHORT_MODE_NAMES.get(record.get('mode'), '?')
+        print('%6i  %s  %s%sB  recorded %s  %s' % (
+            i, record.get('timestamp', '?'), name, record.get('n', '?'),
+            recorded is None and '-' or '%i%%' % recorded, '  '.join(scores)))
+        count += 1
+    sys.stderr.write('%i sessions replayed, %i scored differently, %i could not be replayed\n' % (
+        count - failed, differ, failed))
+    sys.exit((differ or failed) and 1 or 0)
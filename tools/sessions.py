@@ -0,0 +1,55 @@
+#!/usr/bin/env python
+#
+# sessions.py: list the sessions stored in a Brain Workshop USER-sessions.dat
+# file without starting the game.  Sessions are read one at a time, so this
+# works on archives of any size.
+#
+# Usage: sessions.py [options] USER-sessions.dat
+#   sessions.py --since 2024-01-01 --mode 2 --n 3 data/default-sessions.dat
+#
+
+import os, sys, optparse
+from datetime import date
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bwstats
+
+def parse_date(string):
+    return date(*[int(part) for part in string.split('-')])
+
+def parse_ints(string):
+    return set([int(part) for part in string.split(',')])
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] USER-sessions.dat')
+    parser.add_option('--since', help='first date to include (YYYY-MM-DD)')
+    parser.add_option('--until', help='last date to include (YYYY-MM-DD)')
+    parser.add_option('--mode', help='mode numbers, comma separated')
+    parser.add_option('--n', help='n-back levels, comma separated')
+    parser.add_option('--manual', action='store_true', default=None,
+                      help='only sessions played in manual mode')
+    parser.add_option('--auto', dest='manual', action='store_false',
+                      help='only sessions not played in manual mode')
+    parser.add_option('--summary', action='store_true',
+                      help='print the stats.txt line of each session')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected one sessions file')
+
+    archive = bwstats.SessionArchive(args[0])
+    sessions = archive.iter_sessions(
+        since=options.since and parse_date(options.since),
+        until=options.until and parse_date(options.until),
+        mode=options.mode and parse_ints(options.mode),
+        n=options.n and parse_ints(options.n),
+        manual=options.manual, resolve=False)
+    count = 0
+    for i, session in sessions:
+        count += 1
+        if options.summary and session.get('summary'):
+            print('\t'.join([str(item) for item in session['summary']]))
+        else:
+            print('%6i  %s  mode %-4i n %-3i%s  %i trials' % (
+                i, session.get('timestamp', '?'), session.get('mode', 0),
+                session.get('n', 0), session.get('manual') and ' manual' or '',
+                session.get('trials', 0)))
+    sys.stderr.write('%i of %i sessions\n' % (count, len(archive)))
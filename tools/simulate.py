@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+#
+# simulate.py: play Brain Workshop sessions without a window or sound, with
+# a simulated player, and report the scores and how many sessions were run
+# per second.  Sessions run on the game's own rules (bwengine.py) on a
+# virtual clock, so a session takes milliseconds instead of minutes.
+#
+# Usage: simulate.py [options]
+#   simulate.py --mode 2 --back 3 --sessions 10000
+#   simulate.py --mode 130 --hit-rate 0.9 --false-alarm-rate 0.05 --jaeggi
+#
+# The same seed and options always give the same scores.
+#
+
+import os, sys, time, random, optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bwengine
+
+def simulate(task):
+    '''Play sessions first..last-1; returns ({percent: count}, trials).'''
+    first, last, options = task
+    cfg = bwengine.config(JAEGGI_MODE=bool(options.jaeggi), JAEGGI_SCORING=bool(options.jaeggi),
+                          VARIABLE_NBACK=int(bool(options.variable)))
+    percents = {}
+    trials = 0
+    for i in range(first, last):
+        engine = bwengine.SessionEngine(
+            options.mode, options.back, cfg, rng=random.Random('%i-%i' % (options.seed, i)),
+            player=bwengine.SimulatedPlayer(random.Random('%i-%i-player' % (options.seed, i)),
+                                            options.hit_rate, options.false_alarm_rate))
+        percent = engine.run()
+        percents[percent] = percents.get(percent, 0) + 1
+        trials += engine.state.num_trials_total
+    return percents, trials
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--mode', type='int', default=2,
+                      help='game mode, as in the stats file [default: %default]')
+    parser.add_option('--back', type='int',
+                      help='n-back level [default: that of the mode]')
+    parser.add_option('--sessions', type='int', default=1000,
+                      help='number of sessions [default: %default]')
+    parser.add_option('--hit-rate', type='float', default=0.8,
+                      help='chance of responding to a match [default: %default]')
+    parser.add_option('--false-alarm-rate', type='float', default=0.1,
+                      help='chance of responding without a match [default: %default]')
+    parser.add_option('--jaeggi', action='store_true',
+                      help='use JAEGGI_MODE and JAEGGI_SCORING')
+    parser.add_option('--variable', action='store_true',
+                      help='use VARIABLE_NBACK')
+    parser.add_option('--jobs', type='int', default=1,
+                      help='worker processes, 0 for one per CPU [default: %default]')
+    parser.add_option('--seed', type='int', default=0,
+                      help='random seed [default: %default]')
+    options, args = parser.parse_args()
+    if args:
+        parser.error('unexpected arguments')
+    if options.mode not in bwengine.MODALITIES:
+        parser.error('unknown mode %i' % options.mode)
+    if options.back is not None and options.back < 1:
+        parser.error('--back must be at least 1')
+
+    start = time.time()
+    if options.jobs == 1:
+        results = [simulate((0, options.sessions, options))]
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+        jobs = options.jobs or os.cpu_count() or 1
+        bounds = [options.sessions * k // jobs for k in range(jobs + 1)]
+        executor = ProcessPoolExecutor(jobs)
+        try:
+            results = list(executor.map(simulate, [(bounds[k], bounds[k + 1], options)
+                                                   for k in range(jobs)]))
+        finally:
+            executor.shutdown()
+    elapsed = time.time() - start
+
+    percents = {}
+    trials = 0
+    for counts, count in results:
+        trials += count
+        for percent, n in counts.items():
+            percents[percent] = percents.get(percent, 0) + n
+    sessions = sum(percents.values())
+    if not sessions:
+        print('no sessions')
+        sys.exit(0)
+    advance = sum([n for percent, n in percents.items() if percent >= 80])
+    fallback = sum([n for percent, n in percents.items() if percent < 50])
+    print('%s: %i sessions, %i trials in %.2f s (%i sessions/s)' % (
+        bwengine.SHORT_MODE_NAMES[options.mode], sessions, trials, elapsed,
+        sessions / max(elapsed, 1e-6)))
+    print('  mean score %.1f%%; %.1f%% of sessions at 80%% or more, %.1f%% under 50%%' % (
+        float(sum([percent * n for percent, n in percents.items()])) / sessions,
+        100.0 * advance / sessions, 100.0 * fallback / sessions))
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+#
+# statsdb.py: move Brain Workshop stats between a stats file and the SQLite
+# database used with STATS_BACKEND = sqlite.
+#
+# Usage:
+#   statsdb.py import STATS.TXT DATABASE [USER-sessions.dat]
+#   statsdb.py export DATABASE STATS.TXT
+#
+# import replaces the contents of the database by the sessions in the stats
+# file, adding any sessions from USER-sessions.dat that the stats file lacks.
+#
+
+import os, sys, optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bwstats
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog import STATS.TXT DATABASE [USER-sessions.dat]\n'
+                                         '       %prog export DATABASE STATS.TXT')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('expected import or export')
+    command, args = args[0], args[1:]
+    if command == 'import':
+        if len(args) not in (2, 3):
+            parser.error('import expects a stats file, a database and optionally a sessions file')
+        database = bwstats.StatsDatabase(args[1])
+        rows = database.import_stats(args[0], len(args) == 3 and args[2] or None)
+        print('%s -> %s: %i sessions' % (args[0], args[1], rows))
+    elif command == 'export':
+        if len(args) != 2:
+            parser.error('export expects a database and a stats file')
+        if not os.path.exists(args[0]):
+            parser.error('%s: no such database' % args[0])
+        database = bwstats.StatsDatabase(args[0])
+        rows = database.export_stats(args[1])
+        print('%s -> %s: %i sessions' % (args[0], args[1], rows))
+    else:
+        parser.error('unknown command %s' % command)
+    database.close()
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+#
+# tailstats.py: print the last sessions of a Brain Workshop stats file.
+# Unlike tail(1), it skips comments and malformed lines, and it reads only
+# as much of the end of the file as it needs.
+#
+# Usage: tailstats.py [-n COUNT] STATSFILE
+#
+
+import os, sys, optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bwstats
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [-n COUNT] STATSFILE')
+    parser.add_option('-n', type='int', dest='count', default=20,
+                      help='number of sessions to print [default: %default]')
+    options, args = parser.parse_args()
+    if len(args) != 1:
+        parser.error('expected one stats file')
+    for row in bwstats.tail_rows(args[0], options.count):
+        print(bwstats.format_row(row))
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#
+# verifylog.py: check the hash chain of Brain Workshop clinical mode session
+# logs (logfile.dat, USER-logfile.dat).  Only the records appended since the
+# last verification are read, unless --full is given; the point reached is
+# kept in FILE.verified.
+#
+# Usage: verifylog.py [--full] FILE_OR_DATA_DIR...
+#
+# The exit status is 1 if any log failed verification.
+#
+
+import os, sys, optparse
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bwstats
+
+def log_files(paths):
+    for path in paths:
+        if os.path.isdir(path):
+            for fn in sorted(os.listdir(path)):
+                if fn.endswith('logfile.dat'):
+                    yield os.path.join(path, fn)
+        else:
+            yield path
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [--full] FILE_OR_DATA_DIR...')
+    parser.add_option('--full', action='store_true',
+                      help='verify the whole log, not just what was appended since the last run')
+    options, args = parser.parse_args()
+    if not args:
+        parser.error('expected a log file or data directory')
+    failed = False
+    for path in log_files(args):
+        log = bwstats.ClinicalLog(path)
+        problems = log.verify(full=options.full)
+        for number, offset, reason in problems:
+            print('%s: record %i (byte %i): %s' % (path, number + 1, offset, reason))
+        if problems:
+            failed = True
+        else:
+            print('%s: %i records, chain intact' % (path, log.records))
+    sys.exit(failed and 1 or 0)